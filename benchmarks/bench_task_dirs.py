@@ -0,0 +1,76 @@
+"""Compare the ways of creating task directories.
+
+Usage: python benchmarks/bench_task_dirs.py [--tasks 1000] [--inputs 20]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Run against this checkout, whether or not metamds is installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metamds.task import LAYOUTS, create_task_dir
+
+
+def create_dir_chdir(output_dir, input_files):
+    """Task.create_dir as it used to be: two chdir and two relpath per file. """
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+    for in_file_path in input_files:
+        in_file_name = os.path.split(in_file_path)[1]
+        link_path = os.path.join(output_dir, in_file_name)
+        cwd = os.getcwd()
+        os.chdir(output_dir)
+        rel_in_path = os.path.relpath(in_file_path, output_dir)
+        rel_link_path = os.path.relpath(link_path, output_dir)
+        if not os.path.exists(rel_link_path):
+            os.symlink(rel_in_path, rel_link_path)
+        os.chdir(cwd)
+
+
+def bench(n_tasks, n_inputs, root):
+    input_dir = os.path.join(root, 'inputs')
+    os.mkdir(input_dir)
+    input_files = list()
+    for i in range(n_inputs):
+        input_files.append(os.path.join(input_dir, 'input_{}.itp'.format(i)))
+        with open(input_files[-1], 'w') as fh:
+            fh.write('x' * 1024)
+
+    results = dict()
+    modes = [('chdir (old)', lambda out: create_dir_chdir(out, input_files))]
+    modes.extend((layout, lambda out, layout=layout: create_task_dir(
+        out, input_files, layout=layout, input_dir=input_dir)) for layout in LAYOUTS)
+    for name, create in modes:
+        output_dir = os.path.join(root, name.split()[0])
+        os.mkdir(output_dir)
+        start = time.time()
+        for i in range(n_tasks):
+            create(os.path.join(output_dir, 'task_{}'.format(i)))
+        results[name] = time.time() - start
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--inputs', type=int, default=20)
+    parser.add_argument('--dir', help='Directory to benchmark in, e.g. on a '
+                                      'parallel filesystem (default: a temp dir).')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='metamds_bench_', dir=args.dir)
+    try:
+        results = bench(args.tasks, args.inputs, root)
+    finally:
+        shutil.rmtree(root)
+    print('{} tasks x {} inputs'.format(args.tasks, args.inputs))
+    for name, seconds in results.items():
+        print('{:<12} {:8.3f} s  {:8.1f} tasks/s'.format(name, seconds, args.tasks / seconds))
+
+
+if __name__ == '__main__':
+    main()
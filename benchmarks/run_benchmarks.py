@@ -0,0 +1,273 @@
+"""Time the hot paths of metamds.
+
+The suite runs offline: database benchmarks use `mongomock` as an in-process
+stand-in for MongoDB and are skipped if it is not installed. Results are
+written as JSON and can be compared against an earlier run to spot
+regressions.
+
+Usage:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Run against this checkout, whether or not metamds is installed.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import metamds as mds
+from metamds.io import cmd_line, stream_cmd_line
+
+BENCHMARKS = OrderedDict()
+
+# Every simulation gets its own loggers, so that handlers do not pile up.
+_SIMULATION_IDS = itertools.count()
+
+
+def benchmark(name, sizes, quick_sizes=None):
+    """Register a benchmark run once per size.
+
+    The decorated function does its setup and returns a callable, which is
+    what gets timed.
+
+    """
+    def register(func):
+        BENCHMARKS[name] = (func, sizes, quick_sizes or sizes)
+        return func
+    return register
+
+
+def _scratch():
+    return tempfile.mkdtemp(prefix='metamds_bench_')
+
+
+def _simulation(n_inputs):
+    name = 'bench_{:d}'.format(next(_SIMULATION_IDS))
+    return mds.Simulation(name=name, input_dir=_input_dir(n_inputs),
+                          output_dir=os.path.join(_scratch(), name))
+
+
+def _input_dir(n_inputs):
+    input_dir = _scratch()
+    for i in range(n_inputs):
+        with open(os.path.join(input_dir, 'input_{}.itp'.format(i)), 'w') as fh:
+            fh.write('x' * 1024)
+    return input_dir
+
+
+@benchmark('import', sizes=(1,))
+def bench_import(_):
+    # A fresh interpreter each time; `python -c pass` is not subtracted. It
+    # starts in the checkout, so that it imports the same metamds.
+    return lambda: subprocess.check_call([sys.executable, '-c', 'import metamds'],
+                                         cwd=REPO_ROOT)
+
+
+def _md_template(T, nsteps, input_dir):
+    return ['gmx grompp -f md.mdp -c {}/conf.gro -o {}.tpr'.format(input_dir, T),
+            'gmx mdrun -deffnm {} -nsteps {}'.format(T, nsteps)]
+
+
+@benchmark('parametrize', sizes=(10, 1000, 10000), quick_sizes=(10, 1000))
+def bench_parametrize(n_tasks):
+    # One call per task, each creating its directory and rescanning the inputs.
+    sim = _simulation(5)
+    sim.template = _md_template
+    parameter_sets = [{'T': 300 + i, 'nsteps': 1000} for i in range(n_tasks)]
+
+    def run():
+        for parameters in parameter_sets:
+            sim.parametrize(**parameters)
+    return run
+
+
+@benchmark('parametrize_many', sizes=(10, 1000, 10000), quick_sizes=(10, 1000))
+def bench_parametrize_many(n_tasks):
+    sim = _simulation(5)
+    sim.template = ['gmx grompp -f md.mdp -c conf.gro -o {T}.tpr',
+                    'gmx mdrun -deffnm {T} -nsteps {nsteps}']
+    sim.format_template = True
+    parameter_sets = [{'T': 300 + i, 'nsteps': 1000} for i in range(n_tasks)]
+    return lambda: sim.parametrize_many(parameter_sets)
+
+
+@benchmark('create_dir', sizes=(100, 1000), quick_sizes=(100,))
+def bench_create_dir(n_tasks):
+    sim = _simulation(20)
+    tasks = [mds.Task(name='task_{}'.format(i), simulation=sim, script=())
+             for i in range(n_tasks)]
+
+    def run():
+        for task in tasks:
+            task.create_dir()
+    return run
+
+
+@benchmark('get_output_files', sizes=(100, 10000), quick_sizes=(100,))
+def bench_get_output_files(n_files):
+    sim = _simulation(0)
+    task = mds.Task(name='md', simulation=sim, script=())
+    task.create_dir()
+    for i in range(n_files):
+        ext = ('.xtc', '.gro', '.edr', '.log')[i % 4]
+        open(os.path.join(task.output_dir, 'out_{}{}'.format(i, ext)), 'w').close()
+
+    def run():
+        task.invalidate_manifest()
+        for file_type in ('.xtc', 'trajectories', 'topologies', '.log'):
+            task.get_output_files(file_type)
+    return run
+
+
+@benchmark('cmd_line', sizes=(10**5, 10**6), quick_sizes=(10**5,))
+def bench_cmd_line(n_lines):
+    return lambda: cmd_line('seq {:d} | cat'.format(n_lines))
+
+
+@benchmark('stream_cmd_line', sizes=(10**5, 10**6), quick_sizes=(10**5,))
+def bench_stream_cmd_line(n_lines):
+    return lambda: stream_cmd_line('seq {:d} | cat'.format(n_lines),
+                                   stdout_callback=lambda line: None)
+
+
+def _mongo_client():
+    import mongomock
+    return mongomock.MongoClient()
+
+
+@benchmark('add_doc_db', sizes=(100, 1000), quick_sizes=(100,))
+def bench_add_doc_db(n_docs):
+    from metamds.db import add_doc_db
+    client = _mongo_client()
+    docs = [{'T': 300 + i, 'P': i % 10, 'output_dir': '/tmp/task_{}/'.format(i)}
+            for i in range(n_docs)]
+
+    def run():
+        for doc in docs:
+            add_doc_db(dict(doc), client=client)
+    return run
+
+
+@benchmark('query_sim', sizes=(1000, 10000), quick_sizes=(1000,))
+def bench_query_sim(n_docs):
+    from metamds.db import query_sim
+    client = _mongo_client()
+    client['shearing_simulations']['tasks'].insert_many(
+        [{'T': 300 + i, 'P': i % 10, 'output_dir': '/tmp/task_{}/'.format(i)}
+         for i in range(n_docs)])
+
+    def run():
+        for pressure in range(10):
+            list(query_sim(client=client, P=pressure))
+        list(query_sim(client=client, T=list(range(300, 400))))
+    return run
+
+
+def run_benchmarks(names=None, quick=False, repeat=5):
+    """Run the benchmarks and return their results.
+
+    Returns
+    -------
+    results : OrderedDict
+        The 'min' and 'median' time in seconds over `repeat` runs, keyed by
+        "<name>[<size>]". Benchmarks that could not run have an 'error'
+        instead.
+
+    """
+    results = OrderedDict()
+    for name, (func, sizes, quick_sizes) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        for size in (quick_sizes if quick else sizes):
+            key = '{}[{}]'.format(name, size)
+            times = list()
+            try:
+                for _ in range(repeat):
+                    timed = func(size)
+                    start = time.time()
+                    timed()
+                    times.append(time.time() - start)
+            except ImportError as error:
+                results[key] = {'error': str(error)}
+                print('{:<28} skipped: {}'.format(key, error))
+                continue
+            times.sort()
+            results[key] = OrderedDict([('min', times[0]),
+                                        ('median', times[len(times) // 2]),
+                                        ('repeat', repeat)])
+            print('{:<28} {:10.4f} s'.format(key, times[0]))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the change against a baseline and return the regressed benchmarks. """
+    regressions = list()
+    for key, result in results.items():
+        before = baseline.get(key)
+        if 'min' not in result or not before or 'min' not in before:
+            continue
+        ratio = result['min'] / before['min']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        print('{:<28} {:10.4f} s -> {:10.4f} s  x{:.2f}{}'.format(
+            key, before['min'], result['min'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', help='Benchmarks to run, all by default: '
+                                                 '{}.'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--quick', action='store_true', help='Skip the largest sizes.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Compare against results from an earlier run.')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Slowdown that counts as a regression (default: 1.25).')
+    args = parser.parse_args()
+
+    tmp = tempfile.tempdir = tempfile.mkdtemp(prefix='metamds_bench_')
+    try:
+        results = run_benchmarks(args.names, quick=args.quick, repeat=args.repeat)
+    finally:
+        tempfile.tempdir = None
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.output:
+        try:
+            from metamds.version import version
+        except ImportError:  # Not installed with setup.py.
+            version = None
+        with open(args.output, 'w') as fh:
+            json.dump(OrderedDict([('version', version),
+                                   ('python', platform.python_version()),
+                                   ('platform', platform.platform()),
+                                   ('time', time.time()),
+                                   ('results', results)]), fh, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)['results']
+        print()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,79 @@
-import pymongo as pm
+import json
+import os
+import socket
+import threading
+
+from six import string_types
 
 # TODO: Add user//pw functionality for a hosted db and implement the get_uri function
 
+# Query operators accepted by `build_query`.
+QUERY_OPERATORS = {"$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin", "$exists"}
+
+# Same as `pymongo.ASCENDING`; pymongo itself is only imported when a client is
+# needed, since it is slow to import.
+ASCENDING = 1
+
+# Shared clients, keyed by host, port, credentials and client options.
+_CLIENTS = dict()
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(host="127.0.0.1", port=27017, user=None, password=None, **options):
+    """returns a shared client for a database server
+
+    Clients are created on first use and reused by every later call with the
+    same arguments, so that each server only gets one connection pool.
+
+    Parameters
+    ----------
+    host : str, optional
+        Database connection host (the default is 127.0.0.1, or the local computer being used)
+    port : int, optional
+        Database host port (default is 27017, which is the pymongo default port).
+    user : str, optional
+        User name (default is None, meaning the database is public).
+    password : str, optional
+        User password (default is None, meaning there is no password access to database).
+    **options
+        Keyword arguments passed to `pymongo.MongoClient`, e.g. pooling options
+        such as `maxPoolSize` or `maxIdleTimeMS`.
+
+    Returns
+    -------
+    client : pymongo.MongoClient
+    """
+    key = (host, port, user, password, tuple(sorted(options.items())))
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            kwargs = dict(journal=True)
+            if user is not None:
+                kwargs.update(username=user, password=password)
+            kwargs.update(options)
+            from pymongo import MongoClient
+            client = MongoClient(host, port, **kwargs)
+            _CLIENTS[key] = client
+    return client
+
+
+def close_clients():
+    """closes all shared clients created by `get_client`"""
+    with _CLIENTS_LOCK:
+        for client in _CLIENTS.values():
+            client.close()
+        _CLIENTS.clear()
+
+
+def _get_collection(client, host, port, database, user, password, collection):
+    if client is None:
+        client = get_client(host, port, user, password)
+    return client[database][collection]
+
+
 def add_doc_db(doc, host="127.0.0.1", port=27017, database="shearing_simulations", 
-               user=None, password=None, collection="tasks", update_duplicates=False):
+               user=None, password=None, collection="tasks", update_duplicates=False,
+               client=None):
     """adds a single document to a database
 
     Parameters
@@ -25,23 +95,98 @@ def add_doc_db(doc, host="127.0.0.1", port=27017, database="shearing_simulations
     update_duplicates : bool, optional
         Determines ifduplicates in the database will be updated (default is False, meaning 
         the added doc should not replace an existing doc that is equivalent)
+    client : pymongo.MongoClient, optional
+        Client to use instead of the shared client from `get_client`.
     """             
-    conn = pm.MongoClient(host, port, j=True)
-    db = conn[database]
-    collection = db[collection]
+    collection = _get_collection(client, host, port, database, user, password, collection)
     
     if doc and update_duplicates:
-        if collection.find(doc).count()==1:
+        # At most two matches are needed to tell one from many.
+        n_docs = collection.count_documents(doc, limit=2)
+        if n_docs==1:
             collection.update_one(doc, {"$set":doc, "$currentDate":{"lastModified":True}})
-        elif collection.find(doc).count()>1:
+        elif n_docs>1:
             print("database not updated because more than one file fits this description")
         else:
             collection.insert_one(doc)
     else:
         collection.insert_one(doc)
 
+def add_docs_db(docs, key=None, host="127.0.0.1", port=27017, database="shearing_simulations",
+                user=None, password=None, collection="tasks", update_duplicates=False,
+                client=None):
+    """adds many documents to a database in a single unordered bulk write
+
+    Every document is upserted on its natural key, so documents that are
+    already in the collection are not inserted again.
+
+    Parameters
+    ----------
+    docs : iterable of dict
+        Documents being entered into a collection
+    key : list of str, optional
+        Fields that identify a document (default is None, meaning all fields of
+        the document, so that only equivalent documents are duplicates).
+    host : str, optional
+        Database connection host (the default is 127.0.0.1, or the local computer being used)
+    port : int, optional
+        Database host port (default is 27017, which is the pymongo default port).
+    database : str, optional
+        Name of the database being used (default is shearing_simulations).
+    user : str, optional 
+        User name (default is None, meaning the database is public).
+    password : str, optional 
+        User password (default is None, meaning there is no password access to database).
+    collection : str, optional 
+        Database collection name for doc location (default is tasks).
+    update_duplicates : bool, optional
+        Determines if existing documents with the same key are updated with the
+        fields of the new document (default is False, meaning they are left as they are)
+    client : pymongo.MongoClient, optional
+        Client to use instead of the shared client from `get_client`.
+
+    Returns
+    -------
+    counts : dict
+        Number of documents "inserted", "updated" and "skipped".
+    """
+    collection = _get_collection(client, host, port, database, user, password, collection)
+
+    # Only the last of several documents with the same key is written.
+    unique = dict()
+    n_docs = 0
+    for doc in docs:
+        n_docs += 1
+        doc = dict((k, v) for k, v in doc.items() if k != "_id")
+        if key is None:
+            doc_filter = doc
+        else:
+            missing = [field for field in key if field not in doc]
+            if missing:
+                raise ValueError("document is missing key fields {}: {}".format(missing, doc))
+            doc_filter = dict((field, doc[field]) for field in key)
+        unique[json.dumps(doc_filter, sort_keys=True, default=str)] = (doc_filter, doc)
+
+    from pymongo import UpdateOne
+    requests = list()
+    for doc_filter, doc in unique.values():
+        if update_duplicates:
+            update = {"$set": doc, "$currentDate": {"lastModified": True}}
+        else:
+            update = {"$setOnInsert": doc}
+        requests.append(UpdateOne(doc_filter, update, upsert=True))
+
+    counts = {"inserted": 0, "updated": 0, "skipped": n_docs}
+    if requests:
+        result = collection.bulk_write(requests, ordered=False)
+        counts["inserted"] = result.upserted_count
+        counts["updated"] = result.modified_count
+        counts["skipped"] = n_docs - result.upserted_count - result.modified_count
+    return counts
+
 def update_doc(existing_doc, added_values, host="127.0.0.1", port=27017, 
-               database="shearing_simulations", user=None, password=None, collection="tasks"):
+               database="shearing_simulations", user=None, password=None, collection="tasks",
+               client=None):
     """updates a single document in a database
 
     Parameters
@@ -62,19 +207,20 @@ def update_doc(existing_doc, added_values, host="127.0.0.1", port=27017,
         User password (default is None, meaning there is no password access to database).
     collection : str, optional 
         Database collection name for doc location (default is tasks).
+    client : pymongo.MongoClient, optional
+        Client to use instead of the shared client from `get_client`.
     """
     
-    conn = pm.MongoClient(host, port, j=True)
-    db = conn[database]
-    collection = db[collection]
+    collection = _get_collection(client, host, port, database, user, password, collection)
 
-    if collection.find(existing_doc).count()==1:
+    if collection.count_documents(existing_doc, limit=2)==1:
         collection.update_one(existing_doc, {"$set":added_values})
     else:
         print("database not updated because there is no existing doc or there are more than one existing docs found")
 
 def query_sim(host="127.0.0.1", port=27017, database="shearing_simulations", user=None,
-              password=None, collection="tasks", **kwargs):
+              password=None, collection="tasks", client=None, projection=None, sort=None,
+              limit=0, **kwargs):
     """queries a database collection for documents that fit the keyword arguements
 
     Parameters
@@ -91,54 +237,148 @@ def query_sim(host="127.0.0.1", port=27017, database="shearing_simulations", use
         User password (default is None, meaning there is no password access to database).
     collection : str, optional 
         Database collection name for doc location (default is tasks).
-    **kwargs : keys of lists of strings (ie {"A": ["a"], "B": ["b", "bb"]} or A=["a"])
-        Fields and field values being queried in a simulation.
+    client : pymongo.MongoClient, optional
+        Client to use instead of the shared client from `get_client`.
+    projection : list of str or dict, optional
+        Fields returned for each document (default is None, meaning whole documents).
+    sort : str or list of (str, int), optional
+        Field, or list of (field, direction) pairs, to sort the documents by
+        (default is None, meaning the order is undefined).
+    limit : int, optional
+        Maximum number of documents returned (default is 0, meaning no limit).
+    **kwargs : keys of lists of values (ie {"A": ["a"], "B": ["b", "bb"]} or A=["a"])
+        Fields and field values being queried in a simulation. A document matches
+        if, for every field, its value is one of the listed values. Numeric
+        ranges are given as dicts of operators, e.g. T={"$gte": 300, "$lt": 400}.
     
     Returns
     -------
     cursor : pymongo.Cursor()
         An iterable python object that contains all the documents that the query specifies.
     """
-    client = pm.MongoClient(host, port, j=True)
-    db = client[database]
-    collection = db[collection]
-
-    keys = list()
-    fields = list()
-    for key, doc_fields in kwargs.items():
-        for field in doc_fields:
-            keys.append(key)
-            fields.append(field)
-    
-    it_len = len(keys)
-    if not keys:
-        raise ValueError('**kwargs needed')
-    elif it_len == 1:
-        cursor = collection.find({keys[0]:fields[0]})
-    else:
-        and_list = list()
-        or_list = list()
-        key_hold = keys[0]
-        for i in range(it_len):
-            if i == it_len-1 and key_hold != keys[i]:
-                and_list.append({"$or":or_list})
-                or_list = [{keys[i]:fields[i]}]
-                and_list.append({"$or":or_list})
-            elif key_hold is not keys[i]:
-                and_list.append({"$or":or_list})
-                or_list = [{keys[i]:fields[i]}]
-            elif i == it_len-1:
-                or_list.append({keys[i]:fields[i]})
-                and_list.append({"$or":or_list})
-            else:
-                or_list.append({keys[i]:fields[i]})
-            key_hold = keys[i]
-    
-        cursor = collection.find({"$and":and_list})
+    collection = _get_collection(client, host, port, database, user, password, collection)
+    cursor = collection.find(build_query(**kwargs), projection)
+    if sort:
+        if isinstance(sort, string_types):
+            sort = [(sort, ASCENDING)]
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
     return cursor
 
+def build_query(**kwargs):
+    """compiles keyword arguements into a MongoDB filter
+
+    Each field becomes a single equality or `$in` clause, or a set of range
+    operators, and all clauses are combined with an implicit AND.
+
+    Parameters
+    ----------
+    **kwargs : keys of lists of values or dicts of operators
+        See `query_sim`.
+
+    Returns
+    -------
+    query : dict
+        A filter that can be passed to `pymongo.collection.Collection.find`.
+    """
+    if not kwargs:
+        raise ValueError('**kwargs needed')
+    query = dict()
+    for key, values in kwargs.items():
+        if isinstance(values, dict):
+            unknown = set(values) - QUERY_OPERATORS
+            if unknown:
+                raise ValueError('Unsupported query operators for "{}": {}'.format(
+                    key, ', '.join(sorted(unknown))))
+            query[key] = values
+        elif isinstance(values, (list, tuple, set, frozenset)):
+            values = list(values)
+            if not values:
+                raise ValueError('No values given for "{}"'.format(key))
+            query[key] = values[0] if len(values) == 1 else {"$in": values}
+        else:
+            query[key] = values
+    return query
+
+def create_indexes(fields, host="127.0.0.1", port=27017, database="shearing_simulations",
+                   user=None, password=None, collection="tasks", client=None, compound=False):
+    """creates ascending indexes on fields of a database collection
+
+    Creating an index that already exists does nothing.
+
+    Parameters
+    ----------
+    fields : list of str
+        Fields being indexed, typically the parameters of a sweep.
+    host : str, optional
+        Database connection host (the default is 127.0.0.1, or the local computer being used)
+    port : int, optional
+        Database host port (default is 27017, which is the pymongo default port).
+    database : str, optional
+        Name of the database being used (default is shearing_simulations).
+    user : str, optional
+        User name (default is None, meaning the database is public).
+    password : str, optional
+        User password (default is None, meaning there is no password access to database).
+    collection : str, optional
+        Database collection name for doc location (default is tasks).
+    client : pymongo.MongoClient, optional
+        Client to use instead of the shared client from `get_client`.
+    compound : bool, optional
+        Create one compound index over all fields, in the given order, instead
+        of one index per field (default is False).
+
+    Returns
+    -------
+    names : list of str
+        Names of the indexes.
+    """
+    collection = _get_collection(client, host, port, database, user, password, collection)
+    if compound:
+        return [collection.create_index([(field, ASCENDING) for field in fields])]
+    return [collection.create_index([(field, ASCENDING)]) for field in fields]
+
+def explain_query(host="127.0.0.1", port=27017, database="shearing_simulations", user=None,
+                  password=None, collection="tasks", client=None, projection=None, sort=None,
+                  limit=0, **kwargs):
+    """summarizes how the database executes a `query_sim` query
+
+    Parameters
+    ----------
+    Same as `query_sim`.
+
+    Returns
+    -------
+    report : dict
+        The "stages" of the winning plan (e.g. "FETCH <- IXSCAN"), the "index"
+        used if any, the number of documents "returned", "docs_examined" and
+        "keys_examined", the execution time in "millis" and the full "explain"
+        output.
+    """
+    cursor = query_sim(host=host, port=port, database=database, user=user,
+                       password=password, collection=collection, client=client,
+                       projection=projection, sort=sort, limit=limit, **kwargs)
+    explain = cursor.explain()
+    plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+    plan = plan.get("queryPlan", plan)
+    stages = list()
+    index = None
+    while plan:
+        stages.append(plan.get("stage"))
+        index = plan.get("indexName", index)
+        plan = plan.get("inputStage")
+    stats = explain.get("executionStats", {})
+    return {"stages": " <- ".join(str(stage) for stage in stages),
+            "index": index,
+            "returned": stats.get("nReturned"),
+            "docs_examined": stats.get("totalDocsExamined"),
+            "keys_examined": stats.get("totalKeysExamined"),
+            "millis": stats.get("executionTimeMillis"),
+            "explain": explain}
+
 def retrieve_all(host="127.0.0.1", port=27017, database="shearing_simulations", user=None,
-                 password=None, collection="tasks"):
+                 password=None, collection="tasks", client=None):
     """retrieves all the documents in a database collection
 
     Parameters
@@ -155,15 +395,15 @@ def retrieve_all(host="127.0.0.1", port=27017, database="shearing_simulations",
         User password (default is None, meaning there is no password access to database).
     collection : str, optional 
         Database collection name for doc location (default is tasks).
+    client : pymongo.MongoClient, optional
+        Client to use instead of the shared client from `get_client`.
     
     Returns
     -------
     cursor : pymongo.Cursor()
         An iterable python object that contains all the documents that the query specifies.
     """
-    client = pm.MongoClient(host, port, j=True)
-    db = client[database]
-    collection = db[collection]   
+    collection = _get_collection(client, host, port, database, user, password, collection)
  
     cursor = collection.find({})
     return cursor
@@ -172,14 +412,16 @@ def get_uri(name):
     """returns the full path name including computer ip location for a file or directory
     Parameters
     ----------
-    name : str
+    name : str or list of str
         file or directory name
     
     Returns
     -------
-    full_uri : str
+    full_uri : str or list of str
         full file or directory name
     """   
+    if not isinstance(name, string_types):
+        return [get_uri(n) for n in name]
     fullpath = os.path.abspath(name)
     try:
         hostname = socket.gethostbyaddr(socket.gethostname())[0]
@@ -0,0 +1,161 @@
+"""Deduplication of task outputs through a local, content-addressed store.
+
+Files with the same contents in different task directories, e.g. processed
+`.gro`, `topol.top` or `.itp` files that do not depend on the swept
+parameters, are replaced by hard links to a single copy in `OBJECTS_DIR`.
+Remote files whose contents are already stored need not be transferred.
+
+Hard links share their data, so a file that is modified in place changes in
+every task directory. Deduplicate finished tasks only.
+
+"""
+import errno
+import os
+
+from six.moves import shlex_quote
+
+from metamds.io import file_digest
+
+# The object store in a simulation's output directory.
+OBJECTS_DIR = '.metamds_objects'
+
+# Remote files larger than this are not hashed by `remote_digests`, as
+# large outputs such as trajectories are rarely shared between tasks.
+MAX_REMOTE_HASH_SIZE = 100 * 2**20
+
+
+class ObjectStore(object):
+    """A directory of files named by the SHA-256 digest of their contents.
+
+    Parameters
+    ----------
+    root : str
+        Created if it does not exist.
+
+    """
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def __contains__(self, digest):
+        return os.path.isfile(os.path.join(self.root, digest))
+
+    def add(self, path):
+        """Store a file, or replace it by a hard link if its contents are stored.
+
+        Returns
+        -------
+        saved : int
+            Bytes freed by replacing the file, 0 if it was new to the store.
+
+        """
+        digest = file_digest(path)
+        obj = os.path.join(self.root, digest)
+        if not os.path.exists(obj):
+            try:
+                os.link(path, obj)
+                return 0
+            except OSError as error:
+                # Stored by another thread in the meantime.
+                if error.errno != errno.EEXIST:
+                    raise
+        if os.path.samefile(path, obj):
+            return 0
+        size = os.path.getsize(path)
+        self.link(digest, path)
+        return size
+
+    def link(self, digest, path):
+        """Atomically replace or create `path` as a hard link to a stored file. """
+        tmp_path = '{}.metamds_tmp'.format(path)
+        os.link(os.path.join(self.root, digest), tmp_path)
+        os.rename(tmp_path, path)
+
+
+def deduplicate(paths, store, min_size=1):
+    """Replace files with identical contents by hard links into a store.
+
+    Only files of a size shared by at least two files, or of a stored size,
+    are hashed.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Regular files; symlinks are skipped.
+    store : ObjectStore
+    min_size : int, optional, default=1
+        Skip smaller files.
+
+    Returns
+    -------
+    n_files, saved : int
+        The number of files replaced and the bytes freed.
+
+    """
+    by_size = dict()
+    for path in paths:
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        size = os.path.getsize(path)
+        if size >= min_size:
+            by_size.setdefault(size, list()).append(path)
+    stored_sizes = set(os.path.getsize(os.path.join(store.root, name))
+                       for name in os.listdir(store.root))
+
+    n_files = saved = 0
+    for size, candidates in by_size.items():
+        if len(candidates) < 2 and size not in stored_sizes:
+            continue
+        for path in candidates:
+            freed = store.add(path)
+            if freed:
+                n_files += 1
+                saved += freed
+    return n_files, saved
+
+
+def remote_digests(client, remote_dir, names, max_size=MAX_REMOTE_HASH_SIZE,
+                   patterns=None):
+    """Hash the files in some directories on a remote host.
+
+    Parameters
+    ----------
+    client : paramiko.SSHClient
+    remote_dir : str
+        The directory containing the directories `names`.
+    names : list of str
+    max_size : int, optional, default=MAX_REMOTE_HASH_SIZE
+        Larger files are not hashed.
+    patterns : list of str, optional
+        Only hash files whose names match one of these glob patterns.
+
+    Returns
+    -------
+    digests : dict
+        SHA-256 digests keyed by path relative to `remote_dir`.
+
+    """
+    name_filter = ''
+    if patterns is not None:
+        if not patterns:
+            return dict()
+        name_filter = ' \\( {} \\)'.format(' -o '.join(
+            '-name {}'.format(shlex_quote(pattern)) for pattern in patterns))
+    # Tasks that never ran have no directory, which is not an error.
+    cmd = ('cd {} && find {} -maxdepth 1 -type f -size -{:d}c{} -print0 2>/dev/null | '
+           'xargs -0 -r sha256sum'.format(shlex_quote(remote_dir),
+                                          ' '.join(shlex_quote(name) for name in names),
+                                          max_size + 1, name_filter))
+    _, stdout, stderr = client.exec_command(cmd)
+    out = stdout.read().decode('utf-8')
+    errors = stderr.read().decode('utf-8').strip()
+    if errors:
+        raise IOError(errors)
+    digests = dict()
+    for line in out.splitlines():
+        digest, _, path = line.partition('  ')
+        if path:
+            digests[path] = digest
+    return digests
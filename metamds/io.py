@@ -1,19 +1,49 @@
+import hashlib
+import os
 import shlex
 from subprocess import Popen, PIPE
+import sys
+import threading
+import time
 
+# Digests of files already hashed, keyed by (path, inode, size, mtime).
+_DIGESTS = dict()
 
-def cmd_line(line, stdin=None):
-    """ """
-    if '|' in line:
-        cmds = line.split('|')
-    else:
-        cmds = [line]
-    procs = []
-    for cmd in cmds:
-        args = shlex.split(cmd)
-        procs.append(Popen(args, stdin=stdin, stdout=PIPE, stderr=PIPE))
-        stdin = procs[-1].stdout
-    out, err = procs[-1].communicate()
+# Longest line handed over by `stream_cmd_line`; longer lines are split.
+MAX_LINE = 2**16
+
+# Remote shell of `rsync_to` and `rsync_from`. Transfers to the same host
+# share one SSH connection, kept open for ten minutes after the last one,
+# instead of each doing its own handshake.
+RSYNC_SSH = ('ssh -o ControlMaster=auto -o ControlPath=~/.ssh/metamds-%C '
+             '-o ControlPersist=600')
+
+
+def cmd_line(line, stdin=None, cwd=None, timeout=None):
+    """Run a command line, optionally containing `|` pipes.
+
+    Parameters
+    ----------
+    line : str
+    stdin : file, optional
+        Standard input of the first command in the pipeline.
+    cwd : str, optional
+        Run the commands in this directory instead of the current one.
+    timeout : float, optional
+        Kill the pipeline if it runs for longer than this many seconds.
+
+    Returns
+    -------
+    out, err : bytes
+        Standard output of the last command and standard error of all commands
+        in the pipeline.
+
+    """
+    out, err = list(), list()
+    stream_cmd_line(line, stdout_callback=out.append, stderr_callback=err.append,
+                    stdin=stdin, cwd=cwd, timeout=timeout)
+    out = ''.join('{}\n'.format(text) for text in out).encode('utf-8')
+    err = ''.join('{}\n'.format(text) for text in err).encode('utf-8')
     # Gromacs logs a lot of its informational output to stderr.
     if 'GROMACS' in err.decode('utf-8'):
         out += err
@@ -21,15 +51,193 @@ def cmd_line(line, stdin=None):
     return out, err
 
 
+def stream_cmd_line(line, stdout_callback=None, stderr_callback=None, stdin=None,
+                    cwd=None, env=None, timeout=None, cancel=None, affinity=None,
+                    profile=None):
+    """Run a command line and hand its output over line by line as it arrives.
+
+    Output is never accumulated, so memory use does not grow with the amount
+    of output. Lines end at a newline or a carriage return, as written by
+    progress meters such as that of `gmx mdrun -v`, and are split after
+    `MAX_LINE` bytes. The standard error of every command in a `|` pipeline
+    is drained, which prevents the pipeline from stalling on a full pipe.
+
+    Parameters
+    ----------
+    line : str
+        A command, optionally containing `|` pipes.
+    stdout_callback : callable, optional
+        Called with each line (without newline) of the last command's output.
+    stderr_callback : callable, optional
+        Called with each line of standard error from any command.
+    stdin : file, optional
+        Standard input of the first command in the pipeline.
+    cwd : str, optional
+        Run the commands in this directory instead of the current one.
+    env : dict, optional
+        Environment of the commands.
+    timeout : float, optional
+        Kill the pipeline if it runs for longer than this many seconds.
+    cancel : threading.Event, optional
+        Kill the pipeline as soon as this event is set.
+    affinity : iterable of int, optional
+        Restrict the commands, and the threads they start, to these CPUs.
+        Ignored on systems without `os.sched_setaffinity`.
+    profile : dict, optional
+        Filled in with the resources used by the pipeline: 'wall_time',
+        'user_time' and 'system_time' in seconds, the largest 'max_rss' of
+        any command and 'bytes_written' to disk, both in bytes. Only the
+        wall time is measured on systems without `os.wait4`.
+
+    Returns
+    -------
+    returncode : int
+        The exit status of the last command in the pipeline.
+
+    """
+    procs = list()
+    readers = list()
+    usages = list()
+    start = time.time()
+    try:
+        for cmd in line.split('|'):
+            args = shlex.split(cmd)
+            proc = _popen(args, affinity, stdin=stdin, stdout=PIPE, stderr=PIPE,
+                          cwd=cwd, env=env)
+            if procs:
+                # Only the next command reads this pipe now, so that the
+                # upstream command receives SIGPIPE if it exits early.
+                procs[-1].stdout.close()
+            procs.append(proc)
+            readers.append(_start_reader(proc.stderr, stderr_callback))
+            stdin = proc.stdout
+        readers.append(_start_reader(procs[-1].stdout, stdout_callback))
+
+        interval = 0.001
+        while any(_poll(proc, usages) is None for proc in procs):
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError('Cancelled: {}'.format(line))
+            if timeout is not None and time.time() - start > timeout:
+                raise RuntimeError('Timed out after {} s: {}'.format(timeout, line))
+            time.sleep(interval)
+            interval = min(2 * interval, 0.1)
+    except BaseException:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+    if profile is not None:
+        profile.update(_summarize_usage(usages, time.time() - start))
+    return procs[-1].returncode
+
+
+def _popen(args, affinity=None, **kwargs):
+    """Start a process that runs on the CPUs `affinity` from the beginning.
+
+    A child inherits the affinity of the thread that starts it, so the
+    calling thread is pinned while the process is started. Pinning the
+    child afterwards would miss threads it already started, e.g. those of
+    OpenMP, and `preexec_fn` is not safe while other threads are running.
+
+    """
+    if affinity is None or not hasattr(os, 'sched_setaffinity'):
+        return Popen(args, **kwargs)
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, affinity)
+    try:
+        return Popen(args, **kwargs)
+    finally:
+        os.sched_setaffinity(0, previous)
+
+
+def _poll(proc, usages):
+    """Like `Popen.poll`, but collect the resource usage of the process. """
+    if proc.returncode is not None or not hasattr(os, 'wait4'):
+        return proc.poll()
+    try:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+    except OSError:  # Already reaped.
+        return proc.poll()
+    if pid == 0:
+        return None
+    usages.append(usage)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode
+
+
+def _summarize_usage(usages, wall_time):
+    summary = {'wall_time': wall_time}
+    if usages:
+        # Linux reports the maximum resident set size in kilobytes.
+        rss_unit = 1 if sys.platform == 'darwin' else 1024
+        summary.update(user_time=sum(usage.ru_utime for usage in usages),
+                       system_time=sum(usage.ru_stime for usage in usages),
+                       max_rss=max(usage.ru_maxrss for usage in usages) * rss_unit,
+                       bytes_written=sum(usage.ru_oublock for usage in usages) * 512)
+    return summary
+
+
+def _start_reader(pipe, callback):
+    """Forward the lines of `pipe` to `callback` from a background thread. """
+    def read():
+        with pipe:
+            for raw in _iter_lines(pipe):
+                if callback:
+                    callback(raw.decode('utf-8', 'replace'))
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    return reader
+
+
+def _iter_lines(pipe, size=MAX_LINE):
+    """Yield the lines of a pipe without their newlines or carriage returns.
+
+    Lines longer than `size` bytes are split.
+
+    """
+    pending = b''
+    while True:
+        chunk = pipe.readline(size - len(pending))
+        if not chunk:
+            break
+        data = pending + chunk
+        # A carriage return may be the first half of a Windows line end.
+        tail = b'\r' if data.endswith(b'\r') else b''
+        if tail:
+            data = data[:-1]
+        lines = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n').split(b'\n')
+        pending = lines.pop()
+        if len(pending) + len(tail) >= size:
+            lines.append(pending)
+            pending = b''
+        for line in lines:
+            yield line
+        pending += tail
+    pending = pending.rstrip(b'\r')
+    if pending:
+        yield pending
+
+
 # TODO: tidy up this madness
 def rsync_to(flags, src, dst, user, host, logger=None):
-    cmd = 'rsync {flags} {src} {user}@{host}:{dst}'.format(**locals())
-    _rsync(cmd, logger)
+    cmd = 'rsync -e "{ssh}" {flags} {src} {user}@{host}:{dst}'.format(ssh=RSYNC_SSH,
+                                                                     **locals())
+    return _rsync(cmd, logger)
 
 
 def rsync_from(flags, src, dst, user, host, logger=None):
-    cmd = 'rsync {flags} {user}@{host}:{src} {dst}'.format(**locals())
-    _rsync(cmd, logger)
+    cmd = 'rsync -e "{ssh}" {flags} {user}@{host}:{src} {dst}'.format(ssh=RSYNC_SSH,
+                                                                     **locals())
+    return _rsync(cmd, logger)
 
 
 def _rsync(cmd, logger=None):
@@ -40,3 +248,48 @@ def _rsync(cmd, logger=None):
         logger.debug(cmd)
         for line in out.splitlines():
             logger.debug(line)
+    return out
+
+
+def parse_transfers(out):
+    """Parse rsync output produced with `--out-format="%l %n"`.
+
+    Returns
+    -------
+    transfers : list of (str, int)
+        The path relative to the transfer root and size in bytes of every
+        file that was transferred.
+
+    """
+    transfers = list()
+    for line in out.decode('utf-8').splitlines():
+        size, _, path = line.partition(' ')
+        if size.isdigit() and path and not path.endswith('/'):
+            transfers.append((path, int(size)))
+    return transfers
+
+
+def file_digest(path, blocksize=2**20):
+    """Return the SHA-256 hex digest of a file's contents.
+
+    Digests are remembered by path, size and modification time so that large,
+    unchanged input files are only read once per session.
+
+    Parameters
+    ----------
+    path : str
+    blocksize : int, optional, default=2**20
+        Number of bytes read at a time.
+
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_ino, stat.st_size,
+           getattr(stat, 'st_mtime_ns', stat.st_mtime))
+    if key not in _DIGESTS:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(blocksize), b''):
+                sha.update(block)
+        _DIGESTS[key] = sha.hexdigest()
+    return _DIGESTS[key]
@@ -0,0 +1,147 @@
+"""Asynchronous, rotating log files for simulations.
+
+Records are put on a queue by the logging thread and written to disk by a
+background `QueueListener`, so that logging every line of a command's output
+does not slow down the command. Log files are rotated when they reach
+`MAX_BYTES` and the old files are gzipped.
+
+"""
+import atexit
+import gzip
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import shutil
+import threading
+
+from six.moves import queue
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:  # Python 2
+    QueueHandler = QueueListener = None
+
+FORMAT = '[%(asctime)s] %(levelname)s - %(message)s'
+
+# Size at which log files are rotated and the number of old files kept.
+MAX_BYTES = 100 * 2**20
+BACKUP_COUNT = 5
+
+# Logger, queue and listener set up by `get_logger` for each (name, log file).
+_LOGGERS = dict()
+_LOGGERS_LOCK = threading.Lock()
+
+
+class GzipRotatingFileHandler(RotatingFileHandler):
+    """A `RotatingFileHandler` that compresses rotated files. """
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+        super(GzipRotatingFileHandler, self).__init__(filename, maxBytes=max_bytes,
+                                                      backupCount=backup_count,
+                                                      delay=True)
+        self.namer = lambda name: name + '.gz'
+        self.rotator = _gzip_rotator
+
+
+def get_logger(name, log_file, level=logging.INFO, max_bytes=MAX_BYTES,
+               backup_count=BACKUP_COUNT):
+    """Return a logger that writes to `log_file` from a background thread.
+
+    Calling this again with the same name and file returns the same logger
+    without adding handlers; the file is then shared until every caller has
+    called `close_logger`. Loggers of the same name that write to different
+    files are independent of each other. They are not registered with
+    `logging.getLogger`, but propagate to the root logger.
+
+    Parameters
+    ----------
+    name : str
+    log_file : str
+    level : int, optional, default=logging.INFO
+    max_bytes : int, optional, default=MAX_BYTES
+        Rotate the file when it reaches this size. 0 disables rotation.
+    backup_count : int, optional, default=BACKUP_COUNT
+        Number of gzipped old files to keep.
+
+    """
+    key = (name, os.path.abspath(log_file))
+    with _LOGGERS_LOCK:
+        entry = _LOGGERS.get(key)
+        if entry is not None:
+            entry['owners'] += 1
+            entry['logger'].setLevel(level)
+            return entry['logger']
+
+        logger = logging.Logger(name, level)
+        logger.parent = logging.getLogger()
+        file_handler = GzipRotatingFileHandler(key[1], max_bytes, backup_count)
+        file_handler.setFormatter(logging.Formatter(FORMAT))
+        entry = {'key': key, 'logger': logger, 'file_handler': file_handler,
+                 'owners': 1}
+        if QueueHandler is None:
+            handler = file_handler
+        else:
+            entry['queue'] = queue.Queue()
+            entry['listener'] = QueueListener(entry['queue'], file_handler)
+            entry['listener'].start()
+            handler = QueueHandler(entry['queue'])
+        entry['handler'] = handler
+        logger.addHandler(handler)
+        _LOGGERS[key] = entry
+    return logger
+
+
+def flush(logger):
+    """Wait until every record logged so far by a logger is written. """
+    entry = _find(logger)
+    if entry is not None:
+        if 'queue' in entry:
+            entry['queue'].join()
+        entry['file_handler'].flush()
+
+
+def close_logger(logger):
+    """Write the remaining records of a logger and close its file.
+
+    A file shared by several callers of `get_logger` stays open until the
+    last of them closes it. Closing a logger that is already closed does
+    nothing.
+
+    """
+    with _LOGGERS_LOCK:
+        entry = _find(logger)
+        if entry is None:
+            return
+        entry['owners'] -= 1
+        if entry['owners'] <= 0:
+            _close(entry['key'])
+
+
+def _find(logger):
+    """Return the entry of a logger from `get_logger`, if still open. """
+    for entry in list(_LOGGERS.values()):
+        if entry['logger'] is logger:
+            return entry
+    return None
+
+
+def _close(key):
+    entry = _LOGGERS.pop(key)
+    entry['logger'].removeHandler(entry['handler'])
+    if 'listener' in entry:
+        entry['listener'].stop()
+    entry['file_handler'].close()
+
+
+@atexit.register
+def close_all():
+    """Close every logger set up by `get_logger`. """
+    with _LOGGERS_LOCK:
+        for key in list(_LOGGERS):
+            _close(key)
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
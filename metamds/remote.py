@@ -0,0 +1,566 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+
+from six.moves import shlex_quote
+
+# `sacct` fields requested for SLURM jobs.
+SACCT_FIELDS = ('JobID', 'JobName', 'State', 'ExitCode', 'Elapsed', 'TotalCPU',
+                'MaxRSS', 'Start', 'End')
+
+# Batch system, scratch directory and walltime cap of the clusters we use,
+# keyed by a part of their hostname. `scratch` may use `{username}`.
+CLUSTERS = OrderedDict([
+    ('rahman', {'submit_line': 'qsub', 'scratch': '~', 'walltime': None}),
+    ('nersc', {'submit_line': 'sbatch', 'scratch': '$SCRATCH', 'walltime': '28:00:00'}),
+    ('accre', {'submit_line': 'sbatch', 'scratch': '/scratch/{username}', 'walltime': None}),
+])
+
+# Directory of the `RemoteInputStore` in each host's scratch directory, and
+# the default limit of its size.
+REMOTE_STORE = '.metamds_store'
+REMOTE_STORE_SIZE = 100 * 2**30
+# Seconds since their last use during which stored files are not evicted.
+STORE_MIN_AGE = 3600
+
+# Job states after which a job will not run again.
+FINISHED_STATES = {'C', 'F', 'X', 'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT',
+                   'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL',
+                   'DEADLINE'}
+
+# Seconds after submission during which a job that the batch system does not
+# list yet is taken to be queued rather than gone.
+LISTING_GRACE = 300
+
+
+class SSHPool(object):
+    """Shared SSH connections and SFTP sessions keyed by (hostname, username).
+
+    Connections are opened on first use and reused afterwards. A connection
+    that has been idle for longer than `idle_timeout` seconds is probed before
+    it is handed out and transparently re-opened if the server dropped it.
+
+    Parameters
+    ----------
+    idle_timeout : float, optional, default=300
+        Seconds of inactivity after which a connection is health-checked
+        before reuse.
+    keepalive : int, optional, default=60
+        Interval in seconds for SSH keepalive packets, which stop login nodes
+        from closing idle connections in the first place. 0 disables them.
+
+    """
+
+    def __init__(self, idle_timeout=300, keepalive=60):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self._clients = dict()
+        self._sftp = dict()
+        self._last_used = dict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def client(self, hostname, username):
+        """Return a connected `paramiko.SSHClient` for `username@hostname`. """
+        key = (hostname, username)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None and not self._is_healthy(key):
+                self.close(hostname, username)
+                client = None
+            if client is None:
+                client = self._connect(hostname, username)
+                self._clients[key] = client
+            self._last_used[key] = time.time()
+            return client
+
+    def sftp(self, hostname, username):
+        """Return an open `paramiko.SFTPClient` for `username@hostname`.
+
+        SFTP sessions are not thread-safe, so each thread gets its own channel
+        on the shared connection.
+
+        """
+        client = self.client(hostname, username)
+        key = (hostname, username, threading.current_thread().ident)
+        with self._lock:
+            sftp = self._sftp.get(key)
+            if sftp is None or sftp.get_channel().closed:
+                sftp = client.open_sftp()
+                self._sftp[key] = sftp
+            return sftp
+
+    def close(self, hostname=None, username=None):
+        """Close the connection to one host, or all connections. """
+        with self._lock:
+            for key in list(self._sftp):
+                if hostname is None or key[:2] == (hostname, username):
+                    try:
+                        self._sftp.pop(key).close()
+                    except Exception:
+                        pass
+            for key in list(self._clients):
+                if hostname is None or key == (hostname, username):
+                    self._clients.pop(key).close()
+                    self._last_used.pop(key, None)
+
+    def _connect(self, hostname, username):
+        # paramiko is slow to import and only needed for remote execution.
+        from paramiko import SSHClient, AutoAddPolicy
+        client = SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        client.connect(hostname=hostname, username=username)
+        # TODO: Is there really not a way to get this from SSHClient()?
+        client.hostname = hostname
+        client.username = username
+        if self.keepalive:
+            client.get_transport().set_keepalive(self.keepalive)
+        return client
+
+    def _is_healthy(self, key):
+        transport = self._clients[key].get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if time.time() - self._last_used.get(key, 0) > self.idle_timeout:
+            try:
+                transport.send_ignore()
+            except Exception:
+                return False
+        return True
+
+
+class HostBalancer(object):
+    """Spread batch jobs over several clusters.
+
+    Each job goes to the host with the shortest queue, as reported by
+    `queue_depth`, among the hosts where fewer than `max_jobs` of our jobs
+    are unfinished. When every host is at its cap, `acquire` waits until one
+    of our jobs finishes. Queues are probed at most every `poll_interval`
+    seconds; jobs submitted in between are added to the last probe. Probes
+    run without holding the lock, so that other threads can submit jobs
+    meanwhile.
+
+    Parameters
+    ----------
+    pool : SSHPool
+    hosts : list of str
+    username : str or dict, optional
+        The username on all hosts, or a username per host.
+    max_jobs : int or dict, optional
+        The maximum number of unfinished jobs on all hosts, or per host.
+        Unlimited by default.
+    poll_interval : float, optional, default=60
+    grace : float, optional, default=LISTING_GRACE
+        Seconds after submission during which a job that the batch system
+        does not list still counts as unfinished, see `job_ended`.
+
+    """
+
+    def __init__(self, pool, hosts, username=None, max_jobs=None, poll_interval=60,
+                 grace=LISTING_GRACE):
+        self.pool = pool
+        self.hosts = list(hosts)
+        if not self.hosts:
+            raise ValueError('No hosts given.')
+        self.usernames = _per_host(username, self.hosts)
+        self.max_jobs = _per_host(max_jobs, self.hosts)
+        self.poll_interval = poll_interval
+        self.grace = grace
+        # Submission time of our unfinished jobs, and the jobs listed so far.
+        self._jobs = dict((hostname, dict()) for hostname in self.hosts)
+        self._listed = dict((hostname, set()) for hostname in self.hosts)
+        # Slots handed out by `acquire` whose job is not submitted yet.
+        self._pending = dict((hostname, 0) for hostname in self.hosts)
+        # Queue depth at the last probe and slots handed out since.
+        self._depth = dict()
+        self._added = dict((hostname, 0) for hostname in self.hosts)
+        self._probed = dict()
+        self._refreshed = dict()
+        self._probing = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, cancel=None, hostname=None):
+        """Reserve a slot on the least busy host and return its name.
+
+        Call `submitted` with the job ID once the job is submitted, or
+        `release` if submission failed.
+
+        Parameters
+        ----------
+        cancel : threading.Event, optional
+            Stop waiting and raise RuntimeError when this event is set.
+        hostname : str, optional
+            Wait for a slot on this host instead, e.g. for a job that needs
+            the outputs of earlier jobs there.
+
+        """
+        hosts = self.hosts if hostname is None else [hostname]
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError('Cancelled while waiting for a free host.')
+            for host in hosts:
+                self._probe(host)
+            with self._lock:
+                free = [host for host in hosts
+                        if host in self._depth and self._has_room(host)]
+                if free:
+                    hostname = min(free, key=lambda host: (self._queue_depth(host),
+                                                           self._n_jobs(host)))
+                    self._pending[hostname] += 1
+                    self._added[hostname] += 1
+                    return hostname
+            time.sleep(min(self.poll_interval, 1))
+
+    def submitted(self, hostname, job_id):
+        """Record the job submitted into a slot from `acquire`. """
+        with self._lock:
+            self._pending[hostname] -= 1
+            self._jobs[hostname][job_id] = time.time()
+
+    def release(self, hostname):
+        """Give back a slot from `acquire` that was not used. """
+        with self._lock:
+            self._pending[hostname] -= 1
+            self._added[hostname] -= 1
+
+    def _has_room(self, hostname):
+        cap = self.max_jobs[hostname]
+        return cap is None or self._n_jobs(hostname) < cap
+
+    def _n_jobs(self, hostname):
+        return len(self._jobs[hostname]) + self._pending[hostname]
+
+    def _queue_depth(self, hostname):
+        return self._depth[hostname] + self._added[hostname]
+
+    def _probe(self, hostname):
+        """Probe the queue of a host and our unfinished jobs there, if due. """
+        with self._lock:
+            now = time.time()
+            probe_depth = now - self._probed.get(hostname, 0) > self.poll_interval
+            refresh = (not self._has_room(hostname) and
+                       now - self._refreshed.get(hostname, 0) > self.poll_interval)
+            if hostname in self._probing or not (probe_depth or refresh):
+                return
+            self._probing.add(hostname)
+            jobs = dict(self._jobs[hostname])
+            added = self._added[hostname]
+        try:
+            client = self._client(hostname)
+            submit_line = cluster_config(hostname)['submit_line']
+            if probe_depth:
+                depth = queue_depth(client, submit_line, self.usernames[hostname])
+                with self._lock:
+                    self._depth[hostname] = depth
+                    # Slots handed out during the probe may be missing from it.
+                    self._added[hostname] -= added
+                    self._probed[hostname] = time.time()
+            if refresh:
+                statuses = query_jobs(client, submit_line, jobs)
+                with self._lock:
+                    for job_id, submitted_at in jobs.items():
+                        status = statuses.get(job_id, dict())
+                        listed = self._listed[hostname]
+                        if job_ended(status, listed=job_id in listed,
+                                     submitted_at=submitted_at, grace=self.grace):
+                            del self._jobs[hostname][job_id]
+                            listed.discard(job_id)
+                        elif status:
+                            listed.add(job_id)
+                    self._refreshed[hostname] = time.time()
+        finally:
+            with self._lock:
+                self._probing.discard(hostname)
+
+    def _client(self, hostname):
+        return self.pool.client(hostname, self.usernames[hostname])
+
+
+class RemoteInputStore(object):
+    """Input files on a remote host, stored once under their SHA-256 digest.
+
+    Simulations hard link the files they need from the store into their
+    remote directory, so that files shared between simulations are uploaded
+    only once. Linking refreshes a file's modification time, and `evict`
+    removes the least recently used files once the store grows beyond
+    `max_bytes`. Since simulations hold their own hard links, evicting a
+    file never breaks a simulation that uses it.
+
+    Another simulation may still evict a file between `missing` and `link`;
+    `link` then reports it, so that it can be uploaded again. Files used in
+    the last `min_age` seconds are not evicted, which keeps such re-uploads
+    until they are linked.
+
+    Parameters
+    ----------
+    client : paramiko.SSHClient
+    sftp : paramiko.SFTPClient
+    root : str
+        The store directory, created if it does not exist.
+    max_bytes : int, optional
+        Size the store is kept below by `evict`. Unlimited by default.
+    min_age : float, optional, default=STORE_MIN_AGE
+
+    """
+
+    def __init__(self, client, sftp, root, max_bytes=None, min_age=STORE_MIN_AGE):
+        self.client = client
+        self.sftp = sftp
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self._exec('mkdir -p {}'.format(shlex_quote(root)))
+
+    def missing(self, digests):
+        """Return the digests of files that are not in the store yet.
+
+        Only complete files are named by their digest, see
+        `Simulation._link_stored_inputs`.
+
+        """
+        stored = set(self.sftp.listdir(self.root))
+        return set(digests) - stored
+
+    def link(self, files, dest_dir):
+        """Hard link stored files into a directory.
+
+        Parameters
+        ----------
+        files : dict
+            Digests of the files to link, keyed by their name in `dest_dir`.
+        dest_dir : str
+
+        Returns
+        -------
+        vanished : set of str
+            The digests of files that are no longer in the store.
+
+        """
+        commands = ['mkdir -p {}'.format(shlex_quote(dest_dir))]
+        for name, digest in sorted(files.items()):
+            src = shlex_quote(os.path.join(self.root, digest))
+            dst = shlex_quote(os.path.join(dest_dir, name))
+            # Copy instead if the two directories are on different filesystems.
+            # If neither works, copy again to report why, unless the file is gone.
+            commands.append('if ln -f {0} {1} 2>/dev/null || cp -f {0} {1} 2>/dev/null; '
+                            'then touch -c {0}; elif [ -e {0} ]; then cp -f {0} {1}; '
+                            'else echo {2}; fi'.format(src, dst, shlex_quote(digest)))
+        return set(self._exec(' && '.join(commands)).split())
+
+    def evict(self, keep=()):
+        """Remove the least recently used files until the store fits `max_bytes`.
+
+        Files used in the last `min_age` seconds are kept as well.
+
+        Returns
+        -------
+        evicted : list of str
+            The digests of the removed files.
+
+        """
+        if self.max_bytes is None:
+            return list()
+        entries = sorted(self.sftp.listdir_attr(self.root), key=lambda attr: attr.st_mtime)
+        total = sum(attr.st_size for attr in entries)
+        if total <= self.max_bytes:
+            return list()
+        # Modification times are compared with the clock of the remote host.
+        now = int(self._exec('date +%s'))
+        evicted = list()
+        for attr in entries:
+            if total <= self.max_bytes:
+                break
+            if attr.filename in keep or now - attr.st_mtime < self.min_age:
+                continue
+            self.sftp.remove(os.path.join(self.root, attr.filename))
+            total -= attr.st_size
+            evicted.append(attr.filename)
+        return evicted
+
+    def _exec(self, cmd):
+        _, stdout, stderr = self.client.exec_command(cmd)
+        errors = stderr.read().decode('utf-8').strip()
+        if errors:
+            raise IOError(errors)
+        return stdout.read().decode('utf-8')
+
+
+def cluster_config(hostname):
+    """Return the `CLUSTERS` entry of a host.
+
+    Unknown hosts get PBS defaults and their home directory as scratch.
+
+    """
+    for name, config in CLUSTERS.items():
+        if name in hostname:
+            return config
+    return {'submit_line': 'qsub', 'scratch': '~', 'walltime': None}
+
+
+def queue_depth(client, submit_line, username):
+    """Return the number of queued and running jobs of a user on a host. """
+    if submit_line == 'sbatch':
+        cmd = 'squeue -h -u {} -o %i'.format(username)
+    else:
+        cmd = 'qstat -u {}'.format(username)
+    _, stdout, stderr = client.exec_command(cmd)
+    out = stdout.read().decode('utf-8')
+    errors = stderr.read().decode('utf-8').strip()
+    if errors:
+        raise IOError(errors)
+    # `qstat -u` prints a few header lines before one line per job.
+    return sum(1 for line in out.splitlines() if line[:1].isdigit())
+
+
+def query_jobs(client, submit_line, job_ids):
+    """Fetch the status of many batch jobs with a single remote command.
+
+    Parameters
+    ----------
+    client : paramiko.SSHClient
+    submit_line : str
+        The command the jobs were submitted with, 'qsub' or 'sbatch'.
+    job_ids : iterable of str
+
+    Returns
+    -------
+    statuses : dict
+        Status fields of each job found, keyed by job ID. Jobs that the batch
+        system no longer knows about are left out.
+
+    """
+    job_ids = list(job_ids)
+    if not job_ids:
+        return dict()
+    if submit_line == 'sbatch':
+        cmd = 'sacct -P -n -j {} --format={}'.format(','.join(job_ids),
+                                                    ','.join(SACCT_FIELDS))
+    else:
+        cmd = 'qstat -f {}'.format(' '.join(job_ids))
+    _, stdout, stderr = client.exec_command(cmd)
+    out = stdout.read().decode('utf-8')
+    errors = [line for line in stderr.read().decode('utf-8').splitlines()
+              if line.strip() and 'Unknown Job Id' not in line]
+    if errors:
+        raise IOError('\n'.join(errors))
+    if submit_line == 'sbatch':
+        return parse_sacct(out)
+    return parse_qstat(out)
+
+
+def parse_qstat(text):
+    """Parse the output of `qstat -f` for any number of jobs.
+
+    Returns
+    -------
+    statuses : OrderedDict
+        Dictionaries of `qstat` attributes keyed by job ID, without the
+        server suffix.
+
+    """
+    statuses = OrderedDict()
+    status = None
+    key = None
+    for line in text.splitlines():
+        if line.startswith('Job Id:'):
+            job_id = line.split(':', 1)[1].strip().split('.')[0]
+            status = statuses[job_id] = OrderedDict()
+            key = None
+        elif status is None:
+            continue
+        elif line.startswith('\t') and key:
+            # Long values are wrapped onto tab-indented continuation lines.
+            status[key] += line.strip()
+        elif '=' in line:
+            key, value = line.split('=', 1)
+            key = key.strip()
+            status[key] = value.strip()
+    return statuses
+
+
+def parse_sacct(text):
+    """Parse the output of `sacct -P -n --format=<SACCT_FIELDS>`.
+
+    Job steps (e.g. "1234.batch") are folded into their job, keeping the
+    largest `MaxRSS` of any step. The fields of each step are also kept
+    under the 'steps' key of its job.
+
+    Returns
+    -------
+    statuses : OrderedDict
+        Dictionaries of `sacct` fields keyed by job ID.
+
+    """
+    statuses = OrderedDict()
+    for line in text.splitlines():
+        values = line.split('|')
+        if len(values) != len(SACCT_FIELDS):
+            continue
+        record = OrderedDict(zip(SACCT_FIELDS, values))
+        job_id, _, step = record['JobID'].partition('.')
+        status = statuses.setdefault(job_id, OrderedDict())
+        max_rss = max(status.get('MaxRSS', ''), record['MaxRSS'], key=parse_memory)
+        if not step:
+            status.update(record)
+        else:
+            status.setdefault('steps', OrderedDict())[step] = record
+        status['MaxRSS'] = max_rss
+    return statuses
+
+
+def job_finished(status):
+    """Return True if a job status from `query_jobs` describes a finished job. """
+    state = status.get('job_state') or status.get('State', '')
+    # sacct reports e.g. "CANCELLED by 1234".
+    return bool(state) and state.split()[0] in FINISHED_STATES
+
+
+def job_ended(status, listed=False, submitted_at=None, grace=LISTING_GRACE):
+    """Return True if a job has ended, given its status from `query_jobs`.
+
+    Batch systems may list a job only some time after its submission, and
+    drop finished jobs, e.g. Torque after `keep_completed`. So a job that is
+    not listed has ended if it was `listed` before, or if it was submitted
+    more than `grace` seconds ago or at an unknown time.
+
+    Parameters
+    ----------
+    status : dict
+        The job's status, empty if the job is not listed.
+    listed : bool, optional, default=False
+        Whether an earlier query listed the job.
+    submitted_at : float, optional
+        The time the job was submitted, as given by `time.time`.
+    grace : float, optional, default=LISTING_GRACE
+
+    """
+    if status:
+        return job_finished(status)
+    if listed or submitted_at is None:
+        return True
+    return time.time() - submitted_at > grace
+
+
+def parse_memory(value):
+    """Convert a memory string such as "1024K", "2.5G" or "512kb" to bytes. """
+    value = value.strip()
+    # PBS reports e.g. "123456kb".
+    if value[-1:] in ('b', 'B'):
+        value = value[:-1]
+    if not value:
+        return 0
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    if value[-1].upper() in units:
+        return float(value[:-1]) * units[value[-1].upper()]
+    return float(value)
+
+
+def _per_host(value, hosts):
+    """Expand a single value or a dict of values into a value per host. """
+    if isinstance(value, dict):
+        return dict((hostname, value.get(hostname)) for hostname in hosts)
+    return dict((hostname, value) for hostname in hosts)
@@ -0,0 +1,164 @@
+from collections import namedtuple
+import glob
+import os
+import threading
+
+# Cores and memory reserved for one task, see `LocalResources.acquire`.
+Allocation = namedtuple('Allocation', ['cores', 'memory'])
+
+
+class LocalResources(object):
+    """Pack locally executed tasks onto the cores and memory of this machine.
+
+    Each task reserves a number of cores and, optionally, an amount of
+    memory before it runs and gives them back when it finishes. Tasks that do
+    not fit wait until enough resources are free. Cores are taken from a
+    single NUMA node whenever one has room, so that a task's threads share
+    their memory controller and caches.
+
+    Parameters
+    ----------
+    cores : iterable of int, optional
+        IDs of the CPUs tasks may use. Defaults to all CPUs this process may
+        run on.
+    memory : int, optional
+        Bytes of memory tasks may use. Defaults to the physical memory.
+
+    Attributes
+    ----------
+    nodes : list of frozenset of int
+        The available CPUs of each NUMA node.
+
+    """
+
+    def __init__(self, cores=None, memory=None):
+        if cores is None:
+            cores = available_cores()
+        cores = set(cores)
+        if not cores:
+            raise ValueError('No cores available.')
+        self.nodes = [frozenset(cores & node) for node in numa_nodes()]
+        self.nodes = [node for node in self.nodes if node]
+        # CPUs the kernel did not list under any node form their own node.
+        missing = cores.difference(*self.nodes)
+        if missing:
+            self.nodes.append(frozenset(missing))
+        self.n_cores = len(cores)
+
+        if memory is None:
+            memory = physical_memory()
+        self.memory = memory
+
+        self._free = set(cores)
+        self._free_memory = memory
+        self._condition = threading.Condition()
+
+    @property
+    def free_cores(self):
+        return len(self._free)
+
+    @property
+    def free_memory(self):
+        return self._free_memory
+
+    def acquire(self, cores=None, memory=None, cancel=None):
+        """Reserve cores and memory, waiting until enough are free.
+
+        Parameters
+        ----------
+        cores : int, optional
+            Number of cores. Defaults to all of them, i.e. the task runs
+            alone.
+        memory : int, optional
+            Bytes of memory. Not tracked if None.
+        cancel : threading.Event, optional
+            Stop waiting and raise RuntimeError when this event is set.
+
+        Returns
+        -------
+        allocation : Allocation
+
+        """
+        if cores is None:
+            cores = self.n_cores
+        memory = memory or 0
+        if not 0 < cores <= self.n_cores:
+            raise ValueError('Cannot reserve {} cores, {} are available.'.format(
+                cores, self.n_cores))
+        if self.memory is not None and memory > self.memory:
+            raise ValueError('Cannot reserve {} bytes of memory, {} are '
+                             'available.'.format(memory, self.memory))
+
+        with self._condition:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise RuntimeError('Cancelled while waiting for resources.')
+                if (len(self._free) >= cores and
+                        (self.memory is None or memory <= self._free_memory)):
+                    break
+                self._condition.wait(0.5)
+            allocated = self._pick(cores)
+            self._free.difference_update(allocated)
+            if self.memory is not None:
+                self._free_memory -= memory
+            return Allocation(tuple(sorted(allocated)), memory)
+
+    def release(self, allocation):
+        """Return the resources of an `Allocation` from `acquire`. """
+        with self._condition:
+            self._free.update(allocation.cores)
+            if self.memory is not None:
+                self._free_memory += allocation.memory
+            self._condition.notify_all()
+
+    def _pick(self, n):
+        """Choose `n` free cores, keeping them on as few NUMA nodes as possible. """
+        free = [self._free & node for node in self.nodes]
+        # The fullest node that fits, so that emptier nodes stay whole.
+        fitting = [cores for cores in free if len(cores) >= n]
+        if fitting:
+            return set(sorted(min(fitting, key=len))[:n])
+        picked = set()
+        for cores in sorted(free, key=len, reverse=True):
+            picked.update(sorted(cores)[:n - len(picked)])
+            if len(picked) == n:
+                break
+        return picked
+
+
+def available_cores():
+    """Return the IDs of the CPUs this process may run on. """
+    if hasattr(os, 'sched_getaffinity'):
+        return set(os.sched_getaffinity(0))
+    import multiprocessing
+    return set(range(multiprocessing.cpu_count()))
+
+
+def numa_nodes():
+    """Return the CPUs of each NUMA node, or a single node on other systems. """
+    nodes = list()
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')):
+        with open(path) as fh:
+            nodes.append(frozenset(parse_cpulist(fh.read())))
+    if not nodes:
+        nodes.append(frozenset(available_cores()))
+    return nodes
+
+
+def parse_cpulist(text):
+    """Parse a Linux CPU list such as "0-3,8-11". """
+    cores = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cores.update(range(int(first), int(last or first) + 1))
+    return cores
+
+
+def physical_memory():
+    """Return the physical memory in bytes, or None if it is unknown. """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
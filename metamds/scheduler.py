@@ -0,0 +1,182 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import time
+
+from six import raise_from, string_types
+
+
+class TaskGraph(object):
+    """A dependency graph of tasks, keyed by task name.
+
+    Tasks are stored in insertion order. Each task may depend on any number
+    of tasks that were added before it, which guarantees that the graph is
+    acyclic.
+
+    """
+
+    def __init__(self):
+        self._tasks = OrderedDict()
+        self._dependencies = OrderedDict()
+        self._dependents = OrderedDict()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __iter__(self):
+        return iter(self._tasks)
+
+    def __contains__(self, name):
+        return name in self._tasks
+
+    def __getitem__(self, name):
+        return self._tasks[name]
+
+    def keys(self):
+        return self._tasks.keys()
+
+    def values(self):
+        return self._tasks.values()
+
+    def items(self):
+        return self._tasks.items()
+
+    def add(self, task, depends_on=None):
+        """Add a task to the graph.
+
+        Parameters
+        ----------
+        task : metamds.Task
+        depends_on : Task, str or iterable of Task or str, optional
+            Tasks (or task names) that must finish before `task` is run.
+
+        """
+        names = _task_names(depends_on)
+        for name in names:
+            if name == task.name:
+                raise ValueError('Task "{}" cannot depend on itself.'.format(name))
+            if name not in self._tasks:
+                raise ValueError('Task "{}" depends on unknown task "{}". '
+                                 'Dependencies must be added to the simulation '
+                                 'first.'.format(task.name, name))
+        if task.name in self._tasks:
+            # Re-adding a task keeps the dependencies it already had.
+            self._dependencies[task.name].update(names)
+        else:
+            self._dependencies[task.name] = set(names)
+            self._dependents[task.name] = set()
+        self._tasks[task.name] = task
+        for name in names:
+            self._dependents[name].add(task.name)
+
+    def dependencies(self, name):
+        """Return the names of the tasks that `name` depends on. """
+        return set(self._dependencies[name])
+
+    def dependents(self, name):
+        """Return the names of the tasks that depend directly on `name`. """
+        return set(self._dependents[name])
+
+
+def run_graph(graph, func, max_workers=1, logger=None):
+    """Run `func` on every task in `graph`, respecting dependencies.
+
+    Independent tasks are run concurrently in a thread pool. Tasks spend
+    nearly all of their time waiting on subprocesses or remote hosts, so
+    threads give full concurrency without having to pickle tasks.
+
+    Parameters
+    ----------
+    graph : TaskGraph
+    func : callable
+        Called as ``func(task)`` for every task.
+    max_workers : int, optional, default=1
+        The maximum number of tasks running at the same time.
+    logger : logging.Logger, optional
+        Receives start, finish and failure messages for each task.
+
+    Returns
+    -------
+    wall_times : OrderedDict
+        Wall-clock time in seconds of every task that was run, keyed by task
+        name, in the order the tasks finished.
+
+    """
+    if max_workers < 1:
+        raise ValueError('`max_workers` must be at least 1.')
+
+    waiting = OrderedDict((name, graph.dependencies(name)) for name in graph)
+    # Tasks that become ready together are started in insertion order.
+    order = dict((name, index) for index, name in enumerate(graph))
+    wall_times = OrderedDict()
+    failed = OrderedDict()
+    skipped = list()
+
+    def timed(task):
+        start = time.time()
+        func(task)
+        return time.time() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = dict()
+
+        def submit(names):
+            for name in names:
+                del waiting[name]
+                if logger:
+                    logger.info('Starting task: {}'.format(name))
+                running[pool.submit(timed, graph[name])] = name
+
+        submit([name for name, deps in waiting.items() if not deps])
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    failed[name] = error
+                    if logger:
+                        logger.error('Task {} failed: {}'.format(name, error))
+                    skipped.extend(_drop_dependents(graph, waiting, name))
+                    continue
+                wall_times[name] = future.result()
+                graph[name].wall_time = wall_times[name]
+                if logger:
+                    logger.info('Finished task: {} ({:.2f} s)'.format(
+                        name, wall_times[name]))
+                ready = list()
+                for dependent in graph.dependents(name):
+                    if dependent in waiting:
+                        waiting[dependent].discard(name)
+                        if not waiting[dependent]:
+                            ready.append(dependent)
+                submit(sorted(ready, key=order.get))
+
+    if failed:
+        msg = 'Failed tasks: {}'.format(', '.join(failed))
+        if skipped:
+            msg += '. Not run because a dependency failed: {}'.format(
+                ', '.join(skipped))
+        raise_from(RuntimeError(msg), next(iter(failed.values())))
+    return wall_times
+
+
+def _drop_dependents(graph, waiting, name):
+    """Remove everything downstream of `name` from `waiting`. """
+    dropped = list()
+    stack = list(graph.dependents(name))
+    while stack:
+        dependent = stack.pop()
+        if dependent in waiting:
+            del waiting[dependent]
+            dropped.append(dependent)
+            stack.extend(graph.dependents(dependent))
+    return dropped
+
+
+def _task_names(tasks):
+    if tasks is None:
+        return list()
+    if isinstance(tasks, string_types) or hasattr(tasks, 'name'):
+        tasks = [tasks]
+    return [task if isinstance(task, string_types) else task.name
+            for task in tasks]
@@ -1,14 +1,29 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
+import itertools
 import logging
 import os
+import shutil
 import tempfile
+import threading
+import time
 
-from six import string_types
+from six import raise_from, string_types
 
 from metamds import Task
-from metamds.io import rsync_to
-from metamds.db import add_doc_db
+from metamds.task import (ARRAY_OPTIONS, ARRAY_SCRIPT, LAYOUTS, batch_header,
+                          create_task_dir, parse_job_id, sync_tasks)
+from metamds.dedup import OBJECTS_DIR, ObjectStore, deduplicate
+from metamds.io import file_digest, rsync_to
+from metamds.log import close_logger, flush, get_logger
+from metamds.db import add_docs_db, create_indexes, get_client, get_uri
+from metamds.remote import (LISTING_GRACE, REMOTE_STORE, REMOTE_STORE_SIZE,
+                            HostBalancer, RemoteInputStore, SSHPool, cluster_config,
+                            job_ended, query_jobs)
+from metamds.resources import LocalResources
+from metamds.walltime import format_walltime, parse_walltime
+from metamds.scheduler import TaskGraph, run_graph
 
 
 class Simulation(object):
@@ -19,21 +34,49 @@ class Simulation(object):
     name :
     tasks :
     template :
+    format_template : bool
+        Fill in the parameters of string templates with `str.format`, e.g.
+        'gmx grompp -f {mdp}'. Literal braces must then be doubled, as in
+        "awk '{{print $2}}'". Off by default, so that commands are used as
+        they are.
     output_dir :
     input_dir :
-    remote_dir :
-    info :
-    debug :
+    layout : str
+        How task directories link to the input files: 'symlink' (one symlink
+        per file), 'hardlink' (one hard link per file) or 'shared' (a single
+        'inputs' symlink per task). See `metamds.task.create_task_dir`.
+    remote_dirs : OrderedDict
+        The directory holding the inputs and `output_dir` on each remote
+        host, keyed by hostname.
+    remote_dir : str
+        The remote directory on the first host used.
+    remote_store : bool
+        Upload input files to a `metamds.remote.RemoteInputStore` under the
+        scratch directory of each host, shared by all simulations, and link
+        them from there instead of uploading them every time.
+        Off by default.
+    remote_store_size : int
+        Bytes the remote input stores are kept below.
+    walltime_predictor : metamds.walltime.WalltimePredictor
+        If set, the runtimes of finished remote tasks are recorded and used
+        to request walltimes for new tasks, see `predict_walltime`.
+    info : logging.Logger
+        Progress of the tasks, written to `<name>_info.log` in `output_dir`
+        by a background thread, see `metamds.log.get_logger`.
+    debug : logging.Logger
+        Output of every command, written to `<name>_debug.log`.
 
     """
 
-    def __init__(self, name=None, template='', output_dir='', input_dir=''):
+    def __init__(self, name=None, template='', output_dir='', input_dir='',
+                 layout='symlink'):
 
         if name is None:
             name = 'project'
         self.name = name
-        self._tasks = OrderedDict()
+        self._tasks = TaskGraph()
         self.template = template
+        self.format_template = False
 
         if not input_dir:
             self.input_dir = os.getcwd()
@@ -48,73 +91,207 @@ class Simulation(object):
                 os.mkdir(output_dir)
         self.output_dir = os.path.abspath(output_dir)
 
-        self.input_files = [f for f in glob('{}/*'.format(self.input_dir))
-                            if not f.endswith(('.py', '.ipynb')) and
-                            f != self.output_dir]
-
-        self.remote_dir = None
-
-        self.info = logging.getLogger('{}_info'.format(self.name))
-        self.info.setLevel(logging.INFO)
-        log_file = os.path.join(self.output_dir, '{}_info.log'.format(self.name))
-        handler = logging.FileHandler(log_file)
-        formatter = logging.Formatter('[%(asctime)s] %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        self.info.addHandler(handler)
-
-        self.debug = logging.getLogger('{}_debug'.format(self.name))
-        self.debug.setLevel(logging.DEBUG)
-        log_file = os.path.join(self.output_dir, '{}_debug.log'.format(self.name))
-        handler = logging.FileHandler(log_file)
-        formatter = logging.Formatter('[%(asctime)s] %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        self.debug.addHandler(handler)
-
-    def create_remote_dir(self, client, hostname, username):
+        self.input_files = self._scan_input_files()
+        if layout not in LAYOUTS:
+            raise ValueError('Unknown layout "{}", use one of {}.'.format(
+                layout, ', '.join(LAYOUTS)))
+        self.layout = layout
+
+        self.remote_dirs = OrderedDict()
+        self.ssh_pool = SSHPool()
+        self.db_client = None
+        self._remote_lock = threading.Lock()
+        self._statuses = None
+        self._statuses_time = 0
+        self.walltime_predictor = None
+        self.remote_store = False
+        self.remote_store_size = REMOTE_STORE_SIZE
+
+        self.info = get_logger('{}_info'.format(self.name),
+                               os.path.join(self.output_dir, '{}_info.log'.format(self.name)),
+                               level=logging.INFO)
+        self.debug = get_logger('{}_debug'.format(self.name),
+                                os.path.join(self.output_dir, '{}_debug.log'.format(self.name)),
+                                level=logging.DEBUG)
+
+    @property
+    def remote_dir(self):
+        return next(iter(self.remote_dirs.values()), None)
+
+    def create_remote_dir(self, client, hostname, username, exist_ok=False):
         """Create a copy of all input files and `output_dir` on a remote host.
 
         Parameters
         ----------
-        client : paramiko.SSHClient
+        client : paramiko.SSHClient or None
+            An open connection to `hostname`. If None, a connection is taken
+            from `ssh_pool`.
+        hostname : str
+        username : str
+        exist_ok : bool, optional, default=False
+            Do nothing if the remote directory on `hostname` was already
+            created.
 
         """
-        if not self.remote_dir:
-            #---------------------------------------------------------------- TJ
-            # For different resources it is necessary to move to preferred production directories
-            # TODO: Add as variable somewhere rather than hardcoding
-            if "nersc" in hostname:
-                _, stdout, stderr = client.exec_command('cd $SCRATCH; mktemp -d; pwd')
-            elif "accre" in hostname:
-                _, stdout, stderr = client.exec_command('cd /scratch/{}; mktemp -d; pwd'.format(username))
-            if "rahman" in hostname:
-                _, stdout, stderr = client.exec_command('mktemp -d; pwd')
-            #---------------------------------------------------------------- TJ 
-            if stderr.readlines():
-                raise IOError(stderr.read().decode('utf-8'))
-            remote_dir, home = (line.rstrip() for line in stdout.readlines())
+        with self._remote_lock:
+            if exist_ok and hostname in self.remote_dirs:
+                return
+            if client is None:
+                client = self.ssh_pool.client(hostname, username)
+            self._create_remote_dir(client, hostname, username)
+
+    def _create_remote_dir(self, client, hostname, username):
+        remote_dir = self.remote_dirs.get(hostname)
+        if not remote_dir:
+            # Work in each cluster's preferred production directory.
+            scratch = cluster_config(hostname)['scratch'].format(username=username)
+            _, stdout, stderr = client.exec_command('cd {}; mktemp -d; pwd'.format(scratch))
+            errors = stderr.read().decode('utf-8')
+            if errors:
+                raise IOError(errors)
+            tmp_dir, scratch_dir = (line.rstrip() for line in stdout.readlines())
             # TODO: tidy up temp dir creation and copying
-            self.remote_dir = os.path.join(home, remote_dir[5:])
+            remote_dir = os.path.join(scratch_dir, os.path.basename(tmp_dir))
 
-            cmd = 'rsync -r {tmp_dir} ~'.format(tmp_dir=remote_dir)
+            cmd = 'rsync -r {} {}'.format(tmp_dir, scratch_dir)
             _, stdout, stderr = client.exec_command(cmd)
-            if stderr.readlines():
-                raise IOError(stderr.read().decode('utf-8'))
+            errors = stderr.read().decode('utf-8')
+            if errors:
+                raise IOError(errors)
+            self.remote_dirs[hostname] = remote_dir
 
         # Move input files
-        rsync_to(flags='-r -h --progress --partial',
-                 src=' '.join(self.input_files),
-                 dst=self.remote_dir,
-                 user=client.username,
-                 host=client.hostname,
-                 logger=self.debug)
+        input_files = self.input_files
+        if self.remote_store:
+            input_files = self._link_stored_inputs(client, remote_dir)
+        if input_files:
+            rsync_to(flags='-r -h --progress --partial',
+                     src=' '.join(input_files),
+                     dst=remote_dir,
+                     user=client.username,
+                     host=client.hostname,
+                     logger=self.debug)
+        # Task directories are created lazily, but all of them are needed remotely.
+        for task in self.tasks():
+            task.create_dir()
         # Move output directory including relative symlinks to input files
-        rsync_to(flags='-r -h --links --progress --partial',
+        # but not the local object store.
+        flags = '-r -h --links --progress --partial --exclude=/*/{}'.format(OBJECTS_DIR)
+        rsync_to(flags=flags,
                  src=self.output_dir,
-                 dst=self.remote_dir,
+                 dst=remote_dir,
                  user=client.username,
                  host=client.hostname,
                  logger=self.debug)
 
+    def _link_stored_inputs(self, client, remote_dir):
+        """Provide the input files from the remote host's `RemoteInputStore`.
+
+        Files missing from the store are uploaded in a single `rsync` call.
+
+        Returns
+        -------
+        directories : list of str
+            Input directories, which are not stored and must be copied.
+
+        """
+        files = OrderedDict((os.path.basename(path), file_digest(path))
+                            for path in self.input_files if os.path.isfile(path))
+        sftp = self.ssh_pool.sftp(client.hostname, client.username)
+        root = os.path.join(os.path.dirname(remote_dir), REMOTE_STORE)
+        store = RemoteInputStore(client, sftp, root, max_bytes=self.remote_store_size)
+
+        missing = store.missing(files.values())
+        self._upload_to_store(client, root, missing)
+        self.info.info('Uploaded {:d} of {:d} input files to the store on {}'.format(
+            len(missing), len(files), client.hostname))
+
+        vanished = store.link(files, remote_dir)
+        if vanished:
+            # Evicted by another simulation since `missing`. Fresh uploads are
+            # not evicted before they are linked.
+            self.info.info('Uploading {:d} input files again that were evicted '
+                           'from the store on {}'.format(len(vanished), client.hostname))
+            self._upload_to_store(client, root, vanished)
+            vanished = store.link(OrderedDict((name, digest) for name, digest in files.items()
+                                              if digest in vanished), remote_dir)
+            if vanished:
+                raise IOError('Input files vanished from the store on {}: {}'.format(
+                    client.hostname, ', '.join(sorted(vanished))))
+        evicted = store.evict(keep=set(files.values()))
+        if evicted:
+            self.info.info('Evicted {:d} files from the store on {}'.format(
+                len(evicted), client.hostname))
+        return [path for path in self.input_files if not os.path.isfile(path)]
+
+    def _upload_to_store(self, client, root, digests):
+        """Upload the input files with the given digests to a store in one `rsync`. """
+        if not digests:
+            return
+        # Name the files by digest through a directory of symlinks.
+        staging = tempfile.mkdtemp(prefix='metamds_store_')
+        try:
+            for path in self.input_files:
+                if os.path.isfile(path):
+                    digest = file_digest(path)
+                    link = os.path.join(staging, digest)
+                    if digest in digests and not os.path.lexists(link):
+                        os.symlink(os.path.abspath(path), link)
+            # Without --partial, rsync writes each file under a temporary
+            # name and only renames it once complete, so an interrupted
+            # upload never leaves a truncated file under a digest.
+            rsync_to(flags='-r -h -L',
+                     src=os.path.join(staging, ''),
+                     dst=root,
+                     user=client.username,
+                     host=client.hostname,
+                     logger=self.debug)
+        finally:
+            shutil.rmtree(staging)
+
+    def connect_db(self, host="127.0.0.1", port=27017, user=None, password=None,
+                   **options):
+        """Use a shared database client for all database calls of this simulation.
+
+        Parameters
+        ----------
+        host : str, optional
+            database connection host (the default is 127.0.0.1, or the local computer being used)
+        port : int, optional
+            database host port (default is 27017, which is the pymongo default port).
+        user : str, optional
+            user name (default is None, meaning the database is public).
+        password : str, optional
+            user password (default is None, meaning there is no password access to database).
+        **options
+            pooling and other options passed to `metamds.db.get_client`.
+
+        Returns
+        -------
+        client : pymongo.MongoClient
+        """
+        self.db_client = get_client(host, port, user, password, **options)
+        return self.db_client
+
+    def close(self):
+        """Close all connections held by this simulation.
+
+        The database client is shared with other simulations and is closed
+        with `metamds.db.close_clients` instead. The log files are flushed
+        and closed, unless another open simulation of the same name and
+        `output_dir` shares them.
+
+        """
+        self.ssh_pool.close()
+        self.db_client = None
+        close_logger(self.info)
+        close_logger(self.debug)
+
+    def flush_logs(self):
+        """Wait until everything logged so far is written to the log files. """
+        flush(self.info)
+        flush(self.debug)
+
     def tasks(self):
         """Yield all tasks in this simulation. """
         for v in self._tasks.values():
@@ -127,62 +304,663 @@ class Simulation(object):
 
     def task_names(self):
         """Return the names of all tasks in this simulation. """
-        for task in self._tasks:
-            yield task.name
+        for name in self._tasks:
+            yield name
 
-    def add_task(self, task):
-        """Add a task to this simulation. """
+    def add_task(self, task, depends_on=None):
+        """Add a task to this simulation.
+
+        Parameters
+        ----------
+        task : metamds.Task
+        depends_on : Task, str or iterable of Task or str, optional
+            Tasks (or task names) already in this simulation that must finish
+            before `task` is run.
+
+        """
         if not task.name:
             task.name = 'task_{:d}'.format(self.n_tasks + 1)
-        self._tasks[task.name] = task
+        self._tasks.add(task, depends_on=depends_on)
+
+    def execute_all(self, hostname=None, username=None, max_workers=1,
+                    use_cache=True, array=False, resources=None, max_jobs=None,
+                    poll_interval=60):
+        """Execute all tasks in this simulation.
+
+        Tasks are started as soon as all of the tasks they depend on have
+        finished, with at most `max_workers` tasks running at the same time.
+
+        Parameters
+        ----------
+        hostname : str or list of str, optional
+            Execute the tasks on this remote host. Given several hosts, each
+            task without dependencies is submitted to the one with the
+            shortest queue, see `metamds.remote.HostBalancer`. Other tasks
+            run on the host of the tasks they depend on.
+        username : str or dict, optional
+            Use this username to access `hostname` when executing remotely,
+            or a dict with the username on each host.
+        max_workers : int, optional, default=1
+            The maximum number of tasks to run concurrently.
+        use_cache : bool, optional, default=True
+            Skip local tasks whose script, parameters and input files are
+            unchanged since they last completed, unless one of the tasks they
+            depend on is re-run. See `Task.cache_key`.
+        array : bool, optional, default=False
+            When executing remotely, submit all tasks created by `parametrize`
+            that have no dependencies as a single job array. See
+            `submit_array`.
+        resources : metamds.resources.LocalResources or bool, optional
+            When executing locally, pack the tasks onto the cores and memory
+            of this machine according to each task's `cores` and `memory`,
+            queueing those that do not fit. True uses all of the machine.
+            Combine with a `max_workers` large enough to fill it.
+        max_jobs : int or dict, optional
+            When executing remotely, the maximum number of unfinished jobs
+            of this simulation on each host, or a dict with a cap per host.
+            Further submissions wait until jobs finish.
+        poll_interval : float, optional, default=60
+            Seconds between queue probes when balancing between hosts or
+            waiting for `max_jobs`.
+
+        Returns
+        -------
+        wall_times : OrderedDict
+            Wall-clock time in seconds of each task, keyed by task name.
+
+        """
+        balancer = None
+        if hostname and (max_jobs is not None or not isinstance(hostname, string_types)):
+            hosts = [hostname] if isinstance(hostname, string_types) else hostname
+            balancer = HostBalancer(self.ssh_pool, hosts, username=username,
+                                    max_jobs=max_jobs, poll_interval=poll_interval)
+
+        def submit(submit_func, cancel=None, pinned=None):
+            """Call `submit_func(hostname, username)` on the chosen host. """
+            if balancer is None:
+                return submit_func(hostname, username)
+            host = balancer.acquire(cancel=cancel, hostname=pinned)
+            try:
+                job_id = submit_func(host, balancer.usernames[host])
+            except BaseException:
+                balancer.release(host)
+                raise
+            balancer.submitted(host, job_id)
+            self.info.info('Submitted {} to {}'.format(job_id, host))
+
+        arrayed = set()
+        if array and hostname:
+            tasks = [task for task in self.tasks()
+                     if task.parameters is not None and
+                     not self._tasks.dependencies(task.name) and
+                     not self._tasks.dependents(task.name)]
+            if tasks:
+                submit(lambda host, user: self.submit_array(tasks, host, user))
+                arrayed.update(task.name for task in tasks)
+
+        if resources is True:
+            resources = LocalResources()
+        elif not resources:
+            resources = None
+
+        rerun = set()
+
+        def execute(task):
+            if task.name in arrayed:
+                return
+            upstream = self._tasks.dependencies(task.name)
+            if (use_cache and not hostname and not upstream & rerun and
+                    task.is_cached()):
+                self.info.info('Skipping unchanged task: {}'.format(task.name))
+                return
+            if hostname:
+                # Upstream jobs were only submitted, so the batch system has
+                # to hold this job until they succeeded.
+                after = [self._tasks[name].pbs_id for name in sorted(upstream)
+                         if self._tasks[name].pbs_id]
+                # Dependents need the outputs of their upstream tasks.
+                hosts = set(self._tasks[name].hostname for name in upstream)
+                if len(hosts) > 1:
+                    raise RuntimeError('Task {} depends on tasks that ran on different '
+                                       'hosts: {}'.format(task.name, ', '.join(sorted(hosts))))
+
+                def execute_remote(host, user):
+                    task.execute(hostname=host, username=user, after=after)
+                    return task.pbs_id
+                submit(execute_remote, cancel=task._cancel,
+                       pinned=next(iter(hosts), None))
+            else:
+                task.execute(resources=resources)
+            rerun.add(task.name)
+
+        return run_graph(self._tasks, execute, max_workers=max_workers,
+                         logger=self.info)
+
+    def predict_walltime(self, task, hostname, default='96:00:00'):
+        """Return the walltime to request for a task on a remote host.
+
+        The prediction of `walltime_predictor`, if set and if there are
+        earlier runs to base it on, or `default`.
+
+        """
+        if self.walltime_predictor is not None:
+            seconds = self.walltime_predictor.predict(task, hostname)
+            if seconds is not None:
+                walltime = format_walltime(seconds)
+                self.info.info('Requesting walltime {} for {}'.format(walltime, task.name))
+                return walltime
+        return default
+
+    def submit_array(self, tasks, hostname, username, walltime=None):
+        """Submit several tasks to a remote host as a single job array.
+
+        Each task's script is written to its directory, a file listing the
+        task directories is uploaded and one `qsub`/`sbatch` submission runs
+        array element `i` in the directory of `tasks[i]`. The sub-job ID of
+        each element is stored in `Task.pbs_id` so that `Task.status` works
+        as for individually submitted tasks.
+
+        Parameters
+        ----------
+        tasks : list of metamds.Task
+        hostname : str
+        username : str
+        walltime : str, optional
+            The walltime of each array element. By default the longest of
+            the tasks' `walltime` or `predict_walltime`.
+
+        Returns
+        -------
+        array_id : str
+            The job ID of the whole array.
+
+        """
+        tasks = list(tasks)
+        if walltime is None:
+            walltime = max((task.walltime or self.predict_walltime(task, hostname)
+                            for task in tasks), key=parse_walltime)
+        header, submit_line, walltime = batch_header(hostname, walltime)
+        options = ARRAY_OPTIONS[submit_line]
+
+        for task in tasks:
+            task.write_script()
+        client = self.ssh_pool.client(hostname, username)
+        # Always sync so that the freshly written scripts reach the host.
+        self.create_remote_dir(client, hostname, username)
+
+        remote_dir = self.remote_dirs[hostname]
+        output = os.path.basename(self.output_dir)
+        task_list = os.path.join(remote_dir, '{}_array.tasks'.format(self.name))
+        array_filename = os.path.join(remote_dir, '{}_array.pbs'.format(self.name))
+        task_dir = '$(sed -n "$(({} + 1))p" {})'.format(options['index'], task_list)
+        header = header.format(walltime=walltime, name=self.name,
+                               directives=options['directive'].format(last=len(tasks) - 1),
+                               task_dir=task_dir, output=output,
+                               tmp_dir=remote_dir)
+
+        sftp = self.ssh_pool.sftp(hostname, username)
+        with sftp.open(task_list, 'w') as fh:
+            fh.write(''.join('{}\n'.format(task.name) for task in tasks))
+        with sftp.open(array_filename, 'w') as fh:
+            fh.write(''.join((header, '. ./{}\n'.format(ARRAY_SCRIPT))))
+
+        _, stdout, stderr = client.exec_command('{} {}'.format(submit_line, array_filename))
+        array_id = parse_job_id(stdout.readlines()[0])
+        submitted_at = time.time()
+        self._statuses = None
+        self.info.info('Submitted {:d} tasks as job array {}'.format(len(tasks), array_id))
+
+        for index, task in enumerate(tasks):
+            task.hostname = hostname
+            task.username = username
+            task.remote_dir = remote_dir
+            task.client = client
+            task.pbs_server = True
+            task.submit_line = submit_line
+            task.array_id = array_id
+            task.array_index = index
+            task.pbs_id = options['job_id'].format(array_id=array_id, index=index)
+            task.submitted_at = submitted_at
+        return array_id
+
+    def invalidate_cache(self):
+        """Force every task to re-run on the next `execute_all`. """
+        for task in self.tasks():
+            task.invalidate_cache()
+
+    def get_output_files(self, file_type):
+        """Get all files of a specific type produced by the tasks in this simulation.
+
+        Answered from the cached manifest of each task, see `Task.manifest`,
+        so repeated calls do not touch the filesystem.
+
+        Parameters
+        ----------
+        file_type : str
+            An extension or a keyword for a category of file types present in
+            `metamds.task.EXTENSIONS`.
+
+        Returns
+        -------
+        files : OrderedDict
+            Lists of file paths keyed by task name.
+
+        """
+        return OrderedDict((task.name, task.get_output_files(file_type))
+                           for task in self.tasks())
+
+    def iter_trajectories(self, file_type='trajectories', chunk_size=100):
+        """Stream the trajectories of all tasks in chunks of frames.
+
+        Only `chunk_size` frames are held in memory at a time.
+
+        Parameters
+        ----------
+        file_type : str, optional, default='trajectories'
+            An extension, e.g. '.dcd', or 'trajectories' for all trajectory
+            formats in `metamds.task.EXTENSIONS`.
+        chunk_size : int, optional, default=100
+
+        Yields
+        ------
+        task : metamds.Task
+        chunk : np.ndarray, shape=(n_frames, n_atoms, 3)
+
+        """
+        from metamds.trajectory import open_trajectory
 
-    def execute_all(self, hostname=None, username=None):
-        """Execute all tasks in this simulation. """
         for task in self.tasks():
-            task.execute(hostname=hostname, username=username)
+            for path in task.get_output_files(file_type):
+                for chunk in open_trajectory(path).iter_chunks(chunk_size):
+                    yield task, chunk
+
+    def status_all(self, ttl=60):
+        """Query the job status of every remotely executed task.
+
+        One `qstat -f` or `sacct` call is made per host for all of its jobs,
+        and `Task.latest_status` is filled in for every task, as well as
+        `Task.analysis_status` for tasks with a separate analysis job.
+
+        Parameters
+        ----------
+        ttl : float, optional, default=60
+            Return the previous result if it is younger than this many
+            seconds and no job was submitted since. Use 0 to always query
+            the batch systems.
+
+        Returns
+        -------
+        statuses : OrderedDict
+            The status of each task, keyed by task name.
+
+        """
+        if self._statuses is not None and time.time() - self._statuses_time < ttl:
+            return self._statuses
+
+        hosts = dict()
+        for task in self.tasks():
+            if task.pbs_server and task.pbs_id:
+                key = (task.hostname, task.username, task.submit_line)
+                hosts.setdefault(key, list()).append(task)
+
+        statuses = OrderedDict()
+        for (hostname, username, submit_line), tasks in hosts.items():
+            client = self.ssh_pool.client(hostname, username)
+            job_ids = [job_id for task in tasks
+                       for job_id in (task.pbs_id, task.analysis_id) if job_id]
+            jobs = query_jobs(client, submit_line, job_ids)
+            for task in tasks:
+                task._set_status(jobs.get(task.pbs_id, dict()))
+                if task.analysis_id:
+                    task.analysis_status = jobs.get(task.analysis_id, dict())
+        for task in self.tasks():
+            statuses[task.name] = task.latest_status
+
+        self._statuses = statuses
+        self._statuses_time = time.time()
+        return statuses
+
+    def wait_all(self, poll_interval=30, max_interval=600, backoff=2, n_sync_workers=4,
+                 callback=None, file_types=None, dedup=False, timeout=None, stop=None,
+                 background=False, grace=LISTING_GRACE):
+        """Wait for the remote jobs of all tasks, syncing each task as it finishes.
+
+        Job states are polled with `status_all`. The interval between polls
+        starts at `poll_interval` and grows by `backoff` up to
+        `max_interval` while nothing finishes. Each finished task, including
+        its separate analysis job if any, is synced right away in a pool of
+        `n_sync_workers` threads. The transfers and `callback` thus overlap
+        with the jobs that are still running.
+
+        Jobs may not be listed by the batch system right after submission,
+        so a job that is not listed is only taken to have ended if an
+        earlier poll listed it or once `grace` seconds have passed since its
+        submission. Jobs that finished before `wait_all` was called are thus
+        synced too, even if the batch system no longer lists them.
+
+        Parameters
+        ----------
+        poll_interval : float, optional, default=30
+        max_interval : float, optional, default=600
+        backoff : float, optional, default=2
+        n_sync_workers : int, optional, default=4
+            The maximum number of transfers at the same time.
+        callback : callable, optional
+            Called as ``callback(task, summary)`` from a sync worker after
+            each task was synced, with the summary returned by `Task.sync`.
+        file_types : str or list of str, optional
+            Passed on to `Task.sync`.
+        dedup : bool, optional, default=False
+            Passed on to `Task.sync`.
+        timeout : float, optional
+            Raise RuntimeError if the jobs take longer than this many seconds.
+        stop : threading.Event, optional
+            Stop waiting when this event is set. Running transfers finish.
+        background : bool, optional, default=False
+            Wait in a background thread and return a
+            `concurrent.futures.Future` of the result immediately.
+        grace : float, optional, default=LISTING_GRACE
+            Seconds after `Task.submitted_at` during which a job that is not
+            listed is taken to be queued.
 
-    def sync_all(self):
+        Returns
+        -------
+        summaries : OrderedDict
+            The sync summary of each task, keyed by task name, in the order
+            the tasks finished.
+
+        """
+        kwargs = dict(poll_interval=poll_interval, max_interval=max_interval,
+                      backoff=backoff, n_sync_workers=n_sync_workers, callback=callback,
+                      file_types=file_types, dedup=dedup, timeout=timeout, stop=stop,
+                      grace=grace)
+        if background:
+            executor = ThreadPoolExecutor(max_workers=1)
+            future = executor.submit(self.wait_all, **kwargs)
+            executor.shutdown(wait=False)
+            return future
+
+        pending = OrderedDict((task.name, task) for task in self.tasks()
+                              if task.pbs_server and task.pbs_id)
+        summaries = OrderedDict()
+        failed = OrderedDict()
+        # IDs of the jobs that were listed by the batch system.
+        seen = set()
+        start = time.time()
+        interval = poll_interval
+
+        def sync(task):
+            summary = task.sync(file_types=file_types, dedup=dedup)
+            if callback is not None:
+                callback(task, summary)
+            return summary
+
+        with ThreadPoolExecutor(max_workers=n_sync_workers) as pool:
+            syncing = OrderedDict()
+            while pending:
+                try:
+                    self.status_all(ttl=0)
+                    finished = [task for task in pending.values()
+                                if self._job_done(task, seen, grace)]
+                except IOError as error:
+                    self.info.warning('Could not query jobs, retrying: {}'.format(error))
+                    finished = list()
+                for task in finished:
+                    del pending[task.name]
+                    self.info.info('Job of {} finished, syncing'.format(task.name))
+                    syncing[pool.submit(sync, task)] = task.name
+                if not pending:
+                    break
+                if timeout is not None and time.time() - start > timeout:
+                    raise RuntimeError('Timed out after {} s waiting for: {}'.format(
+                        timeout, ', '.join(pending)))
+                interval = poll_interval if finished else min(interval * backoff,
+                                                              max_interval)
+                if stop is not None:
+                    if stop.wait(interval):
+                        break
+                else:
+                    time.sleep(interval)
+
+            for future, name in syncing.items():
+                error = future.exception()
+                if error is not None:
+                    failed[name] = error
+                    self.info.error('Sync of {} failed: {}'.format(name, error))
+                else:
+                    summaries[name] = future.result()
+
+        if failed:
+            raise_from(RuntimeError('Failed to sync: {}'.format(', '.join(failed))),
+                       next(iter(failed.values())))
+        return summaries
+
+    def _job_done(self, task, seen, grace=LISTING_GRACE):
+        """Return True if a task's job, and its analysis job if any, ended.
+
+        Uses the statuses from the last `status_all`, see `job_ended`; `seen`
+        holds the jobs listed by earlier polls and is updated with the jobs
+        that are listed now.
+
+        """
+        done = True
+        for job_id, status in ((task.pbs_id, task.latest_status),
+                               (task.analysis_id, task.analysis_status)):
+            if not job_id:
+                continue
+            ended = job_ended(status, listed=job_id in seen,
+                              submitted_at=task.submitted_at, grace=grace)
+            if status:
+                seen.add(job_id)
+            done = done and ended
+        return done
+
+    def sync_all(self, file_types=None, n_streams=1, compress=False, reduced=True,
+                 dedup=False):
+        """Copy the results of all remotely executed tasks.
+
+        Tasks are copied in batches, with one `rsync` call per host and
+        stream instead of one per task.
+
+        Parameters
+        ----------
+        file_types : str or list of str, optional
+            Only copy files of these types: extensions (e.g. ['.gro', '.edr']),
+            categories present in `metamds.task.EXTENSIONS` or glob patterns.
+            By default each task's `reduced_outputs` are copied if set, and
+            everything otherwise.
+        n_streams : int, optional, default=1
+            Number of parallel transfers per host. Tasks are split evenly
+            between them.
+        compress : bool, optional, default=False
+            Compress data during the transfer.
+        reduced : bool, optional, default=True
+            Set to False to copy everything despite `reduced_outputs`.
+        dedup : bool, optional, default=False
+            Link files whose contents are already in the local object store
+            instead of copying them, and deduplicate the copied files. See
+            `deduplicate`.
+
+        Returns
+        -------
+        summary : OrderedDict
+            Number of files and bytes transferred for each task and the
+            duration of the transfer that carried it, keyed by task name.
+
+        """
+        hosts = OrderedDict()
         for task in self.tasks():
-            task.sync()
+            if task.hostname:
+                hosts.setdefault((task.hostname, task.username), list()).append(task)
+        if not hosts:
+            print('Nothing to sync.')
+            return OrderedDict()
+
+        batches = list()
+        for tasks in hosts.values():
+            n_batches = min(n_streams, len(tasks))
+            batches.extend(tasks[i::n_batches] for i in range(n_batches))
+
+        summary = OrderedDict()
+        with ThreadPoolExecutor(max_workers=len(batches)) as pool:
+            for result in pool.map(lambda batch: sync_tasks(batch, file_types, compress,
+                                                            reduced, dedup),
+                                   batches):
+                summary.update(result)
+
+        total = sum(entry['bytes'] for entry in summary.values())
+        self.info.info('Synced {:d} tasks, {:d} bytes'.format(len(summary), total))
+        for name, entry in summary.items():
+            self.debug.debug('{}: {:d} files, {:d} bytes in {:.1f} s'.format(
+                name, entry['files'], entry['bytes'], entry['seconds']))
+        return summary
+
+    def deduplicate(self, min_size=1):
+        """Replace identical output files of different tasks by hard links.
+
+        Files are hashed and stored once in `metamds.dedup.OBJECTS_DIR` in
+        `output_dir`, and every copy becomes a hard link to the stored file.
+        Only run this on finished tasks: a file that is modified in place
+        afterwards changes in every task directory.
+
+        Parameters
+        ----------
+        min_size : int, optional, default=1
+            Skip files smaller than this many bytes.
+
+        Returns
+        -------
+        n_files, saved : int
+            The number of files replaced and the bytes freed.
+
+        """
+        store = ObjectStore(os.path.join(self.output_dir, OBJECTS_DIR))
+        paths = [entry.path for task in self.tasks()
+                 for entry in task.manifest().values()]
+        n_files, saved = deduplicate(paths, store, min_size=min_size)
+        self.info.info('Deduplicated {:d} files, {:d} bytes'.format(n_files, saved))
+        return n_files, saved
 
     def parametrize(self, **parameters):
         """Parametrize and add a task to this simulation. """
-        task = Task(simulation=self)
+        return self.parametrize_many([parameters])[0]
+
+    def parametrize_grid(self, n_processes=None, **parameters):
+        """Parametrize and add a task for every combination of parameter values.
+
+        Parameters
+        ----------
+        n_processes : int, optional
+            See `parametrize_many`.
+        **parameters
+            Lists (or other iterables) of values to sweep over. Strings, dicts
+            and other scalars are passed unchanged to every task.
+
+        Returns
+        -------
+        tasks : list of metamds.Task
+
+        """
+        names = list(parameters)
+        values = [value if _is_sweep(value) else [value]
+                  for value in parameters.values()]
+        return self.parametrize_many([dict(zip(names, point))
+                                      for point in itertools.product(*values)],
+                                     n_processes=n_processes)
+
+    def parametrize_many(self, parameter_sets, n_processes=None):
+        """Parametrize and add a task for each of many sets of parameters.
+
+        The template is checked once, the input directory is scanned once
+        after all scripts are rendered and all tasks are added in one step.
+
+        Parameters
+        ----------
+        parameter_sets : iterable of dict
+            The parameters of each task.
+        n_processes : int, optional
+            Render the scripts of callable templates in a pool of this many
+            processes. Useful for expensive templates; the template must be
+            picklable. By default scripts are rendered in this process.
 
-        parameters['input_dir'] = os.path.relpath(self.input_dir, task.output_dir)
+        Returns
+        -------
+        tasks : list of metamds.Task
 
-        cwd = os.getcwd()
-        os.chdir(task.output_dir)
+        """
+        template = self._compile_template()
+        parameter_sets = [dict(parameters) for parameters in parameter_sets]
+        if not parameter_sets:
+            return list()
+        names = ['task_{:d}'.format(self.n_tasks + i) for i in range(len(parameter_sets))]
+        output_dirs = [os.path.join(self.output_dir, name) for name in names]
+        # All task directories are siblings, so they share the relative path.
+        input_dir = os.path.relpath(self.input_dir, os.path.join(self.output_dir, 'task'))
+        for parameters in parameter_sets:
+            parameters['input_dir'] = input_dir
+
+        if isinstance(template, _FormatTemplate):
+            # Formatting strings cannot touch the filesystem.
+            cwds = [None] * len(names)
+        else:
+            # Callable templates run inside the task directory, where they
+            # may write files.
+            cwds = output_dirs
+            for output_dir in output_dirs:
+                create_task_dir(output_dir, self.input_files, layout=self.layout,
+                                input_dir=self.input_dir)
+
+        templates = [template] * len(names)
+        if n_processes and n_processes > 1 and cwds[0] is not None:
+            # Imported here as multiprocessing adds to the import time of metamds.
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=n_processes) as pool:
+                chunksize = max(1, len(names) // (4 * n_processes))
+                scripts = list(pool.map(_render_script, templates, parameter_sets, cwds,
+                                        chunksize=chunksize))
+        else:
+            scripts = list(map(_render_script, templates, parameter_sets, cwds))
+
+        for script in scripts:
+            if not _is_iterable_of_strings(script):
+                raise ValueError('Unusable template: {}\n Templates should either '
+                                 'be an iterable of strings or a function that '
+                                 'returns an iterable of strings.'.format(self.template))
+
+        # Parametrizing a task can and typically will produce input files.
+        self.input_files = self._scan_input_files()
+        tasks = list()
+        for name, script, parameters in zip(names, scripts, parameter_sets):
+            task = Task(name=name, simulation=self, script=script)
+            task.parameters = parameters
+            self.add_task(task)
+            tasks.append(task)
+        return tasks
+
+    def _compile_template(self):
+        """Return the template as a callable returning a script. """
         if hasattr(self.template, '__call__'):
-            script = self.template(**parameters)
+            return self.template
         # elif is_url(self.template):
         #     treat as blockly and download from github
         elif _is_iterable_of_strings(self.template):
-            script = list()
-            for command in self.template:
-                command.format(**parameters)
-                script.append(command)
-        else:
-            script = None
+            return _FormatTemplate(self.template, self.format_template)
+        raise ValueError('Unusable template: {}\n Templates should either '
+                         'be an iterable of strings or a function that '
+                         'returns an iterable of strings.'.format(self.template))
 
-        if not _is_iterable_of_strings(script):
-            raise ValueError('Unusable template: {}\n Templates should either '
-                             'be an iterable of strings or a function that '
-                             'returns an iterable of strings.'.format(self.template))
-
-        os.chdir(cwd)
-        # Parametrizing a task can and typically will produce input files.
-        self.input_files = [f for f in glob('{}/*'.format(self.input_dir))
-                            if not f.endswith(('.py', '.ipynb')) and
-                            f != self.output_dir]
-        task.script = script
-        self.add_task(task)
-        return task
+    def _scan_input_files(self):
+        """Return all files in `input_dir` that tasks should link to. """
+        return [f for f in glob('{}/*'.format(self.input_dir))
+                if not f.endswith(('.py', '.ipynb')) and
+                f != self.output_dir]
 
     def add_to_db(self, host="127.0.0.1", port=27017, database="shearing_simulations", 
                   user=None, password=None, collection="tasks", use_full_uri=False, 
-                  update_duplicates=False, **parameters):
+                  update_duplicates=False, key=("output_dir",), **parameters):
         """Adds simulation parameters and io file locations to db.
+
+        The doc is upserted on `key`, like the docs of `add_all_to_db`.
         
         Parameters
         ----------
@@ -197,38 +975,176 @@ class Simulation(object):
         password : str, optional 
             user password (default is None, meaning there is no password access to database).
         collection : str, optional 
-            database collection name for doc location (default is tasks).
+            database collection name for doc location (default is tasks). If
+            `connect_db` was called, its client is used instead of `host`,
+            `port`, `user` and `password`.
         use_full_uri : bool, optional 
             optional use of full uri path name, necessary for hosted database (default is False,
             meaning the files being used in the database are local).
         update_duplicates : bool, optional
-            determines ifduplicates in the database will be updated (default is False, meaning 
-            the added doc should not replace an existing doc that is equivalent)
+            determines if an existing doc with the same key is updated (default is False,
+            meaning it is left as it is)
+        key : tuple of str, optional
+            fields that identify the doc (default is ("output_dir",)).
         **parameters : dict, optional
             keys and fields added in doc.
+
+        Returns
+        -------
+        counts : dict
+            number of docs "inserted", "updated" and "skipped".
         """
         # TODO:: add user//pw functionality when MongoDB is hosted
-        
-        for key in parameters:
-            if type(parameters[key]).__name__ in ['function', 'type']:
-                parameters[key] = parameters[key].__name__
-       
+        output_dir = "{}/task_{:d}/".format(self.output_dir, self.n_tasks-1)
+        doc = self._db_doc(output_dir, parameters, use_full_uri)
+        return add_docs_db([doc], key=key, host=host, port=port, database=database,
+                           user=user, password=password, collection=collection,
+                           update_duplicates=update_duplicates, client=self.db_client)
+
+    def add_all_to_db(self, host="127.0.0.1", port=27017, database="shearing_simulations",
+                      user=None, password=None, collection="tasks", use_full_uri=False,
+                      update_duplicates=False, key=("output_dir",), profile=False,
+                      **parameters):
+        """Adds the parameters and io file locations of every task to db at once.
+
+        All documents are written in a single bulk write, upserted on `key`.
+
+        Parameters
+        ----------
+        host : str, optional
+            database connection host (the default is 127.0.0.1, or the local computer being used)
+        port : int, optional
+            database host port (default is 27017, which is the pymongo default port).
+        database : str, optional
+            name of the database being used (default is shearing_simulations).
+        user : str, optional
+            user name (default is None, meaning the database is public).
+        password : str, optional
+            user password (default is None, meaning there is no password access to database).
+        collection : str, optional
+            database collection name for doc location (default is tasks).
+        use_full_uri : bool, optional
+            optional use of full uri path name, necessary for hosted database (default is False,
+            meaning the files being used in the database are local).
+        update_duplicates : bool, optional
+            determines if existing docs with the same key are updated (default is False,
+            meaning they are left as they are)
+        key : tuple of str, optional
+            fields that identify a task's doc (default is ("output_dir",)).
+        profile : bool, optional
+            add the resources used by each task's commands under "profile", see
+            `Task.load_profile` (default is False).
+        **parameters : dict, optional
+            keys and fields added to every doc, in addition to the parameters each
+            task was created with by `parametrize`.
+
+        Returns
+        -------
+        counts : dict
+            number of docs "inserted", "updated" and "skipped".
+        """
+        docs = list()
+        for task in self.tasks():
+            task_parameters = dict(task.parameters or {})
+            task_parameters.update(parameters)
+            output_dir = os.path.join(task.output_dir, '')
+            doc = self._db_doc(output_dir, task_parameters, use_full_uri)
+            if profile:
+                doc['profile'] = task.load_profile()
+            docs.append(doc)
+        return add_docs_db(docs, key=key, host=host, port=port, database=database,
+                           user=user, password=password, collection=collection,
+                           update_duplicates=update_duplicates, client=self.db_client)
+
+    def create_db_indexes(self, host="127.0.0.1", port=27017, database="shearing_simulations",
+                          user=None, password=None, collection="tasks", compound=False):
+        """Index the database on the parameters swept in this simulation.
+
+        Parameters
+        ----------
+        host : str, optional
+            database connection host (the default is 127.0.0.1, or the local computer being used)
+        port : int, optional
+            database host port (default is 27017, which is the pymongo default port).
+        database : str, optional
+            name of the database being used (default is shearing_simulations).
+        user : str, optional
+            user name (default is None, meaning the database is public).
+        password : str, optional
+            user password (default is None, meaning there is no password access to database).
+        collection : str, optional
+            database collection name for doc location (default is tasks).
+        compound : bool, optional
+            create one compound index over all parameters instead of one index per
+            parameter (default is False).
+
+        Returns
+        -------
+        names : list of str
+            names of the indexes.
+        """
+        fields = ["output_dir"]
+        for task in self.tasks():
+            for field in sorted(task.parameters or {}):
+                if field not in fields and field != "input_dir":
+                    fields.append(field)
+        if compound:
+            fields = fields[1:]
+        return create_indexes(fields, host=host, port=port, database=database, user=user,
+                              password=password, collection=collection,
+                              client=self.db_client, compound=compound)
+
+    def _db_doc(self, output_dir, parameters, use_full_uri=False):
+        """Build the database doc of a task from its parameters and io locations. """
+        doc = dict()
+        for key, value in parameters.items():
+            if type(value).__name__ in ['function', 'type']:
+                value = value.__name__
+            doc[key] = value
+
         if use_full_uri:
-            output_dir = get_uri("{}/task_{:d}/".format(self.output_dir, self.n_tasks-1))
-            input_dir = get_uri(self.input_dir)
-            input_files = get_uri(self.input_files)
+            doc['output_dir'] = get_uri(output_dir)
+            doc['input_dir'] = get_uri(self.input_dir)
+            doc['input_files'] = get_uri(self.input_files)
         else:
-            output_dir = "{}/task_{:d}/".format(self.output_dir, self.n_tasks-1)
-            input_dir = self.input_dir
-            input_files = self.input_files
+            doc['output_dir'] = output_dir
+            doc['input_dir'] = self.input_dir
+            doc['input_files'] = self.input_files
+        return doc
+
+
+class _FormatTemplate(object):
+    """A template of command strings, optionally filled in with `str.format`. """
+
+    def __init__(self, commands, format=False):
+        self.commands = list(commands)
+        self.format = format
+
+    def __call__(self, **parameters):
+        if not self.format:
+            return list(self.commands)
+        return [command.format(**parameters) for command in self.commands]
+
+
+def _render_script(template, parameters, cwd=None):
+    """Render a template, optionally from within the directory `cwd`. """
+    old_cwd = os.getcwd()
+    if cwd is not None:
+        os.chdir(cwd)
+    try:
+        script = template(**parameters)
+    finally:
+        os.chdir(old_cwd)
+    # Generators can only be iterated once and cannot be pickled.
+    if hasattr(script, '__iter__') and not isinstance(script, string_types):
+        script = list(script)
+    return script
+
+
+def _is_sweep(value):
+    return (hasattr(value, '__iter__') and
+            not isinstance(value, string_types + (bytes, dict)))
 
-        parameters['output_dir'] = output_dir
-        parameters['input_dir'] = input_dir
-        parameters['input_files'] = input_files
-        
-        add_doc_db(host=host, port=port,database=database, user=user, password=password,
-                   collection=collection, doc=parameters, 
-                   update_duplicates=update_duplicates) 
 
 def _is_iterable_of_strings(script):
     try:
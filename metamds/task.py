@@ -1,22 +1,54 @@
-from glob import glob
+from collections import OrderedDict, namedtuple
+import errno
+import hashlib
+import json
 import os
+import tempfile
+import threading
+import time
 
-from paramiko import SSHClient, AutoAddPolicy
+from six import string_types
 
-from metamds.io import cmd_line, rsync_from
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    from scandir import scandir
+
+from metamds.dedup import OBJECTS_DIR, ObjectStore, deduplicate, remote_digests
+from metamds.io import file_digest, parse_transfers, rsync_from, stream_cmd_line
+from metamds.remote import cluster_config, job_finished, parse_memory, query_jobs
+from metamds.walltime import job_elapsed, parse_walltime
 
 EXTENSIONS = {'trajectories': {'.xtc', '.trr', '.dcd', '.lammpstrj'},
               'topologies': {'.gro', '.pdb'}}
 
+# The `EXTENSIONS` category of each extension.
+_CATEGORIES = dict((ext, category) for category, extensions in EXTENSIONS.items()
+                   for ext in extensions)
+
+CACHE_FILE = '.metamds_cache.json'
+
+# Resources used by each command of a task, see `Task.load_profile`.
+PROFILE_FILE = '.metamds_profile.json'
+
+# Ways of making input files available in task directories, see `create_task_dir`.
+LAYOUTS = ('symlink', 'shared', 'hardlink')
+
+# Name of the link to the input directory in the 'shared' layout.
+SHARED_INPUTS = 'inputs'
+
+# A file in a task's output directory, see `Task.manifest`.
+OutputFile = namedtuple('OutputFile', ['path', 'size', 'mtime', 'category'])
+
 PBS_HEADER = """#!/bin/sh -l
 #PBS -j oe
 #PBS -l nodes=1:ppn=16
 #PBS -l walltime={walltime}
 #PBS -q low
 #PBS -N {name}
-
+{directives}
 echo $PWD
-cd {tmp_dir}/{output}/{name}
+cd {tmp_dir}/{output}/{task_dir}
 echo $PWD
 
 module load gromacs
@@ -31,15 +63,38 @@ NERSC_HEADER = """#!/bin/bash -l
 #SBATCH -L SCRATCH
 #SBATCH -J {name}
 #SBATCH -qos=normal
-
+{directives}
 echo $PWD
-cd {tmp_dir}/{output}/{name}
+cd {tmp_dir}/{output}/{task_dir}
 echo $PWD
 
 module load gromacs/5.1.2
 
 """
 
+# Submission header of each cluster in `metamds.remote.CLUSTERS` we can submit to.
+BATCH_HEADERS = {'rahman': PBS_HEADER,
+                 'nersc': NERSC_HEADER}
+
+# Job-array directive, index variable and sub-job ID format per submit command.
+ARRAY_OPTIONS = {'qsub': {'directive': '#PBS -t 0-{last:d}',
+                          'index': '$PBS_ARRAYID',
+                          'job_id': '{array_id}[{index:d}]'},
+                 'sbatch': {'directive': '#SBATCH --array=0-{last:d}',
+                            'index': '$SLURM_ARRAY_TASK_ID',
+                            'job_id': '{array_id}_{index:d}'}}
+
+# Directive making a job wait for others to finish successfully; several job
+# IDs are separated by colons.
+DEPENDENCY_OPTIONS = {'qsub': '#PBS -W depend=afterok:{job_id}',
+                      'sbatch': '#SBATCH --dependency=afterok:{job_id}'}
+
+# Walltime of separate analysis jobs, see `Task.analysis_job`.
+ANALYSIS_WALLTIME = '02:00:00'
+
+# Name of the script written into each task directory for array jobs.
+ARRAY_SCRIPT = 'metamds_script.sh'
+
 class Task(object):
     def __init__(self, script=None, simulation=None, name=None):
         if name is None:
@@ -48,33 +103,58 @@ class Task(object):
         self.script = script
         self.simulation = simulation
         self.current_proc = None
+        self.timeout = None
+        self._cancel = threading.Event()
+        self.wall_time = None
+        self.parameters = None
+        # Resources reserved when run through `LocalResources`; None cores
+        # means the whole machine.
+        self.cores = None
+        self.memory = None
+        # Requested walltime of remote jobs, e.g. '02:00:00'. By default it is
+        # predicted by the simulation's `walltime_predictor`, if set.
+        self.walltime = None
+        # Commands that reduce the outputs, e.g. `gmx energy`, run after the
+        # script next to the data, and the file types they produce. Only
+        # those are copied by `sync` if set.
+        self.analysis = None
+        self.reduced_outputs = None
+        # Run `analysis` as a separate job that starts when the main job
+        # succeeded, instead of at the end of the main job.
+        self.analysis_job = False
+        self.analysis_id = None
+        self.analysis_status = dict()
+        self._walltime_recorded = False
+        self._profile_written = False
+        self._manifest = None
+        # The directory itself is only created when the task needs it.
         self.output_dir = os.path.join(self.simulation.output_dir, self.name)
-        if not os.path.isdir(self.output_dir):
-            os.mkdir(self.output_dir)
-        self.create_dir()
 
         self.hostname = None
         self.username = None
+        self.remote_dir = None
         self.pbs_server = None
+        self.pbs_id = None
+        # When the job was submitted, as given by `time.time`.
+        self.submitted_at = None
+        self.submit_line = None
+        self.latest_status = dict()
+        self.array_id = None
+        self.array_index = None
 
     def create_dir(self):
-        """Set up the local directory for this task. """
-        for in_file_path in self.simulation.input_files:
-            # TODO: tidy up
-            in_file_name = os.path.split(in_file_path)[1]
-            link_path = os.path.join(self.output_dir, in_file_name)
+        """Set up the local directory for this task.
 
-            cwd = os.getcwd()
-            os.chdir(self.output_dir)
+        Input files are made available according to the simulation's
+        `layout`, see `create_task_dir`. Calling this again only adds what is
+        missing.
 
-            rel_in_path = os.path.relpath(in_file_path, self.output_dir)
-            rel_link_path = os.path.relpath(link_path, self.output_dir)
-
-            if not os.path.exists(rel_link_path):
-                os.symlink(rel_in_path, rel_link_path)
-            os.chdir(cwd)
+        """
+        create_task_dir(self.output_dir, self.simulation.input_files,
+                        layout=self.simulation.layout,
+                        input_dir=self.simulation.input_dir)
 
-    def execute(self, hostname=None, username=None):
+    def execute(self, hostname=None, username=None, resources=None, after=None):
         """Execute the task.
 
         Parameters
@@ -83,90 +163,245 @@ class Task(object):
             Execute the task on this remote host.
         username : str, optional, default=''
             Use this username to access `hostname` when executing remotely.
+        resources : metamds.resources.LocalResources, optional
+            When executing locally, wait for `cores` cores and `memory` bytes
+            of memory and run the commands on those cores only.
+        after : list of str, optional
+            When executing remotely, IDs of jobs on `hostname` that must
+            finish successfully before this task's job starts.
 
         """
+        self.invalidate_manifest()
         if hostname:
-            self.client = SSHClient()
-            self.client.load_system_host_keys()
-            self.client.set_missing_host_key_policy(AutoAddPolicy())
-            self.client.connect(hostname=hostname, username=username)
-            # TODO: Is there really not a way to get this from SSHClient()?
-            self.client.hostname = hostname
-            self.client.username = username
-
-            if not self.simulation.remote_dir:
-                self.simulation.create_remote_dir(self.client, hostname, username)
-            self._execute_remote(self.client, hostname) # hostname added for HEADER check TJJ
+            self.hostname = hostname
+            self.username = username
+            self.client = self.simulation.ssh_pool.client(hostname, username)
+            self.simulation.create_remote_dir(self.client, hostname, username,
+                                              exist_ok=True)
+            self.remote_dir = self.simulation.remote_dirs[hostname]
+            walltime = self.walltime or self.simulation.predict_walltime(self, hostname)
+            self._execute_remote(self.client, hostname, walltime, after=after)
         else:
-            self._execute_local()
+            self.create_dir()
+            try:
+                self._execute_local(resources)
+            finally:
+                self.invalidate_manifest()
 
-    def _execute_remote(self, client, hostname, walltime='96:00:00'):
+    def _execute_remote(self, client, hostname, walltime='96:00:00', after=None):
         """Execute the task on a remote server.
 
         Parameters
         ----------
         client : paramiko.SSHClient
         walltime : str, optional
+        after : list of str, optional
+            IDs of jobs that must finish successfully first.
 
         """
         # if uses_PBS(client):
         self.pbs_server = True
-        sftp = client.open_sftp()
-        pbs_filename = os.path.join(self.simulation.remote_dir, '{}.pbs'.format(self.name))
+        sftp = self.simulation.ssh_pool.sftp(client.hostname, client.username)
+        pbs_filename = os.path.join(self.remote_dir, '{}.pbs'.format(self.name))
+        header, submit_line, walltime = batch_header(hostname, walltime)
+        directives = ''
+        if after:
+            directives = DEPENDENCY_OPTIONS[submit_line].format(job_id=':'.join(after))
         with sftp.open(pbs_filename, 'w') as fh:
-            # TODO: right now the header, hostname, and walltime are all hardcoded. TJJ
-            # This fix could go hand in hand with finding a way to get info from SSHClient(). TJJ
-            if "rahman" in hostname:
-                header = PBS_HEADER.format(walltime=walltime, name=self.name,
-                                           output=os.path.basename(self.simulation.output_dir),
-                                           tmp_dir=self.simulation.remote_dir)
-                submit_line = 'qsub'
-            if "nersc" in hostname:
-                walltime = '28:00:00'
-                header = NERSC_HEADER.format(walltime=walltime, name=self.name,
-                                             output=os.path.basename(self.simulation.output_dir),
-                                             tmp_dir=self.simulation.remote_dir)
-                submit_line = 'sbatch'
-            body = '\n'.join(self.script)
+            header = header.format(walltime=walltime, name=self.name,
+                                   directives=directives, task_dir=self.name,
+                                   output=os.path.basename(self.simulation.output_dir),
+                                   tmp_dir=self.remote_dir)
+            commands = self.script if self.analysis_job else self.commands()
+            body = '\n'.join(commands)
             fh.write(''.join((header, body)))
 
         _, stdout, stderr = client.exec_command('{} {}'.format(submit_line, pbs_filename))
-        self.pbs_id = stdout.readlines()[0].split('.')[0]
-
-    def _execute_local(self):
-        """Execute the task locally. """
-
-        cwd = os.getcwd()
-        os.chdir(self.output_dir)
-
-        print(cwd, self.output_dir)
-        for line in self.script:
-            print(line)
-            self.simulation.info.info('Running: {}'.format(line))
-            out, err = cmd_line(line)
-            for line in out.decode('utf-8').splitlines():
-                self.simulation.debug.debug(line)
-            for line in err.decode('utf-8').splitlines():
-                self.simulation.info.fatal(line)
-            self.simulation.info.info('Success!')
-
-        os.chdir(cwd)
-
-    def sync(self):
-        if self.simulation.remote_dir:
-            out_dir = os.path.split(self.simulation.output_dir)[1]
-            rsync_from(flags='-r -h --progress --partial',
-                       src=os.path.join(self.simulation.remote_dir, out_dir, self.name, '*'),
-                       dst=self.output_dir,
-                       user=self.client.username,
-                       host=self.client.hostname,
-                       logger=self.simulation.debug)
+        self.pbs_id = parse_job_id(stdout.readlines()[0])
+        self.submitted_at = time.time()
+        self.submit_line = submit_line
+        # The statuses cached by `status_all` do not know this job yet.
+        self.simulation._statuses = None
+        self.analysis_id = None
+        self.analysis_status = dict()
+        if self.analysis and self.analysis_job:
+            self.analysis_id = self._submit_analysis(client, hostname, sftp)
+
+    def _submit_analysis(self, client, hostname, sftp):
+        """Submit `analysis` as a job that runs once the main job succeeded. """
+        filename = os.path.join(self.remote_dir, '{}_analysis.pbs'.format(self.name))
+        header, submit_line, walltime = batch_header(hostname, ANALYSIS_WALLTIME)
+        directive = DEPENDENCY_OPTIONS[submit_line].format(job_id=self.pbs_id)
+        with sftp.open(filename, 'w') as fh:
+            header = header.format(walltime=walltime, name='{}_analysis'.format(self.name),
+                                   directives=directive, task_dir=self.name,
+                                   output=os.path.basename(self.simulation.output_dir),
+                                   tmp_dir=self.remote_dir)
+            fh.write(''.join((header, '\n'.join(self.analysis))))
+        _, stdout, stderr = client.exec_command('{} {}'.format(submit_line, filename))
+        return parse_job_id(stdout.readlines()[0])
+
+    def commands(self):
+        """Return the script followed by the `analysis` commands. """
+        return list(self.script or ()) + list(self.analysis or ())
+
+    def write_script(self, filename=ARRAY_SCRIPT):
+        """Write this task's script into its local output directory.
+
+        Used for job arrays, where a single submission script sources the
+        script of each array element from that task's directory. The
+        `analysis` commands are always part of it.
+
+        """
+        self.create_dir()
+        with open(os.path.join(self.output_dir, filename), 'w') as fh:
+            fh.write('\n'.join(self.commands()))
+            fh.write('\n')
+
+    def _execute_local(self, resources=None):
+        """Execute the task locally.
+
+        Output is streamed to the simulation's loggers while each command
+        runs. Commands are killed after `timeout` seconds, if set, or when
+        `cancel` is called.
+
+        With `resources`, the commands are pinned to the reserved cores and
+        `OMP_NUM_THREADS` is set to their number, which keeps e.g. `gmx
+        mdrun` from starting a thread for every core of the machine.
+
+        The resources used by each command are written to `PROFILE_FILE`.
+
+        Raises RuntimeError if a command fails, without running the rest of
+        the script.
+
+        """
+        key = self.cache_key()
+        info = self.simulation.info
+        debug = self.simulation.debug
+        # Gromacs logs a lot of its informational output to stderr.
+        gromacs = [False]
+
+        def log_stderr(text):
+            if 'GROMACS' in text:
+                gromacs[0] = True
+            if gromacs[0]:
+                debug.debug(text)
+            elif text.strip():
+                info.fatal(text)
+
+        env = None
+        allocation = None
+        commands = list()
+        try:
+            if resources is not None:
+                allocation = resources.acquire(self.cores, self.memory,
+                                               cancel=self._cancel)
+                env = dict(os.environ, OMP_NUM_THREADS=str(len(allocation.cores)))
+                info.info('Running {} on cores {}'.format(
+                    self.name, ','.join(str(core) for core in allocation.cores)))
+            for line in self.commands():
+                info.info('Running: {}'.format(line))
+                gromacs[0] = False
+                profile = OrderedDict([('command', line)])
+                commands.append(profile)
+                returncode = stream_cmd_line(line, stdout_callback=debug.debug,
+                                             stderr_callback=log_stderr,
+                                             cwd=self.output_dir, env=env,
+                                             timeout=self.timeout,
+                                             cancel=self._cancel,
+                                             affinity=allocation and allocation.cores,
+                                             profile=profile)
+                profile['returncode'] = returncode
+                if 'user_time' in profile:
+                    profile['cpu_time'] = profile['user_time'] + profile['system_time']
+                debug.debug('Profile: {}'.format(json.dumps(profile)))
+                if returncode != 0:
+                    msg = 'Failed with exit code {}: {}'.format(returncode, line)
+                    info.fatal(msg)
+                    raise RuntimeError(msg)
+                info.info('Success!')
+        finally:
+            if allocation is not None:
+                resources.release(allocation)
+            self._cancel.clear()
+            self._write_profile(commands)
+
+        with open(os.path.join(self.output_dir, CACHE_FILE), 'w') as fh:
+            json.dump({'key': key, 'completed': time.time()}, fh)
+
+    def cancel(self):
+        """Kill the command this task is currently running locally. """
+        self._cancel.set()
+
+    def cache_key(self):
+        """Return a hash of everything that determines this task's outputs.
+
+        The key covers the rendered script and analysis commands, the
+        parameters passed to `Simulation.parametrize` and the contents of
+        the simulation's input files.
+
+        """
+        inputs = sorted((os.path.basename(path), file_digest(path))
+                        for path in self.simulation.input_files
+                        if os.path.isfile(path))
+        content = json.dumps({'script': self.commands(),
+                              'parameters': self.parameters,
+                              'inputs': inputs},
+                             sort_keys=True, default=_cache_repr)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def is_cached(self):
+        """Return True if a previous run with the same `cache_key` completed. """
+        cache_file = os.path.join(self.output_dir, CACHE_FILE)
+        if not os.path.isfile(cache_file):
+            return False
+        try:
+            with open(cache_file) as fh:
+                cached = json.load(fh)
+        except ValueError:
+            return False
+        return cached.get('key') == self.cache_key()
+
+    def invalidate_cache(self):
+        """Forget any previous run so that the next execution starts over. """
+        cache_file = os.path.join(self.output_dir, CACHE_FILE)
+        if os.path.isfile(cache_file):
+            os.remove(cache_file)
+
+    def sync(self, file_types=None, compress=False, reduced=True, dedup=False):
+        """Copy this task's results from the remote host it ran on.
+
+        Parameters
+        ----------
+        file_types : str or list of str, optional
+            Only copy files of these types: extensions, categories present in
+            `EXTENSIONS` or glob patterns. By default `reduced_outputs` are
+            copied if set, and everything otherwise.
+        compress : bool, optional, default=False
+            Compress data during the transfer.
+        reduced : bool, optional, default=True
+            Set to False to copy everything despite `reduced_outputs`.
+        dedup : bool, optional, default=False
+            Link files whose contents are already stored locally instead of
+            copying them, see `sync_tasks`.
+
+        Returns
+        -------
+        summary : dict
+            Number of files, bytes and seconds taken by the transfer.
+
+        """
+        if self.remote_dir and self.hostname:
+            return sync_tasks([self], file_types=file_types, compress=compress,
+                              reduced=reduced, dedup=dedup)[self.name]
         else:
             print('Nothing to sync.')
 
     def get_output_files(self, file_type):
         """Get all files of a specific type produced by this task.
 
+        Answered from the cached `manifest`.
+
         Parameters
         ----------
         file_type : str
@@ -174,21 +409,69 @@ class Task(object):
             `EXTENSIONS`.
 
         """
-        all_files = list()
         if file_type in EXTENSIONS:
-            for ext in EXTENSIONS[file_type]:
-                files = glob(os.path.join(self.output_dir, '*{}'.format(ext)))
-                all_files.extend(files)
+            return [f.path for f in self.manifest().values() if f.category == file_type]
         elif file_type.startswith('.'):
-            files = glob(os.path.join(self.output_dir, '*{}'.format(file_type)))
-            all_files.extend(files)
-        return all_files
+            return [f.path for f in self.manifest().values() if f.path.endswith(file_type)]
+        return list()
+
+    def trajectory(self, filename=None):
+        """Open one of this task's trajectories for lazy, frame-by-frame reading.
+
+        Parameters
+        ----------
+        filename : str, optional
+            Name of the trajectory file in `output_dir`, or an extension. By
+            default the only trajectory produced by this task is opened.
+
+        Returns
+        -------
+        reader : metamds.trajectory.TrajectoryReader
+            Supports `len`, indexing, iteration and `iter_chunks`, returning
+            positions as NumPy arrays.
 
-    def status(self):
         """
+        from metamds.trajectory import open_trajectory
+
+        if filename is None or filename.startswith('.'):
+            paths = self.get_output_files(filename or 'trajectories')
+            if len(paths) != 1:
+                raise ValueError('Found {:d} trajectories in {}, please pass '
+                                 '`filename`.'.format(len(paths), self.output_dir))
+            path = paths[0]
+        else:
+            path = os.path.join(self.output_dir, filename)
+        return open_trajectory(path)
+
+    def manifest(self, refresh=False):
+        """Return the files in this task's output directory.
+
+        The directory is scanned once and the result is cached until the task
+        is executed or synced again, or `refresh` is True.
 
         Returns
         -------
+        manifest : OrderedDict
+            `OutputFile` entries with path, size, mtime and category (a key of
+            `EXTENSIONS` or None), keyed by file name and sorted by it.
+
+        """
+        if self._manifest is None or refresh:
+            self._manifest = _scan_output_dir(self.output_dir)
+        return self._manifest
+
+    def invalidate_manifest(self):
+        """Forget the cached `manifest`, e.g. after files were changed. """
+        self._manifest = None
+
+    def status(self):
+        """Query the batch system for the state of this task's job.
+
+        Returns
+        -------
+        status : dict
+            The fields reported by `qstat -f` (PBS) or `sacct` (SLURM). Empty
+            for local tasks and for jobs the batch system no longer knows.
 
         """
         status = dict()
@@ -196,18 +479,315 @@ class Task(object):
             if not self.pbs_id:
                 raise RuntimeError('This task does not have a `pbs_id`. Have you'
                                    'run `task.execute` yet?')
-            _, stdout, stderr = self.client.exec_command('qstat -f {}'.format(self.pbs_id))
-            if stderr.readlines():
-                raise IOError(stderr.read().decode('utf-8'))
-            content = stdout.readlines()[1:]
-            for line in content:
-                if '=' in line:
-                    entry, value = line.split('=', 1)
-                    status[entry.strip()] = value.strip()
+            client = self.simulation.ssh_pool.client(self.hostname, self.username)
+            statuses = query_jobs(client, self.submit_line, [self.pbs_id])
+            status = statuses.get(self.pbs_id, dict())
 
-        self.latest_status = status
+        self._set_status(status)
         return status
 
+    def load_profile(self):
+        """Return the resources used by this task's commands.
 
+        Local tasks are profiled as they run. For remote tasks, the job
+        accounting data is saved once `status` or `Simulation.status_all`
+        sees the job finish: one entry per job step on SLURM and one for the
+        whole job on PBS.
 
+        Returns
+        -------
+        profile : dict or None
+            'task', 'hostname' and a list of 'commands', each with the
+            'command', 'returncode', 'wall_time' and 'cpu_time' in seconds
+            and 'max_rss' in bytes where known. None if the task has not
+            been profiled yet.
 
+        """
+        path = os.path.join(self.output_dir, PROFILE_FILE)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as fh:
+            return json.load(fh, object_pairs_hook=OrderedDict)
+
+    def _write_profile(self, commands):
+        profile = OrderedDict([('task', self.name),
+                               ('hostname', self.hostname or 'localhost'),
+                               ('job_id', self.pbs_id),
+                               ('commands', commands)])
+        with open(os.path.join(self.output_dir, PROFILE_FILE), 'w') as fh:
+            json.dump(profile, fh, indent=2)
+        self.invalidate_manifest()
+
+    def _set_status(self, status):
+        """Store a job status and save the data of finished jobs. """
+        self.latest_status = status
+        self._record_walltime()
+        if (status and job_finished(status) and not self._profile_written and
+                os.path.isdir(self.output_dir)):
+            self._write_profile(job_profile(status))
+            self._profile_written = True
+
+    def _record_walltime(self):
+        """Add the runtime of this task's finished job to the walltime history. """
+        predictor = self.simulation.walltime_predictor
+        if predictor is None or self._walltime_recorded:
+            return
+        seconds = job_elapsed(self.latest_status)
+        if seconds is not None:
+            predictor.record(self, seconds)
+            self._walltime_recorded = True
+
+
+def job_profile(status):
+    """Convert the job accounting data of a job status to `PROFILE_FILE` entries. """
+    if 'State' not in status:
+        return [OrderedDict([
+            ('command', status.get('Job_Name')),
+            ('returncode', _int(status.get('exit_status'))),
+            ('wall_time', _seconds(status.get('resources_used.walltime'))),
+            ('cpu_time', _seconds(status.get('resources_used.cput'))),
+            ('max_rss', parse_memory(status.get('resources_used.mem', '')) or None)])]
+    commands = list()
+    for step, record in status.get('steps', {'': status}).items():
+        commands.append(OrderedDict([
+            ('command', record['JobName']),
+            ('step', step or None),
+            ('state', record['State']),
+            ('returncode', _int(record['ExitCode'].split(':')[0])),
+            ('wall_time', _seconds(record['Elapsed'])),
+            ('cpu_time', _seconds(record['TotalCPU'])),
+            ('max_rss', parse_memory(record['MaxRSS']) or None)]))
+    return commands
+
+
+def _seconds(walltime):
+    return parse_walltime(walltime) if walltime else None
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _cache_repr(obj):
+    """Hashable stand-in for parameters that JSON cannot encode. """
+    return getattr(obj, '__name__', repr(obj))
+
+
+def batch_header(hostname, walltime):
+    """Return the submission header, submit command and walltime for a host.
+
+    Parameters
+    ----------
+    hostname : str
+    walltime : str
+        Requested walltime, which is capped at the host's maximum.
+
+    """
+    config = cluster_config(hostname)
+    if config['walltime'] and parse_walltime(walltime) > parse_walltime(config['walltime']):
+        walltime = config['walltime']
+    for name, header in BATCH_HEADERS.items():
+        if name in hostname:
+            return header, config['submit_line'], walltime
+    raise ValueError('No batch header is configured for host "{}".'.format(hostname))
+
+
+def parse_job_id(line):
+    """Extract the job ID from the output of `qsub` or `sbatch`.
+
+    `qsub` prints e.g. "1234.server" or "1234[].server" for arrays, while
+    `sbatch` prints "Submitted batch job 1234".
+
+    """
+    return line.split()[-1].split('.')[0].replace('[]', '')
+
+
+def sync_tasks(tasks, file_types=None, compress=False, reduced=True, dedup=False):
+    """Copy the results of several tasks with a single `rsync` call.
+
+    All tasks must belong to the same simulation and have run on the same
+    host.
+
+    Parameters
+    ----------
+    tasks : list of Task
+    file_types : str or list of str, optional
+        Only copy files of these types: extensions, categories present in
+        `EXTENSIONS` or glob patterns. By default each task's
+        `reduced_outputs` are copied if set, and everything otherwise.
+    compress : bool, optional, default=False
+        Compress data during the transfer.
+    reduced : bool, optional, default=True
+        Set to False to ignore `reduced_outputs`.
+    dedup : bool, optional, default=False
+        Hash the remote files first and link those whose contents are in
+        the simulation's `metamds.dedup.ObjectStore` instead of copying
+        them. Afterwards, the copied files are deduplicated.
+
+    Returns
+    -------
+    summary : OrderedDict
+        The number of files and bytes transferred for each task, keyed by task
+        name, along with the duration of the whole transfer and the number
+        of files linked from the object store.
+
+    """
+    simulation = tasks[0].simulation
+    out_dir = os.path.split(simulation.output_dir)[1]
+    rules = list()
+    linked = dict((task.name, 0) for task in tasks)
+    task_patterns = OrderedDict()
+    for task in tasks:
+        if file_types is None and reduced:
+            task_patterns[task.name] = file_patterns(task.reduced_outputs)
+        else:
+            task_patterns[task.name] = file_patterns(file_types)
+    if dedup:
+        store = ObjectStore(os.path.join(simulation.output_dir, OBJECTS_DIR))
+        client = simulation.ssh_pool.client(tasks[0].hostname, tasks[0].username)
+        # Only the files that would be copied are hashed, with one remote
+        # command per set of patterns.
+        groups = OrderedDict()
+        for name, patterns in task_patterns.items():
+            key = None if patterns is None else tuple(patterns)
+            groups.setdefault(key, list()).append(name)
+        digests = dict()
+        for patterns, names in groups.items():
+            digests.update(remote_digests(client, os.path.join(tasks[0].remote_dir, out_dir),
+                                          names, patterns=patterns))
+        for path, digest in sorted(digests.items()):
+            if digest in store:
+                store.link(digest, os.path.join(simulation.output_dir, path))
+                rules.append('- /{}'.format(path))
+                linked[path.split('/', 1)[0]] += 1
+    for task in tasks:
+        patterns = task_patterns[task.name]
+        if patterns is None:
+            rules.append('+ /{}/***'.format(task.name))
+        else:
+            rules.append('+ /{}/'.format(task.name))
+            rules.extend('+ /{}/{}'.format(task.name, pattern) for pattern in patterns)
+    rules.append('- *')
+
+    with tempfile.NamedTemporaryFile('w', suffix='.rules', delete=False) as fh:
+        fh.write('\n'.join(rules))
+        fh.write('\n')
+    flags = '-r -h --partial --links --filter="merge {}" --out-format="%l %n"'.format(fh.name)
+    if compress:
+        flags += ' -z'
+    start = time.time()
+    try:
+        out = rsync_from(flags=flags,
+                         src=os.path.join(tasks[0].remote_dir, out_dir, ''),
+                         dst=os.path.join(simulation.output_dir, ''),
+                         user=tasks[0].username,
+                         host=tasks[0].hostname,
+                         logger=simulation.debug)
+    finally:
+        os.remove(fh.name)
+    seconds = time.time() - start
+
+    for task in tasks:
+        task.invalidate_manifest()
+    if dedup:
+        deduplicate((entry.path for task in tasks for entry in task.manifest().values()),
+                    store)
+    summary = OrderedDict((task.name, {'files': 0, 'bytes': 0, 'seconds': seconds,
+                                       'linked': linked[task.name]})
+                          for task in tasks)
+    for path, size in parse_transfers(out):
+        name = path.split('/', 1)[0]
+        if name in summary:
+            summary[name]['files'] += 1
+            summary[name]['bytes'] += size
+    return summary
+
+
+def create_task_dir(output_dir, input_files, layout='symlink', input_dir=None):
+    """Create a task directory and make the input files available in it.
+
+    No working directory changes are made, so this is safe to call from
+    several threads.
+
+    Parameters
+    ----------
+    output_dir : str
+    input_files : list of str
+    layout : str, optional, default='symlink'
+        'symlink' creates a relative symlink per input file, 'hardlink' a hard
+        link per input file (falling back to a symlink for directories and
+        across filesystems) and 'shared' a single relative symlink named
+        `SHARED_INPUTS` to `input_dir`, so scripts refer to e.g.
+        'inputs/topol.top'.
+    input_dir : str, optional
+        Required for the 'shared' layout.
+
+    """
+    if layout not in LAYOUTS:
+        raise ValueError('Unknown layout "{}", use one of {}.'.format(layout, ', '.join(LAYOUTS)))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    if layout == 'shared':
+        link_path = os.path.join(output_dir, SHARED_INPUTS)
+        if not os.path.lexists(link_path):
+            os.symlink(os.path.relpath(input_dir, output_dir), link_path)
+        return
+
+    rel_dirs = dict()
+    for in_file_path in input_files:
+        in_dir, in_file_name = os.path.split(in_file_path)
+        link_path = os.path.join(output_dir, in_file_name)
+        if os.path.lexists(link_path):
+            continue
+        if layout == 'hardlink' and not os.path.isdir(in_file_path):
+            try:
+                os.link(in_file_path, link_path)
+                continue
+            except OSError as error:
+                if error.errno != errno.EXDEV:
+                    raise
+        if in_dir not in rel_dirs:
+            rel_dirs[in_dir] = os.path.relpath(in_dir, output_dir)
+        os.symlink(os.path.join(rel_dirs[in_dir], in_file_name), link_path)
+
+
+def _scan_output_dir(output_dir):
+    """Build a manifest of `output_dir` with a single directory scan. """
+    entries = list()
+    if os.path.isdir(output_dir):
+        for entry in scandir(output_dir):
+            # Hidden files are bookkeeping, e.g. `CACHE_FILE`.
+            if entry.name.startswith('.'):
+                continue
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            ext = os.path.splitext(entry.name)[1]
+            entries.append((entry.name, OutputFile(entry.path, stat.st_size, stat.st_mtime,
+                                                   _CATEGORIES.get(ext))))
+    return OrderedDict(sorted(entries))
+
+
+def file_patterns(file_types):
+    """Turn extensions and `EXTENSIONS` categories into glob patterns.
+
+    Returns None if `file_types` is None, meaning that all files match.
+
+    """
+    if file_types is None:
+        return None
+    if isinstance(file_types, string_types):
+        file_types = [file_types]
+    patterns = list()
+    for file_type in file_types:
+        if file_type in EXTENSIONS:
+            patterns.extend('*{}'.format(ext) for ext in sorted(EXTENSIONS[file_type]))
+        elif file_type.startswith('.'):
+            patterns.append('*{}'.format(file_type))
+        else:
+            patterns.append(file_type)
+    return patterns
@@ -0,0 +1,235 @@
+"""Lazy readers for the trajectory files listed in `metamds.task.EXTENSIONS`.
+
+Every reader returns positions as NumPy arrays of shape (n_atoms, 3) per
+frame, or (n_frames, n_atoms, 3) per chunk, in the units of the file. Binary
+formats are memory-mapped and text formats are indexed by frame offset, so
+reading frame `k` never reads the frames before it.
+
+"""
+import os
+import struct
+
+import numpy as np
+
+
+def open_trajectory(path):
+    """Return a lazy reader for a trajectory file, chosen by its extension. """
+    ext = os.path.splitext(path)[1]
+    if ext not in READERS:
+        raise ValueError('Unsupported trajectory format "{}". Supported formats '
+                         'are {}.'.format(ext, ', '.join(sorted(READERS))))
+    return READERS[ext](path)
+
+
+class TrajectoryReader(object):
+    """Base class of the lazy trajectory readers.
+
+    Subclasses implement `_read(start, stop)`, returning the positions of
+    frames `start` to `stop` as an array of shape (n_frames, n_atoms, 3).
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.n_frames = 0
+        self.n_atoms = 0
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, k):
+        if k < 0:
+            k += self.n_frames
+        if not 0 <= k < self.n_frames:
+            raise IndexError('Frame {} out of range for {} frames.'.format(k, self.n_frames))
+        return self._read(k, k + 1)[0]
+
+    def __iter__(self):
+        for k in range(self.n_frames):
+            yield self[k]
+
+    def iter_chunks(self, chunk_size=100):
+        """Yield the positions of `chunk_size` frames at a time. """
+        for start in range(0, self.n_frames, chunk_size):
+            yield self._read(start, min(start + chunk_size, self.n_frames))
+
+    def _read(self, start, stop):
+        raise NotImplementedError
+
+
+class DCDReader(TrajectoryReader):
+    """Memory-mapped reader for CHARMM/NAMD/LAMMPS `.dcd` files. """
+
+    def __init__(self, path):
+        super(DCDReader, self).__init__(path)
+        with open(path, 'rb') as fh:
+            head = fh.read(92)
+        if struct.unpack('<i', head[:4])[0] == 84:
+            endian = '<'
+        elif struct.unpack('>i', head[:4])[0] == 84:
+            endian = '>'
+        else:
+            raise IOError('{} is not a DCD file.'.format(path))
+        if head[4:8] != b'CORD':
+            raise IOError('{} is not a DCD coordinate file.'.format(path))
+        icntrl = struct.unpack(endian + '20i', head[8:88])
+        if icntrl[8]:
+            raise NotImplementedError('DCD files with fixed atoms are not supported.')
+        charmm = icntrl[19] != 0
+        has_cell = charmm and icntrl[10] != 0
+        four_dims = charmm and icntrl[11] != 0
+
+        mm = np.memmap(path, dtype=np.uint8, mode='r')
+        offset = 92
+        title_size = struct.unpack_from(endian + 'i', mm, offset)[0]
+        offset += 4 + title_size + 4
+        self.n_atoms = struct.unpack_from(endian + 'i', mm, offset + 4)[0]
+        offset += 12
+
+        # Each block is a Fortran record framed by two 4-byte size markers.
+        self._cell_words = 14 if has_cell else 0
+        block = self.n_atoms + 2
+        frame_words = self._cell_words + (4 if four_dims else 3) * block
+        self.n_frames = (mm.size - offset) // (4 * frame_words)
+        self._frames = np.memmap(path, dtype=endian + 'f4', mode='r', offset=offset,
+                                 shape=(self.n_frames, frame_words))
+
+    def _read(self, start, stop):
+        frames = self._frames[start:stop]
+        block = self.n_atoms + 2
+        xyz = [frames[:, self._cell_words + i * block + 1:
+                      self._cell_words + (i + 1) * block - 1] for i in range(3)]
+        return np.stack(xyz, axis=-1).astype(np.float32)
+
+
+class TRRReader(TrajectoryReader):
+    """Memory-mapped reader for GROMACS `.trr` files.
+
+    Frames without positions, e.g. velocity-only frames, are skipped.
+
+    """
+
+    MAGIC = 1993
+
+    def __init__(self, path):
+        super(TRRReader, self).__init__(path)
+        self._mm = np.memmap(path, dtype=np.uint8, mode='r')
+        self._offsets = list()
+        self._dtype = None
+        offset = 0
+        while offset < self._mm.size:
+            magic, _, version_size = struct.unpack_from('>3i', self._mm, offset)
+            if magic != self.MAGIC:
+                raise IOError('Corrupt TRR frame header at byte {} of {}.'.format(offset, path))
+            offset += 12 + version_size + (-version_size % 4)
+            sizes = struct.unpack_from('>13i', self._mm, offset)
+            (ir_size, e_size, box_size, vir_size, pres_size, top_size, sym_size,
+             x_size, v_size, f_size, n_atoms, _, _) = sizes
+            offset += 52
+            if box_size:
+                real_size = box_size // 9
+            elif x_size or v_size or f_size:
+                real_size = (x_size or v_size or f_size) // (3 * n_atoms)
+            else:
+                real_size = 4
+            offset += 2 * real_size
+            offset += ir_size + e_size + top_size + sym_size + box_size + vir_size + pres_size
+            if x_size:
+                self._offsets.append(offset)
+                self.n_atoms = n_atoms
+                self._dtype = np.dtype('>f{:d}'.format(real_size))
+            offset += x_size + v_size + f_size
+        self.n_frames = len(self._offsets)
+
+    def _read(self, start, stop):
+        size = 3 * self.n_atoms * self._dtype.itemsize
+        return np.stack([self._mm[offset:offset + size].view(self._dtype).reshape(-1, 3)
+                         for offset in self._offsets[start:stop]]).astype(np.float32)
+
+
+class LAMMPSTrjReader(TrajectoryReader):
+    """Offset-indexed reader for LAMMPS `.lammpstrj` dump files.
+
+    Positions are taken from the x/y/z, xu/yu/zu or (orthogonal boxes only)
+    xs/ys/zs columns and sorted by atom id when an id column is present.
+
+    """
+
+    def __init__(self, path):
+        super(LAMMPSTrjReader, self).__init__(path)
+        self._offsets = list()
+        offset = 0
+        with open(path, 'rb') as fh:
+            for line in fh:
+                if line.startswith(b'ITEM: TIMESTEP'):
+                    self._offsets.append(offset)
+                offset += len(line)
+        self.n_frames = len(self._offsets)
+        if self.n_frames:
+            self.n_atoms = len(self[0])
+
+    def _read(self, start, stop):
+        with open(self.path, 'rb') as fh:
+            return np.stack([self._read_frame(fh, offset)
+                             for offset in self._offsets[start:stop]])
+
+    def _read_frame(self, fh, offset):
+        fh.seek(offset)
+        fh.readline()
+        fh.readline()
+        fh.readline()
+        n_atoms = int(fh.readline())
+        bounds_header = fh.readline()
+        bounds = np.array([fh.readline().split()[:2] for _ in range(3)], dtype=float)
+        columns = fh.readline().decode('utf-8').split()[2:]
+        rows = [fh.readline().split() for _ in range(n_atoms)]
+
+        for names, scaled in ((('x', 'y', 'z'), False), (('xu', 'yu', 'zu'), False),
+                              (('xs', 'ys', 'zs'), True)):
+            if all(name in columns for name in names):
+                break
+        else:
+            raise IOError('No position columns found in {}.'.format(self.path))
+        indices = [columns.index(name) for name in names]
+        xyz = np.array([[row[i] for i in indices] for row in rows], dtype=np.float64)
+        if scaled:
+            if b'xy' in bounds_header:
+                raise NotImplementedError('Scaled coordinates in triclinic boxes '
+                                          'are not supported.')
+            xyz = bounds[:, 0] + xyz * (bounds[:, 1] - bounds[:, 0])
+        if 'id' in columns:
+            ids = np.array([int(row[columns.index('id')]) for row in rows])
+            xyz = xyz[np.argsort(ids)]
+        return xyz.astype(np.float32)
+
+
+class XTCReader(TrajectoryReader):
+    """Reader for compressed GROMACS `.xtc` files.
+
+    XTC frames are compressed and cannot be memory-mapped. Decompression and
+    seeking are delegated to `mdtraj`, which must be installed.
+
+    """
+
+    def __init__(self, path):
+        super(XTCReader, self).__init__(path)
+        try:
+            from mdtraj.formats import XTCTrajectoryFile
+        except ImportError:
+            raise ImportError('Reading .xtc files requires mdtraj '
+                              '(conda install -c conda-forge mdtraj).')
+        self._file = XTCTrajectoryFile(path, 'r')
+        self.n_frames = len(self._file)
+        if self.n_frames:
+            self.n_atoms = len(self[0])
+
+    def _read(self, start, stop):
+        self._file.seek(start)
+        xyz = self._file.read(n_frames=stop - start)[0]
+        return np.asarray(xyz, dtype=np.float32)
+
+
+READERS = {'.dcd': DCDReader,
+           '.trr': TRRReader,
+           '.lammpstrj': LAMMPSTrjReader,
+           '.xtc': XTCReader}
@@ -0,0 +1,215 @@
+"""Predict the walltime of batch jobs from the runtimes of earlier jobs.
+
+Asking for the maximum walltime keeps jobs out of backfill windows. Instead,
+`WalltimePredictor` records how long each finished task ran, together with
+its parameters and the number of atoms in its system, and requests the
+runtime of the most similar earlier tasks plus a safety margin.
+
+"""
+from collections import OrderedDict
+import json
+import math
+import os
+import threading
+import time
+
+from six import string_types
+
+from metamds.remote import CLUSTERS, job_finished
+
+DEFAULT_HISTORY = os.path.join('~', '.metamds', 'walltimes.json')
+
+
+class WalltimePredictor(object):
+    """Record task runtimes and predict walltimes for new tasks.
+
+    Runs are compared within the same simulation name and cluster. Among
+    the runs whose non-numeric parameters match, the `k` nearest in terms
+    of their numeric parameters and system size (on a log scale) are used.
+    Their runtimes, scaled linearly by system size, are combined into a
+    prediction by taking the longest one and multiplying it by `margin`.
+
+    Parameters
+    ----------
+    history_file : str, optional
+        JSON lines file with one record per finished task. Shared between
+        simulations, and created if it does not exist.
+    margin : float, optional, default=1.5
+        Factor applied to the predicted runtime.
+    minimum : float, optional, default=1800
+        Never request less than this many seconds.
+    k : int, optional, default=3
+        Number of earlier runs a prediction is based on.
+
+    """
+
+    def __init__(self, history_file=DEFAULT_HISTORY, margin=1.5, minimum=1800, k=3):
+        self.history_file = os.path.expanduser(history_file)
+        self.margin = margin
+        self.minimum = minimum
+        self.k = k
+        self._lock = threading.Lock()
+        self.history = list()
+        if os.path.isfile(self.history_file):
+            with open(self.history_file) as fh:
+                self.history = [json.loads(line) for line in fh if line.strip()]
+
+    def record(self, task, seconds):
+        """Add the runtime of a finished task to the history. """
+        record = OrderedDict([('simulation', task.simulation.name),
+                              ('cluster', _cluster(task.hostname)),
+                              ('task', task.name),
+                              ('parameters', _features(task.parameters)),
+                              ('n_atoms', system_size(task)),
+                              ('seconds', seconds),
+                              ('time', time.time())])
+        with self._lock:
+            self.history.append(record)
+            directory = os.path.dirname(self.history_file)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.history_file, 'a') as fh:
+                fh.write(json.dumps(record))
+                fh.write('\n')
+
+    def predict(self, task, hostname):
+        """Predict the walltime of a task in seconds.
+
+        Returns None if there are no earlier runs to base a prediction on.
+
+        """
+        parameters = _features(task.parameters)
+        n_atoms = system_size(task)
+        with self._lock:
+            runs = [run for run in self.history
+                    if run['simulation'] == task.simulation.name and
+                    run['cluster'] == _cluster(hostname)]
+        matching = [run for run in runs if _same_labels(run['parameters'], parameters)]
+        runs = matching or runs
+        if not runs:
+            return None
+
+        def distance(run):
+            features = dict(run['parameters'], n_atoms=run['n_atoms'])
+            query = dict(parameters, n_atoms=n_atoms)
+            return sum(_log_distance(features[key], value) ** 2
+                       for key, value in query.items()
+                       if _is_number(value) and _is_number(features.get(key)))
+
+        nearest = sorted(runs, key=distance)[:self.k]
+        seconds = list()
+        for run in nearest:
+            scale = 1.0
+            if n_atoms and run['n_atoms']:
+                scale = float(n_atoms) / run['n_atoms']
+            seconds.append(run['seconds'] * scale)
+        return max(self.minimum, self.margin * max(seconds))
+
+
+def system_size(task):
+    """Return the number of atoms in a task's system, or None if unknown.
+
+    The first `.gro` or `.pdb` file in the task directory is read, falling
+    back to the simulation's input files.
+
+    """
+    paths = [entry.path for entry in task.manifest().values()
+             if entry.category == 'topologies']
+    paths.extend(path for path in task.simulation.input_files
+                 if os.path.splitext(path)[1] in ('.gro', '.pdb'))
+    for path in paths:
+        try:
+            return count_atoms(path)
+        except (IOError, OSError, ValueError):
+            continue
+    return None
+
+
+def count_atoms(path):
+    """Return the number of atoms in a `.gro` or `.pdb` file. """
+    with open(path) as fh:
+        if path.endswith('.gro'):
+            fh.readline()
+            return int(fh.readline())
+        n_atoms = 0
+        for line in fh:
+            if line.startswith(('ATOM', 'HETATM')):
+                n_atoms += 1
+            elif line.startswith('ENDMDL'):
+                break
+        return n_atoms
+
+
+def parse_walltime(text):
+    """Convert a walltime such as "1-02:03:04", "02:03:04" or "03:04" to seconds. """
+    days, _, text = text.strip().rpartition('-')
+    seconds = 0
+    for part in text.split(':'):
+        seconds = 60 * seconds + float(part)
+    return seconds + 86400 * int(days or 0)
+
+
+def format_walltime(seconds):
+    """Format seconds as an "HH:MM:SS" walltime, rounding up to whole minutes. """
+    minutes = int(math.ceil(seconds / 60.0))
+    return '{:02d}:{:02d}:00'.format(minutes // 60, minutes % 60)
+
+
+def job_elapsed(status):
+    """Return the runtime in seconds of a successfully finished job.
+
+    Parameters
+    ----------
+    status : dict
+        A job status from `metamds.remote.query_jobs`.
+
+    Returns
+    -------
+    seconds : float or None
+        None if the job has not finished or failed.
+
+    """
+    if not status or not job_finished(status):
+        return None
+    if 'State' in status:
+        if status['State'] != 'COMPLETED' or not status.get('Elapsed'):
+            return None
+        return parse_walltime(status['Elapsed'])
+    if status.get('exit_status', '0') != '0' or 'resources_used.walltime' not in status:
+        return None
+    return parse_walltime(status['resources_used.walltime'])
+
+
+def _cluster(hostname):
+    for name in CLUSTERS:
+        if hostname and name in hostname:
+            return name
+    return hostname
+
+
+def _features(parameters):
+    """Keep the numbers and strings of a task's parameters. """
+    features = dict()
+    for key, value in (parameters or dict()).items():
+        if _is_number(value):
+            features[key] = float(value)
+        elif isinstance(value, string_types):
+            features[key] = value
+    return features
+
+
+def _same_labels(a, b):
+    """Return True if the non-numeric parameters of two runs agree. """
+    labels = [key for key in set(a) | set(b)
+              if not _is_number(a.get(key)) or not _is_number(b.get(key))]
+    return all(a.get(key) == b.get(key) for key in labels)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _log_distance(a, b):
+    if a > 0 and b > 0:
+        return math.log(a) - math.log(b)
+    return a - b
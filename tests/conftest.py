@@ -0,0 +1,18 @@
+import tempfile
+
+import pytest
+
+from metamds.log import close_all
+
+
+@pytest.fixture(autouse=True)
+def scratch_dir(tmpdir, monkeypatch):
+    """Create the temporary directories of a test under pytest's `tmpdir`.
+
+    The log files of the simulations created by the test are closed
+    afterwards, which stops their background threads.
+
+    """
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    yield
+    close_all()
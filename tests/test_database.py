@@ -1,5 +1,3 @@
-import pymongo as pm
-
 from pprint import pprint
 from metamds.db import *
 
@@ -32,7 +30,7 @@ port=27017
 db_name = "test_db"
 coll_name = "test_collection_mds_8679305"
 
-connection = pm.MongoClient(host, port, j=True)
+connection = get_client(host, port)
 database = connection[db_name]
 collection = database[coll_name] 
 
@@ -43,19 +41,16 @@ def test_add_doc_db():
 def test_update_doc():
     update_doc(existing_doc=doc_1, added_values=additional_info, host=host, port=port, 
                database=db_name, collection=coll_name)
-    assert collection.find(additional_info).count() == 1
+    assert collection.count_documents(additional_info) == 1
 
 def test_query_sim():
     cursor = query_sim(host=host, port=port, database=db_name, collection=coll_name, **query_info)
-    info = list()
-    for doc in cursor:
-        info = doc
-    assert cursor.count() == 1 and info["name"] == "TJJ"
+    docs = list(cursor)
+    assert len(docs) == 1 and docs[0]["name"] == "TJJ"
 
 def test_retrieve_all():
     cursor = retrieve_all(host=host, port=port, database=db_name, collection=coll_name)
-    pm_cursor = collection.find()
-    assert cursor.count() == pm_cursor.count()
+    assert len(list(cursor)) == collection.count_documents({})
 
 if __name__ == "__main__":
     test_add_doc_db()
@@ -0,0 +1,168 @@
+from collections import defaultdict, namedtuple
+import os
+import tempfile
+
+import pytest
+
+import metamds as mds
+from metamds.db import add_doc_db, add_docs_db, build_query, explain_query, update_doc
+
+UpdateOne = namedtuple('UpdateOne', ['filter', 'update', 'upsert'])
+BulkWriteResult = namedtuple('BulkWriteResult', ['upserted_count', 'modified_count'])
+
+
+class FakeCollection(object):
+    """Just enough of `pymongo.collection.Collection` for equality filters. """
+
+    def __init__(self, docs=()):
+        self.docs = [dict(doc) for doc in docs]
+        self.n_bulk_writes = 0
+
+    def find_all(self, doc_filter):
+        return [doc for doc in self.docs
+                if all(doc.get(key) == value for key, value in doc_filter.items())]
+
+    def count_documents(self, doc_filter, limit=0):
+        n_docs = len(self.find_all(doc_filter))
+        return min(n_docs, limit) if limit else n_docs
+
+    def insert_one(self, doc):
+        self.docs.append(dict(doc))
+
+    def update_one(self, doc_filter, update):
+        matches = self.find_all(doc_filter)
+        if matches:
+            matches[0].update(update.get('$set', {}))
+            if '$currentDate' in update:
+                matches[0].update((key, 'now') for key in update['$currentDate'])
+
+    def bulk_write(self, requests, ordered=True):
+        """Apply upserts made with the `UpdateOne` stand-in. """
+        self.n_bulk_writes += 1
+        upserted = modified = 0
+        for request in requests:
+            assert request.upsert
+            matches = self.find_all(request.filter)
+            if matches:
+                if '$set' in request.update:
+                    self.update_one(request.filter, request.update)
+                    modified += 1
+            else:
+                doc = dict(request.filter)
+                doc.update(request.update.get('$set', request.update.get('$setOnInsert')))
+                self.docs.append(doc)
+                upserted += 1
+        return BulkWriteResult(upserted, modified)
+
+
+def fake_client(docs=()):
+    """Return a client whose collections are `FakeCollection`s. """
+    client = defaultdict(lambda: defaultdict(FakeCollection))
+    client['shearing_simulations']['tasks'] = FakeCollection(docs)
+    return client
+
+
+def test_add_doc_db_updates_a_single_duplicate():
+    client = fake_client([{'T': 300, 'P': 1}])
+    collection = client['shearing_simulations']['tasks']
+    add_doc_db({'T': 300, 'P': 1}, update_duplicates=True, client=client)
+    assert collection.docs == [{'T': 300, 'P': 1, 'lastModified': 'now'}]
+
+    # Ambiguous updates are refused.
+    add_doc_db({'T': 300}, client=client)
+    add_doc_db({'T': 300}, update_duplicates=True, client=client)
+    assert 'lastModified' not in collection.docs[1]
+
+
+def test_update_doc():
+    client = fake_client([{'T': 300, 'P': 1}, {'T': 310, 'P': 1}])
+    collection = client['shearing_simulations']['tasks']
+    # Ambiguous updates are refused.
+    update_doc({'P': 1}, {'P': 100}, client=client)
+    update_doc({'T': 300}, {'P': 10}, client=client)
+    assert [doc['P'] for doc in collection.docs] == [10, 1]
+
+
+@pytest.fixture
+def fake_update_one(monkeypatch):
+    pytest.importorskip('pymongo')
+    monkeypatch.setattr('pymongo.UpdateOne', UpdateOne)
+
+
+def test_add_docs_db_counts(fake_update_one):
+    client = fake_client([{'output_dir': '/a/', 'T': 300}])
+    collection = client['shearing_simulations']['tasks']
+    docs = [{'output_dir': '/a/', 'T': 310}, {'output_dir': '/b/', 'T': 320}]
+
+    counts = add_docs_db(docs, key=['output_dir'], client=client)
+    assert counts == {'inserted': 1, 'updated': 0, 'skipped': 1}
+    assert collection.docs[0]['T'] == 300
+
+    counts = add_docs_db(docs, key=['output_dir'], update_duplicates=True, client=client)
+    assert counts == {'inserted': 0, 'updated': 2, 'skipped': 0}
+    assert [doc['T'] for doc in collection.docs] == [310, 320]
+    assert collection.n_bulk_writes == 2
+
+
+def test_add_docs_db_collapses_duplicate_keys(fake_update_one):
+    client = fake_client()
+    collection = client['shearing_simulations']['tasks']
+    docs = [{'output_dir': '/a/', 'T': 300, '_id': 1}, {'output_dir': '/a/', 'T': 310}]
+
+    counts = add_docs_db(docs, key=['output_dir'], client=client)
+    assert counts == {'inserted': 1, 'updated': 0, 'skipped': 1}
+    # The last doc with a key wins, and `_id`s are left to the database.
+    assert collection.docs == [{'output_dir': '/a/', 'T': 310}]
+
+    with pytest.raises(ValueError):
+        add_docs_db([{'T': 300}], key=['output_dir'], client=client)
+
+
+def test_add_to_db_upserts_on_output_dir(fake_update_one):
+    sim = mds.Simulation(name='db', input_dir=tempfile.mkdtemp(prefix='metamds_test_'))
+    sim.parametrize(T=300)
+    sim.db_client = fake_client()
+    collection = sim.db_client['shearing_simulations']['tasks']
+
+    assert sim.add_to_db(T=300) == {'inserted': 1, 'updated': 0, 'skipped': 0}
+    assert sim.add_to_db(T=300) == {'inserted': 0, 'updated': 0, 'skipped': 1}
+    doc, = collection.docs
+    assert doc['output_dir'] == os.path.join(sim.output_dir, 'task_0', '')
+    assert collection.n_bulk_writes == 2
+
+
+def test_build_query():
+    query = build_query(T=[300, 310], P=[1], solvent='water', rate={'$gte': 0.1, '$lt': 1})
+    assert query == {'T': {'$in': [300, 310]}, 'P': 1, 'solvent': 'water',
+                     'rate': {'$gte': 0.1, '$lt': 1}}
+    assert build_query(T=(300,)) == {'T': 300}
+
+
+@pytest.mark.parametrize('kwargs', [dict(), dict(T=[]), dict(T={'$where': 'true'})])
+def test_build_query_rejects(kwargs):
+    with pytest.raises(ValueError):
+        build_query(**kwargs)
+
+
+class ExplainedCursor(object):
+    def explain(self):
+        index_scan = {'stage': 'IXSCAN', 'indexName': 'T_1'}
+        return {'queryPlanner': {'winningPlan': {'stage': 'FETCH', 'inputStage': index_scan}},
+                'executionStats': {'nReturned': 2, 'totalDocsExamined': 2,
+                                   'totalKeysExamined': 3, 'executionTimeMillis': 0}}
+
+
+def test_explain_query():
+    queries = list()
+
+    class Collection(object):
+        def find(self, query, projection):
+            queries.append(query)
+            return ExplainedCursor()
+
+    report = explain_query(client={'shearing_simulations': {'tasks': Collection()}},
+                           T=[300, 310])
+    assert queries == [{'T': {'$in': [300, 310]}}]
+    assert report['stages'] == 'FETCH <- IXSCAN'
+    assert report['index'] == 'T_1'
+    assert (report['returned'], report['docs_examined'], report['keys_examined']) == (2, 2, 3)
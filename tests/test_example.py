@@ -22,6 +22,6 @@ def test_lysozyme_tutorial():
     minimize = mds.Task(name='minimize', simulation=tutorial, script=script)
 
     tutorial.add_task(build)
-    tutorial.add_task(minimize)
-    tutorial.execute()
+    tutorial.add_task(minimize, depends_on=build)
+    tutorial.execute_all()
     print(tutorial.output_dir)
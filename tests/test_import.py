@@ -0,0 +1,9 @@
+import subprocess
+import sys
+
+
+def test_backends_are_imported_lazily():
+    code = ('import sys, metamds, metamds.db, metamds.remote; '
+            'print(" ".join(name for name in ("paramiko", "pymongo") if name in sys.modules))')
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.strip() == b''
@@ -0,0 +1,81 @@
+import os
+import shlex
+import sys
+import threading
+import time
+
+import pytest
+
+from metamds.io import MAX_LINE, RSYNC_SSH, cmd_line, rsync_from, stream_cmd_line
+
+
+def test_cmd_line_pipe():
+    out, err = cmd_line('echo hello world | wc -w')
+    assert out.split() == [b'2']
+    assert err == b''
+
+
+def test_stream_cmd_line_drains_every_stage():
+    # Enough stderr from the first stage to fill a pipe buffer.
+    noisy = ('{} -c "import sys; [sys.stderr.write(100 * \'x\' + chr(10)) '
+             'for _ in range(5000)]"'.format(sys.executable))
+    out, err = list(), list()
+    returncode = stream_cmd_line('{} | cat'.format(noisy),
+                                 stdout_callback=out.append,
+                                 stderr_callback=err.append, timeout=30)
+    assert returncode == 0
+    assert len(err) == 5000
+    assert out == []
+
+
+def test_stream_cmd_line_timeout():
+    start = time.time()
+    with pytest.raises(RuntimeError):
+        stream_cmd_line('sleep 10', timeout=0.2)
+    assert time.time() - start < 5
+
+
+def test_stream_cmd_line_cancel():
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    with pytest.raises(RuntimeError):
+        stream_cmd_line('sleep 10', cancel=cancel)
+
+
+def test_stream_cmd_line_splits_progress_lines():
+    lines = list()
+    stream_cmd_line('printf "step 1\\rstep 2\\r\\ndone\\nlast"', stdout_callback=lines.append)
+    assert lines == ['step 1', 'step 2', 'done', 'last']
+
+
+def test_stream_cmd_line_bounds_line_length():
+    lines = list()
+    stream_cmd_line('{} -c "print(200000 * \'x\')"'.format(sys.executable),
+                    stdout_callback=lines.append)
+    assert sum(len(line) for line in lines) == 200000
+    assert max(len(line) for line in lines) <= MAX_LINE
+
+
+def test_rsync_shares_ssh_connections(monkeypatch):
+    commands = list()
+    monkeypatch.setattr('metamds.io.cmd_line',
+                        lambda cmd: commands.append(shlex.split(cmd)) or (b'', b''))
+    rsync_from(flags='-r', src='/scratch/tmp.1/', dst='.', user='user', host='rahman')
+    assert commands == [['rsync', '-e', RSYNC_SSH, '-r', 'user@rahman:/scratch/tmp.1/', '.']]
+    assert 'ControlMaster=auto' in RSYNC_SSH
+
+
+@pytest.mark.skipif(not hasattr(os, 'sched_setaffinity'), reason='Linux only')
+def test_stream_cmd_line_pins_threads_from_the_start():
+    before = os.sched_getaffinity(0)
+    core = min(before)
+    # A thread started right away must run on the pinned core as well.
+    script = ('import os, threading; out = []; '
+              'thread = threading.Thread(target=lambda: out.append(os.sched_getaffinity(0))); '
+              'thread.start(); thread.join(); print(sorted(out[0]))')
+    lines = list()
+    stream_cmd_line('{} -c "{}"'.format(sys.executable, script), affinity=[core],
+                    stdout_callback=lines.append)
+    assert lines == ['[{}]'.format(core)]
+    # The calling thread is left as it was.
+    assert os.sched_getaffinity(0) == before
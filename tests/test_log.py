@@ -0,0 +1,66 @@
+import gzip
+import os
+import tempfile
+
+import metamds as mds
+from metamds.log import close_logger, flush, get_logger
+
+
+def test_same_name_does_not_stack_handlers():
+    input_dir = tempfile.mkdtemp(prefix='metamds_test_')
+    output_dir = tempfile.mkdtemp(prefix='metamds_test_')
+    first = mds.Simulation(name='logs', input_dir=input_dir, output_dir=output_dir)
+    second = mds.Simulation(name='logs', input_dir=input_dir, output_dir=output_dir)
+    assert len(second.info.handlers) == 1
+
+    second.info.info('once')
+    second.flush_logs()
+    with open(os.path.join(output_dir, 'logs_info.log')) as fh:
+        assert fh.read().count('once') == 1
+
+    # The file stays open for the simulation that is still in use.
+    second.close()
+    first.info.info('after')
+    first.flush_logs()
+    with open(os.path.join(output_dir, 'logs_info.log')) as fh:
+        assert 'after' in fh.read()
+    first.close()
+    assert not first.info.handlers
+
+
+def test_same_name_in_another_output_dir_keeps_its_own_log():
+    input_dir = tempfile.mkdtemp(prefix='metamds_test_')
+    first_dir = tempfile.mkdtemp(prefix='metamds_test_')
+    second_dir = tempfile.mkdtemp(prefix='metamds_test_')
+    first = mds.Simulation(name='logs', input_dir=input_dir, output_dir=first_dir)
+    second = mds.Simulation(name='logs', input_dir=input_dir, output_dir=second_dir)
+    assert first.info is not second.info
+
+    first.info.info('first')
+    second.info.info('second')
+    # Closing one simulation leaves the other one's log open.
+    first.close()
+    first.close()
+    second.info.info('still second')
+    second.flush_logs()
+    with open(os.path.join(first_dir, 'logs_info.log')) as fh:
+        assert fh.read().split(' - ')[-1] == 'first\n'
+    with open(os.path.join(second_dir, 'logs_info.log')) as fh:
+        text = fh.read()
+    assert 'first' not in text
+    assert 'second' in text and 'still second' in text
+    second.close()
+
+
+def test_rotated_logs_are_compressed():
+    log_file = os.path.join(tempfile.mkdtemp(prefix='metamds_test_'), 'rotate.log')
+    logger = get_logger('rotate', log_file, max_bytes=1000, backup_count=2)
+    for i in range(100):
+        logger.info('line {:d}'.format(i))
+    flush(logger)
+    close_logger(logger)
+
+    assert os.path.getsize(log_file) <= 1000
+    with gzip.open(log_file + '.1.gz') as fh:
+        assert b'line' in fh.read()
+    assert not os.path.exists(log_file + '.3.gz')
@@ -0,0 +1,556 @@
+from collections import namedtuple
+import io
+import itertools
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import pytest
+
+import metamds as mds
+from metamds.dedup import remote_digests
+from metamds.io import file_digest
+from metamds.remote import (REMOTE_STORE, HostBalancer, RemoteInputStore, SSHPool,
+                            job_ended, job_finished, parse_qstat, parse_sacct)
+from metamds.task import ARRAY_SCRIPT, job_profile
+
+QSTAT = """Job Id: 1234.rahman.vuse.vanderbilt.edu
+    Job_Name = task_0
+    job_state = C
+    resources_used.walltime = 01:02:03
+    Variable_List = PBS_O_HOME=/home/user,
+\tPBS_O_LOGNAME=user
+Job Id: 1235[2].rahman.vuse.vanderbilt.edu
+    Job_Name = project
+    job_state = R
+"""
+
+SACCT = """1300_0|project|COMPLETED|0:0|00:10:00|00:19:30||2017-01-01T00:00:00|2017-01-01T00:10:00
+1300_0.batch|batch|COMPLETED|0:0|00:10:00|00:19:30|2048K|2017-01-01T00:00:00|2017-01-01T00:10:00
+1300_0.0|gmx|COMPLETED|0:0|00:09:00|00:18:00|1.5G|2017-01-01T00:00:00|2017-01-01T00:09:00
+1300_1|project|RUNNING|0:0|00:10:00|00:00:00||2017-01-01T00:00:00|Unknown
+"""
+
+
+def test_parse_qstat():
+    statuses = parse_qstat(QSTAT)
+    assert list(statuses) == ['1234', '1235[2]']
+    assert statuses['1234']['resources_used.walltime'] == '01:02:03'
+    assert statuses['1234']['Variable_List'].endswith('PBS_O_LOGNAME=user')
+    assert job_finished(statuses['1234'])
+    assert not job_finished(statuses['1235[2]'])
+
+
+def test_job_ended():
+    assert job_ended({'job_state': 'C'}, submitted_at=time.time())
+    assert not job_ended({'job_state': 'R'}, listed=True)
+    # Not listed: queued if just submitted, gone if listed before or old.
+    assert not job_ended({}, submitted_at=time.time())
+    assert job_ended({}, listed=True, submitted_at=time.time())
+    assert job_ended({}, submitted_at=time.time() - 600)
+    assert job_ended({}, submitted_at=time.time() - 1, grace=0.5)
+    assert job_ended({})
+
+
+def test_parse_sacct():
+    statuses = parse_sacct(SACCT)
+    assert list(statuses) == ['1300_0', '1300_1']
+    assert statuses['1300_0']['MaxRSS'] == '1.5G'
+    assert statuses['1300_0']['Elapsed'] == '00:10:00'
+    assert job_finished(statuses['1300_0'])
+    assert not job_finished(statuses['1300_1'])
+    assert list(statuses['1300_0']['steps']) == ['batch', '0']
+
+
+def test_job_profile():
+    mdrun = job_profile(parse_sacct(SACCT)['1300_0'])[1]
+    assert mdrun['command'] == 'gmx'
+    assert mdrun['returncode'] == 0
+    assert mdrun['wall_time'] == 540
+    assert mdrun['cpu_time'] == 1080
+    assert mdrun['max_rss'] == 1.5 * 2**30
+
+    job, = job_profile(parse_qstat(QSTAT)['1234'])
+    assert job['wall_time'] == 3723
+
+
+class Transport(object):
+    def __init__(self):
+        self.active = True
+        self.n_probes = 0
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        self.n_probes += 1
+
+
+class SSHClient(object):
+    """A connection as opened by `SSHPool._connect`. """
+
+    def __init__(self):
+        self.transport = Transport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def open_sftp(self):
+        return SFTPSession()
+
+    def close(self):
+        self.closed = True
+
+
+class SFTPSession(object):
+    def __init__(self):
+        self.channel = Channel()
+
+    def get_channel(self):
+        return self.channel
+
+    def close(self):
+        self.channel.closed = True
+
+
+class Channel(object):
+    closed = False
+
+
+def _fake_pool(monkeypatch, **kwargs):
+    pool = SSHPool(**kwargs)
+    monkeypatch.setattr(pool, '_connect', lambda hostname, username: SSHClient())
+    return pool
+
+
+def test_ssh_pool_reuses_connections(monkeypatch):
+    pool = _fake_pool(monkeypatch)
+    client = pool.client('rahman', 'user')
+    assert pool.client('rahman', 'user') is client
+    assert pool.client('rahman', 'other') is not client
+    assert len(pool) == 2
+
+    pool.close()
+    assert client.closed and len(pool) == 0
+
+
+def test_ssh_pool_reconnects_dropped_connections(monkeypatch):
+    pool = _fake_pool(monkeypatch, idle_timeout=0)
+    client = pool.client('rahman', 'user')
+    # Idle connections are probed before they are handed out again.
+    time.sleep(0.01)
+    assert pool.client('rahman', 'user') is client
+    assert client.transport.n_probes == 1
+
+    client.transport.active = False
+    reconnected = pool.client('rahman', 'user')
+    assert reconnected is not client and client.closed
+
+
+def test_ssh_pool_opens_an_sftp_session_per_thread(monkeypatch):
+    pool = _fake_pool(monkeypatch)
+    sftp = pool.sftp('rahman', 'user')
+    assert pool.sftp('rahman', 'user') is sftp
+
+    other = list()
+    thread = threading.Thread(target=lambda: other.append(pool.sftp('rahman', 'user')))
+    thread.start()
+    thread.join()
+    assert other[0] is not sftp
+
+    sftp.close()
+    assert pool.sftp('rahman', 'user') is not sftp
+
+
+class FakeClient(object):
+    """Answers `squeue` with a fixed queue and `sacct` with job states.
+
+    `squeue` waits for `gate` to be set, and jobs in `unlisted` are left out.
+
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.finished = set()
+        self.unlisted = set()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def exec_command(self, cmd):
+        if cmd.startswith('squeue'):
+            self.gate.wait()
+            out = ''.join('{}\n'.format(i) for i in range(self.depth))
+        else:
+            job_ids = cmd.split(' -j ')[1].split()[0].split(',')
+            out = ''.join('{}|x|{}|0:0|||||\n'.format(
+                job_id, 'COMPLETED' if job_id in self.finished else 'RUNNING')
+                for job_id in job_ids if job_id not in self.unlisted)
+        return None, io.BytesIO(out.encode('utf-8')), io.BytesIO(b'')
+
+
+class FakePool(object):
+    def __init__(self, clients):
+        self.clients = clients
+
+    def client(self, hostname, username):
+        return self.clients[hostname]
+
+
+def test_host_balancer():
+    clients = {'edison.nersc.gov': FakeClient(3), 'login.accre.vanderbilt.edu': FakeClient(1)}
+    balancer = HostBalancer(FakePool(clients), sorted(clients), username='user',
+                            max_jobs={'login.accre.vanderbilt.edu': 1}, poll_interval=0)
+
+    # The shorter queue wins until its cap is reached.
+    assert balancer.acquire() == 'login.accre.vanderbilt.edu'
+    balancer.submitted('login.accre.vanderbilt.edu', '10')
+    assert balancer.acquire() == 'edison.nersc.gov'
+    balancer.submitted('edison.nersc.gov', '20')
+
+    # Once its job has finished, the slot is free again.
+    clients['login.accre.vanderbilt.edu'].finished.add('10')
+    assert balancer.acquire() == 'login.accre.vanderbilt.edu'
+
+
+def _acquire_or_cancel(balancer, wait=0.05):
+    """Return the host from `balancer.acquire`, or None if it has to wait. """
+    cancel = threading.Event()
+    timer = threading.Timer(wait, cancel.set)
+    timer.start()
+    try:
+        return balancer.acquire(cancel=cancel)
+    except RuntimeError:
+        return None
+    finally:
+        timer.cancel()
+
+
+def test_host_balancer_keeps_unlisted_jobs():
+    host = 'login.accre.vanderbilt.edu'
+    client = FakeClient(0)
+    balancer = HostBalancer(FakePool({host: client}), [host], username='user',
+                            max_jobs=1, poll_interval=0)
+
+    # Not listed yet right after submission.
+    assert balancer.acquire() == host
+    balancer.submitted(host, '10')
+    client.unlisted.add('10')
+    assert _acquire_or_cancel(balancer) is None
+    # Gone for longer than the grace period.
+    balancer.grace = 0
+    assert balancer.acquire() == host
+    balancer.submitted(host, '11')
+
+    # Listed while running, then dropped by the batch system.
+    balancer.grace = 60
+    assert _acquire_or_cancel(balancer) is None
+    client.unlisted.add('11')
+    assert balancer.acquire() == host
+
+
+def test_host_balancer_probes_without_the_lock():
+    host = 'login.accre.vanderbilt.edu'
+    client = FakeClient(0)
+    balancer = HostBalancer(FakePool({host: client}), [host], username='user',
+                            poll_interval=0)
+    assert balancer.acquire() == host
+
+    client.gate.clear()
+    acquiring = threading.Thread(target=balancer.acquire)
+    acquiring.start()
+    # Submissions are recorded while the other thread waits for `squeue`.
+    submitting = threading.Thread(target=balancer.submitted, args=(host, '10'))
+    submitting.start()
+    submitting.join(timeout=5)
+    assert not submitting.is_alive()
+    assert acquiring.is_alive()
+    client.gate.set()
+    acquiring.join(timeout=5)
+    assert not acquiring.is_alive()
+
+
+class LocalClient(object):
+    """Runs commands on this machine, as if it were the remote host. """
+
+    def exec_command(self, cmd):
+        proc = subprocess.Popen(['sh', '-c', cmd], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        return None, io.BytesIO(out), io.BytesIO(err)
+
+
+SFTPAttributes = namedtuple('SFTPAttributes', ['filename', 'st_size', 'st_mtime'])
+
+
+class LocalSFTP(object):
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def listdir_attr(self, path):
+        attrs = list()
+        for name in os.listdir(path):
+            stat = os.stat(os.path.join(path, name))
+            attrs.append(SFTPAttributes(name, stat.st_size, stat.st_mtime))
+        return attrs
+
+    def remove(self, path):
+        os.remove(path)
+
+
+def test_remote_input_store():
+    scratch = tempfile.mkdtemp(prefix='metamds_test_')
+    store = RemoteInputStore(LocalClient(), LocalSFTP(), os.path.join(scratch, 'store'),
+                             max_bytes=150, min_age=50)
+    for digest, age in (('old', 200), ('new', 100), ('used', 300), ('recent', 10)):
+        path = os.path.join(store.root, digest)
+        with open(path, 'w') as fh:
+            fh.write(100 * 'x')
+        os.utime(path, (time.time() - age, time.time() - age))
+    assert store.missing(['old', 'used', 'other']) == {'other'}
+
+    assert store.link({'conf.gro': 'used', 'topol.top': 'gone'},
+                      os.path.join(scratch, 'sim')) == {'gone'}
+    assert os.path.samefile(os.path.join(scratch, 'sim', 'conf.gro'),
+                            os.path.join(store.root, 'used'))
+
+    # Linking counts as a use, so the other two files are older. Recently
+    # used files are kept even though the store is too large.
+    assert store.evict(keep={'used'}) == ['old', 'new']
+    assert os.path.isfile(os.path.join(scratch, 'sim', 'conf.gro'))
+    assert os.path.isfile(os.path.join(store.root, 'recent'))
+
+
+def test_inputs_evicted_before_linking_are_uploaded_again(monkeypatch):
+    sim = mds.Simulation(name='store', input_dir=tempfile.mkdtemp(prefix='metamds_test_'))
+    for name in ('conf.gro', 'topol.top'):
+        with open(os.path.join(sim.input_dir, name), 'w') as fh:
+            fh.write(name)
+    sim.input_files = sim._scan_input_files()
+    digests = dict((os.path.basename(path), file_digest(path)) for path in sim.input_files)
+
+    scratch = tempfile.mkdtemp(prefix='metamds_test_')
+    root = os.path.join(scratch, REMOTE_STORE)
+    os.mkdir(root)
+    for path in sim.input_files:
+        shutil.copy(path, os.path.join(root, digests[os.path.basename(path)]))
+
+    client = LocalClient()
+    client.hostname, client.username = 'rahman.vuse.vanderbilt.edu', 'user'
+    monkeypatch.setattr(sim.ssh_pool, 'sftp', lambda hostname, username: LocalSFTP())
+    uploads = list()
+
+    def rsync_to(flags, src, dst, user, host, logger=None):
+        uploads.append(sorted(os.listdir(src)))
+        for name in os.listdir(src):
+            shutil.copy(os.path.join(src, name), dst)
+    monkeypatch.setattr('metamds.simulation.rsync_to', rsync_to)
+
+    # Another simulation evicts a file after it was found in the store.
+    link = RemoteInputStore.link
+
+    def evict_then_link(store, files, dest_dir):
+        if not uploads:
+            os.remove(os.path.join(root, digests['topol.top']))
+        return link(store, files, dest_dir)
+    monkeypatch.setattr(RemoteInputStore, 'link', evict_then_link)
+
+    remote_dir = os.path.join(scratch, 'store')
+    assert sim._link_stored_inputs(client, remote_dir) == []
+    assert uploads == [[digests['topol.top']]]
+    for name, digest in digests.items():
+        assert os.path.samefile(os.path.join(remote_dir, name), os.path.join(root, digest))
+
+
+class BatchClient(object):
+    """Accepts job submissions and reports a queue of fixed length. """
+
+    def __init__(self, hostname, depth=0):
+        self.hostname = hostname
+        self.username = 'user'
+        self.depth = depth
+        self.job_ids = itertools.count(1000)
+        self.submitted = list()
+
+    def exec_command(self, cmd):
+        if cmd.startswith('qsub'):
+            self.submitted.append(cmd.split()[-1])
+            # qsub reports job arrays as e.g. "1234[].server".
+            array = '[]' if cmd.endswith('_array.pbs') else ''
+            out = '{}{}.{}\n'.format(next(self.job_ids), array, self.hostname)
+        elif cmd.startswith('sbatch'):
+            self.submitted.append(cmd.split()[-1])
+            out = 'Submitted batch job {}\n'.format(next(self.job_ids))
+        else:
+            out = ''.join('{}\n'.format(i) for i in range(self.depth))
+        return None, _ChannelFile(out.encode('utf-8')), _ChannelFile(b'')
+
+
+class _ChannelFile(io.BytesIO):
+    """Like paramiko's channel files, `readlines` decodes while `read` does not. """
+
+    def readlines(self):
+        return [line.decode('utf-8') for line in super(_ChannelFile, self).readlines()]
+
+
+class MemorySFTP(object):
+    """Keeps the files written through it in `files`. """
+
+    def __init__(self):
+        self.files = dict()
+
+    def open(self, path, mode='r'):
+        return _MemoryFile(self.files, path)
+
+
+class _MemoryFile(io.StringIO):
+    def __init__(self, files, path):
+        super(_MemoryFile, self).__init__()
+        self.files = files
+        self.path = path
+
+    def close(self):
+        self.files[self.path] = self.getvalue()
+        super(_MemoryFile, self).close()
+
+
+def _remote_simulation(monkeypatch, name, clients):
+    """Return a simulation that submits to `clients`, and their SFTP sessions. """
+    sim = mds.Simulation(name=name, input_dir=tempfile.mkdtemp(prefix='metamds_test_'))
+    sftps = dict((hostname, MemorySFTP()) for hostname in clients)
+    monkeypatch.setattr(sim.ssh_pool, 'client', lambda hostname, username: clients[hostname])
+    monkeypatch.setattr(sim.ssh_pool, 'sftp', lambda hostname, username: sftps[hostname])
+
+    def create_remote_dir(client, hostname, username, exist_ok=False):
+        sim.remote_dirs.setdefault(hostname, '/scratch/{}'.format(hostname.split('.')[0]))
+    monkeypatch.setattr(sim, 'create_remote_dir', create_remote_dir)
+    return sim, sftps
+
+
+def test_remote_dependents_wait_for_upstream_jobs(monkeypatch):
+    client = BatchClient('rahman.vuse.vanderbilt.edu')
+    sim, sftps = _remote_simulation(monkeypatch, 'remote_dependencies',
+                                    {client.hostname: client})
+    build = mds.Task(name='build', simulation=sim, script=('gmx grompp',))
+    solvate = mds.Task(name='solvate', simulation=sim, script=('gmx solvate',))
+    minimize = mds.Task(name='minimize', simulation=sim, script=('gmx mdrun',))
+    sim.add_task(build)
+    sim.add_task(solvate)
+    sim.add_task(minimize, depends_on=[build, solvate])
+    sim.execute_all(hostname=client.hostname, username='user')
+
+    scripts = sftps[client.hostname].files
+    assert 'afterok' not in scripts['/scratch/rahman/build.pbs']
+    assert '#PBS -W depend=afterok:{}:{}\n'.format(build.pbs_id, solvate.pbs_id) in \
+        scripts['/scratch/rahman/minimize.pbs']
+
+
+def test_balanced_dependents_stay_with_their_upstream_task(monkeypatch):
+    clients = dict((client.hostname, client) for client in (
+        BatchClient('rahman.vuse.vanderbilt.edu', depth=0),
+        BatchClient('edison.nersc.gov', depth=1)))
+    sim, sftps = _remote_simulation(monkeypatch, 'remote_pinned', clients)
+    build = mds.Task(name='build', simulation=sim, script=('gmx grompp',))
+    md = mds.Task(name='md', simulation=sim, script=('gmx mdrun',))
+    analyze = mds.Task(name='analyze', simulation=sim, script=('gmx energy',))
+    sim.add_task(build)
+    sim.add_task(md)
+    sim.add_task(analyze, depends_on=md)
+    sim.execute_all(hostname=sorted(clients), username='user')
+
+    assert build.hostname == 'rahman.vuse.vanderbilt.edu'
+    # The shorter queue is rahman's, but the outputs of md are on edison.
+    assert md.hostname == analyze.hostname == 'edison.nersc.gov'
+    assert '#SBATCH --dependency=afterok:{}\n'.format(md.pbs_id) in \
+        sftps['edison.nersc.gov'].files['/scratch/edison/analyze.pbs']
+
+
+def test_remote_digests_only_hash_matching_files():
+    remote_dir = tempfile.mkdtemp(prefix='metamds_test_')
+    os.mkdir(os.path.join(remote_dir, 'md'))
+    for name in ('ener.xvg', 'traj.xtc', 'topol.top'):
+        with open(os.path.join(remote_dir, 'md', name), 'w') as fh:
+            fh.write(name)
+
+    digests = remote_digests(LocalClient(), remote_dir, ['md', 'missing'],
+                             patterns=['*.xvg', '*.top'])
+    assert sorted(digests) == ['md/ener.xvg', 'md/topol.top']
+    assert digests['md/ener.xvg'] == file_digest(os.path.join(remote_dir, 'md', 'ener.xvg'))
+    assert len(remote_digests(LocalClient(), remote_dir, ['md'])) == 3
+    assert remote_digests(LocalClient(), remote_dir, ['md'], patterns=[]) == dict()
+
+
+@pytest.mark.parametrize('hostname, directive, index, job_ids', [
+    ('rahman.vuse.vanderbilt.edu', '#PBS -t 0-2', '$PBS_ARRAYID',
+     ['1000[0]', '1000[1]', '1000[2]']),
+    ('edison.nersc.gov', '#SBATCH --array=0-2', '$SLURM_ARRAY_TASK_ID',
+     ['1000_0', '1000_1', '1000_2'])])
+def test_submit_array(monkeypatch, hostname, directive, index, job_ids):
+    client = BatchClient(hostname)
+    sim, sftps = _remote_simulation(monkeypatch, 'array_{}'.format(hostname.split('.')[0]),
+                                    {hostname: client})
+    sim.template = ['gmx mdrun']
+    tasks = sim.parametrize_grid(T=[300, 310, 320])
+    assert sim.submit_array(tasks, hostname, 'user') == '1000'
+
+    remote_dir = sim.remote_dirs[hostname]
+    task_list = os.path.join(remote_dir, '{}_array.tasks'.format(sim.name))
+    array_script = os.path.join(remote_dir, '{}_array.pbs'.format(sim.name))
+    assert client.submitted == [array_script]
+    files = sftps[hostname].files
+    assert files[task_list] == 'task_0\ntask_1\ntask_2\n'
+    assert '{}\n'.format(directive) in files[array_script]
+    assert 'sed -n "$(({} + 1))p" {}'.format(index, task_list) in files[array_script]
+    assert files[array_script].endswith('. ./{}\n'.format(ARRAY_SCRIPT))
+
+    with open(os.path.join(tasks[1].output_dir, ARRAY_SCRIPT)) as fh:
+        assert fh.read() == 'gmx mdrun\n'
+    assert [task.pbs_id for task in tasks] == job_ids
+    assert len(set(task.submitted_at for task in tasks)) == 1
+    assert tasks[0].submitted_at <= time.time()
+    assert [task.array_index for task in tasks] == [0, 1, 2]
+
+
+def test_status_all_queries_each_host_once(monkeypatch):
+    rahman = BatchClient('rahman.vuse.vanderbilt.edu')
+    edison = BatchClient('edison.nersc.gov')
+    sim, _ = _remote_simulation(monkeypatch, 'status_all',
+                                dict((client.hostname, client) for client in (rahman, edison)))
+    queries = list()
+
+    def query_jobs(client, submit_line, job_ids):
+        queries.append((client.hostname, submit_line, sorted(job_ids)))
+        return dict((job_id, {'job_state': 'R'}) for job_id in job_ids)
+    monkeypatch.setattr('metamds.simulation.query_jobs', query_jobs)
+
+    def submit(name, client):
+        task = mds.Task(name=name, simulation=sim, script=('gmx mdrun',))
+        sim.add_task(task)
+        task.execute(hostname=client.hostname, username='user')
+        return task
+
+    for name, client in (('a', rahman), ('b', rahman), ('c', edison)):
+        submit(name, client)
+    statuses = sim.status_all()
+    assert sorted(queries) == [('edison.nersc.gov', 'sbatch', ['1000']),
+                               ('rahman.vuse.vanderbilt.edu', 'qsub', ['1000', '1001'])]
+    assert dict(statuses) == dict((name, {'job_state': 'R'}) for name in 'abc')
+
+    # Reused within the TTL, unless asked not to.
+    assert sim.status_all() is statuses
+    assert len(queries) == 2
+    sim.status_all(ttl=0)
+    assert len(queries) == 4
+
+    # New submissions are queried right away.
+    submit('d', rahman)
+    assert sim.status_all()['d'] == {'job_state': 'R'}
+    assert len(queries) == 6
+    array_task = mds.Task(name='e', simulation=sim, script=('gmx mdrun',))
+    sim.add_task(array_task)
+    sim.submit_array([array_task], rahman.hostname, 'user')
+    assert sim.status_all()['e'] == {'job_state': 'R'}
+    assert len(queries) == 8
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import threading
+
+import pytest
+
+import metamds as mds
+from metamds.resources import LocalResources, parse_cpulist
+
+
+def test_parse_cpulist():
+    assert parse_cpulist('0-3,8,10-11\n') == {0, 1, 2, 3, 8, 10, 11}
+
+
+def test_acquire_prefers_one_numa_node():
+    resources = LocalResources(cores=range(8), memory=100)
+    resources.nodes = [frozenset(range(4)), frozenset(range(4, 8))]
+
+    first = resources.acquire(3, memory=60)
+    second = resources.acquire(2)
+    # Two cores no longer fit on the first node, so the second task goes to
+    # the other one rather than straddling both.
+    assert set(first.cores) <= resources.nodes[0]
+    assert set(second.cores) <= resources.nodes[1]
+
+    with pytest.raises(ValueError):
+        resources.acquire(9)
+    with pytest.raises(ValueError):
+        resources.acquire(1, memory=101)
+
+    # Not enough memory left, so this waits for the first task to finish.
+    acquired = list()
+    waiter = threading.Thread(target=lambda: acquired.append(resources.acquire(1, memory=50)))
+    waiter.start()
+    waiter.join(0.2)
+    assert not acquired
+    resources.release(first)
+    waiter.join(5)
+    assert acquired and resources.free_memory == 50
+
+
+def test_execute_all_with_resources():
+    cores = sorted(os.sched_getaffinity(0))[:1] if hasattr(os, 'sched_getaffinity') else [0]
+    sim = mds.Simulation(name='resources', input_dir=tempfile.mkdtemp(prefix='metamds_test_'))
+    for i in range(3):
+        task = mds.Task(name='md_{}'.format(i), simulation=sim,
+                        script=('sh -c "echo $OMP_NUM_THREADS > omp.txt"',))
+        task.cores = 1
+        sim.add_task(task)
+
+    sim.execute_all(max_workers=3, resources=LocalResources(cores=cores))
+
+    for task in sim.tasks():
+        with open(os.path.join(task.output_dir, 'omp.txt')) as fh:
+            assert fh.read().strip() == '1'
@@ -0,0 +1,396 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+import metamds as mds
+from metamds.io import file_digest
+
+
+def _simulation(name):
+    input_dir = tempfile.mkdtemp(prefix='metamds_test_')
+    return mds.Simulation(name=name, input_dir=input_dir)
+
+
+def test_execute_all_respects_dependencies():
+    sim = _simulation('dependencies')
+    build = mds.Task(name='build', simulation=sim,
+                     script=('sleep 0.2', 'touch built.txt'))
+    minimize = mds.Task(name='minimize', simulation=sim,
+                        script=('cp ../build/built.txt copied.txt',))
+    sim.add_task(build)
+    sim.add_task(minimize, depends_on=build)
+
+    wall_times = sim.execute_all(max_workers=2)
+
+    assert list(wall_times) == ['build', 'minimize']
+    assert os.path.isfile(os.path.join(minimize.output_dir, 'copied.txt'))
+    assert build.wall_time >= 0.2
+
+
+def test_dependents_start_in_insertion_order():
+    sim = _simulation('fan_out')
+    build = mds.Task(name='build', simulation=sim, script=())
+    sim.add_task(build)
+    names = ['point_{}'.format(i) for i in range(20)]
+    for name in names:
+        task = mds.Task(name=name, simulation=sim,
+                        script=('sh -c "echo {} >> ../order.txt"'.format(name),))
+        sim.add_task(task, depends_on=build)
+    sim.execute_all(max_workers=1)
+
+    with open(os.path.join(sim.output_dir, 'order.txt')) as fh:
+        assert fh.read().split() == names
+
+
+def test_execute_all_runs_independent_tasks_concurrently():
+    sim = _simulation('concurrent')
+    for i in range(3):
+        sim.add_task(mds.Task(name='sleep_{}'.format(i), simulation=sim,
+                              script=('sleep 0.5',)))
+
+    start = time.time()
+    wall_times = sim.execute_all(max_workers=3)
+
+    assert len(wall_times) == 3
+    assert time.time() - start < 1.4
+
+
+def test_unknown_dependency():
+    sim = _simulation('unknown')
+    task = mds.Task(name='lonely', simulation=sim, script=('true',))
+    with pytest.raises(ValueError):
+        sim.add_task(task, depends_on='missing')
+
+
+def test_execute_all_skips_unchanged_tasks():
+    sim = _simulation('cache')
+    with open(os.path.join(sim.input_dir, 'conf.gro'), 'w') as fh:
+        fh.write('a')
+    sim.input_files = [os.path.join(sim.input_dir, 'conf.gro')]
+    build = mds.Task(name='build', simulation=sim, script=('touch built.txt',))
+    analyze = mds.Task(name='analyze', simulation=sim,
+                       script=('touch analyzed.txt',))
+    sim.add_task(build)
+    sim.add_task(analyze, depends_on=build)
+    sim.execute_all()
+
+    built = os.path.join(build.output_dir, 'built.txt')
+    analyzed = os.path.join(analyze.output_dir, 'analyzed.txt')
+    os.remove(built)
+    os.remove(analyzed)
+    sim.execute_all()
+    assert not os.path.exists(built)
+    assert not os.path.exists(analyzed)
+
+    # Changing an input re-runs the task and everything downstream of it.
+    with open(os.path.join(sim.input_dir, 'conf.gro'), 'w') as fh:
+        fh.write('b')
+    sim.execute_all()
+    assert os.path.exists(built)
+    assert os.path.exists(analyzed)
+
+    os.remove(built)
+    sim.invalidate_cache()
+    sim.execute_all()
+    assert os.path.exists(built)
+
+
+def test_get_output_files_uses_cached_manifest():
+    sim = _simulation('manifest')
+    task = mds.Task(name='md', simulation=sim,
+                    script=('touch traj.xtc', 'touch conf.gro', 'touch ener.edr'))
+    sim.add_task(task)
+    sim.execute_all()
+
+    assert [os.path.basename(f) for f in task.get_output_files('.xtc')] == ['traj.xtc']
+    assert sorted(task.manifest()) == ['conf.gro', 'ener.edr', 'traj.xtc']
+    assert task.manifest()['conf.gro'].category == 'topologies'
+
+    # New files only show up once the manifest is refreshed.
+    open(os.path.join(task.output_dir, 'more.xtc'), 'w').close()
+    assert len(sim.get_output_files('trajectories')['md']) == 1
+    task.invalidate_manifest()
+    assert len(sim.get_output_files('trajectories')['md']) == 2
+
+
+def _grompp_template(temperature, pressure, input_dir):
+    return ['echo {} {}'.format(temperature, pressure)]
+
+
+def test_parametrize_grid():
+    sim = _simulation('grid')
+    sim.template = _grompp_template
+    tasks = sim.parametrize_grid(temperature=[300, 350], pressure=[1, 10, 100],
+                                 n_processes=2)
+
+    assert sim.n_tasks == 6
+    assert [task.name for task in tasks] == ['task_{}'.format(i) for i in range(6)]
+    assert tasks[1].parameters['temperature'] == 300
+    assert tasks[1].parameters['pressure'] == 10
+    assert tasks[-1].script == ['echo 350 100']
+
+
+def test_parametrize_nothing():
+    sim = _simulation('empty_grid')
+    sim.template = _grompp_template
+    assert sim.parametrize_grid(temperature=[], pressure=[1], n_processes=2) == []
+    assert sim.parametrize_many([], n_processes=2) == []
+    assert sim.n_tasks == 0
+
+
+def test_parametrize_many_formats_string_templates():
+    sim = _simulation('many')
+    sim.template = ['gmx grompp -f {mdp} -p {input_dir}/topol.top']
+    sim.format_template = True
+    tasks = sim.parametrize_many([{'mdp': 'nvt.mdp'}, {'mdp': 'npt.mdp'}])
+    task = sim.parametrize(mdp='md.mdp')
+
+    assert tasks[1].script[0].startswith('gmx grompp -f npt.mdp -p ../../')
+    assert task.name == 'task_2'
+    assert task.script[0].startswith('gmx grompp -f md.mdp')
+
+
+def test_string_templates_keep_braces():
+    sim = _simulation('braces')
+    sim.template = ["gmx energy -f ener.edr | awk '{print $2}'"]
+    task = sim.parametrize(T=300)
+    assert task.script == ["gmx energy -f ener.edr | awk '{print $2}'"]
+
+    sim.template = ["gmx energy -f {T}.edr | awk '{{print $2}}'"]
+    sim.format_template = True
+    task = sim.parametrize(T=300)
+    assert task.script == ["gmx energy -f 300.edr | awk '{print $2}'"]
+
+
+def test_task_dir_layouts():
+    for layout, link in (('symlink', 'conf.gro'), ('hardlink', 'conf.gro'),
+                         ('shared', os.path.join('inputs', 'conf.gro'))):
+        input_dir = tempfile.mkdtemp(prefix='metamds_test_')
+        with open(os.path.join(input_dir, 'conf.gro'), 'w') as fh:
+            fh.write('conf')
+        sim = mds.Simulation(name=layout, input_dir=input_dir, layout=layout)
+        task = mds.Task(name='md', simulation=sim, script=('cp {} copy.gro'.format(link),))
+        sim.add_task(task)
+        # Directories are only created when a task runs.
+        assert not os.path.exists(task.output_dir)
+
+        sim.execute_all()
+        with open(os.path.join(task.output_dir, 'copy.gro')) as fh:
+            assert fh.read() == 'conf'
+        link_path = os.path.join(task.output_dir, link.split(os.sep)[0])
+        assert os.path.islink(link_path) == (layout != 'hardlink')
+
+
+def test_local_commands_are_profiled():
+    sim = _simulation('profile')
+    task = mds.Task(name='md', simulation=sim,
+                    script=('python -c "bytearray(50 * 2**20)"', 'false', 'touch after.txt'))
+    analyze = mds.Task(name='analyze', simulation=sim, script=('touch analyzed.txt',))
+    sim.add_task(task)
+    sim.add_task(analyze, depends_on=task)
+    with pytest.raises(RuntimeError) as error:
+        sim.execute_all()
+    assert 'Not run because a dependency failed: analyze' in str(error.value)
+
+    # The script stops at the first failing command.
+    assert not os.path.exists(os.path.join(task.output_dir, 'after.txt'))
+    assert not os.path.exists(os.path.join(analyze.output_dir, 'analyzed.txt'))
+    assert not task.is_cached()
+
+    profile = task.load_profile()
+    assert profile['hostname'] == 'localhost'
+    first, second = profile['commands']
+    assert first['returncode'] == 0 and second['returncode'] == 1
+    assert first['wall_time'] > 0
+    if hasattr(os, 'wait4'):
+        assert first['max_rss'] > 50 * 2**20
+
+
+def test_analysis_runs_after_script_and_limits_sync(monkeypatch):
+    sim = _simulation('analysis')
+    task = mds.Task(name='md', simulation=sim, script=('sh -c "seq 100 > traj.txt"',))
+    task.analysis = ['sh -c "wc -l < traj.txt > count.xvg"']
+    task.reduced_outputs = ['.xvg']
+    sim.add_task(task)
+    sim.execute_all()
+    with open(os.path.join(task.output_dir, 'count.xvg')) as fh:
+        assert fh.read().strip() == '100'
+
+    rules = list()
+
+    def rsync_from(flags, **kwargs):
+        rules_file = flags.split('merge ')[1].split('"')[0]
+        with open(rules_file) as fh:
+            rules.append(fh.read().splitlines())
+        return b''
+
+    monkeypatch.setattr('metamds.task.rsync_from', rsync_from)
+    task.hostname, task.remote_dir = 'rahman.vuse.vanderbilt.edu', '/scratch/tmp.1'
+    task.sync()
+    task.sync(reduced=False)
+    assert rules[0] == ['+ /md/', '+ /md/*.xvg', '- *']
+    assert rules[1] == ['+ /md/***', '- *']
+
+
+def test_sync_all_batches_tasks_per_host_and_stream(monkeypatch):
+    sim = _simulation('sync_batches')
+    hosts = {'rahman.vuse.vanderbilt.edu': 'abc', 'edison.nersc.gov': 'de'}
+    for hostname, names in sorted(hosts.items()):
+        for name in names:
+            task = mds.Task(name=name, simulation=sim, script=())
+            task.hostname, task.username = hostname, 'user'
+            task.remote_dir = '/scratch/{}'.format(hostname.split('.')[0])
+            sim.add_task(task)
+
+    transfers = list()
+
+    def rsync_from(flags, src, dst, user, host, logger=None):
+        with open(flags.split('merge ')[1].split('"')[0]) as fh:
+            names = [rule.split('/')[1] for rule in fh.read().splitlines()
+                     if rule.endswith('/***')]
+        transfers.append((host, sorted(names)))
+        return ''.join('{0}/\n100 {0}/traj.xtc\n50 {0}/ener.edr\n'.format(name)
+                       for name in names).encode('utf-8')
+    monkeypatch.setattr('metamds.task.rsync_from', rsync_from)
+
+    sim.sync_all(reduced=False)
+    assert sorted(transfers) == [('edison.nersc.gov', ['d', 'e']),
+                                 ('rahman.vuse.vanderbilt.edu', ['a', 'b', 'c'])]
+
+    del transfers[:]
+    summary = sim.sync_all(n_streams=2, reduced=False)
+    assert sorted(transfers) == [('edison.nersc.gov', ['d']), ('edison.nersc.gov', ['e']),
+                                 ('rahman.vuse.vanderbilt.edu', ['a', 'c']),
+                                 ('rahman.vuse.vanderbilt.edu', ['b'])]
+    assert sorted(summary) == ['a', 'b', 'c', 'd', 'e']
+    for entry in summary.values():
+        assert (entry['files'], entry['bytes']) == (2, 150)
+
+
+def test_deduplicate_and_sync_known_content(monkeypatch):
+    sim = _simulation('dedup')
+    for temperature in (300, 310, 320):
+        task = mds.Task(name='T_{}'.format(temperature), simulation=sim,
+                        script=('sh -c "echo same > topol.top"',
+                                'sh -c "echo {} > ener.xvg"'.format(temperature)))
+        sim.add_task(task)
+    sim.execute_all()
+
+    assert sim.deduplicate() == (2, 2 * len('same\n'))
+    first, second, third = sim.tasks()
+    assert os.path.samefile(os.path.join(first.output_dir, 'topol.top'),
+                            os.path.join(third.output_dir, 'topol.top'))
+    assert not os.path.samefile(os.path.join(first.output_dir, 'ener.xvg'),
+                                os.path.join(third.output_dir, 'ener.xvg'))
+
+    # A remote task with the same topology only needs its energies copied.
+    remote = mds.Task(name='T_330', simulation=sim, script=())
+    remote.create_dir()
+    remote.hostname, remote.remote_dir = 'rahman.vuse.vanderbilt.edu', '/scratch/tmp.1'
+    digest = file_digest(os.path.join(first.output_dir, 'topol.top'))
+    rules = list()
+
+    def rsync_from(flags, **kwargs):
+        with open(flags.split('merge ')[1].split('"')[0]) as fh:
+            rules.extend(fh.read().splitlines())
+        return b'5 T_330/ener.xvg\n'
+
+    monkeypatch.setattr(sim.ssh_pool, 'client', lambda hostname, username: None)
+    remote.reduced_outputs = ['.top', '.xvg']
+    hashed = list()
+
+    def remote_digests(client, remote_dir, names, patterns=None):
+        hashed.append(patterns)
+        return {'T_330/topol.top': digest, 'T_330/ener.xvg': 'unknown'}
+
+    monkeypatch.setattr('metamds.task.remote_digests', remote_digests)
+    monkeypatch.setattr('metamds.task.rsync_from', rsync_from)
+    summary = remote.sync(dedup=True)
+
+    # Only files that would be copied are hashed.
+    assert hashed == [('*.top', '*.xvg')]
+    assert rules[0] == '- /T_330/topol.top'
+    assert summary['linked'] == 1 and summary['files'] == 1
+    assert os.path.samefile(os.path.join(remote.output_dir, 'topol.top'),
+                            os.path.join(first.output_dir, 'topol.top'))
+
+
+def test_wait_all_syncs_tasks_as_they_finish(monkeypatch):
+    sim = _simulation('wait')
+    for i in range(3):
+        task = mds.Task(name='task_{}'.format(i), simulation=sim, script=())
+        task.pbs_server, task.pbs_id = True, str(i)
+        sim.add_task(task)
+
+    # Task i finishes at poll i.
+    polls = list()
+
+    def status_all(ttl=60):
+        polls.append(time.time())
+        for i, task in enumerate(sim.tasks()):
+            task.latest_status = {'job_state': 'C' if i < len(polls) else 'R'}
+
+    synced = list()
+    monkeypatch.setattr(sim, 'status_all', status_all)
+    for task in sim.tasks():
+        monkeypatch.setattr(task, 'sync', lambda task=task, **kwargs: {'files': 1})
+
+    summaries = sim.wait_all(poll_interval=0.01, callback=lambda task, summary:
+                             synced.append((task.name, len(polls))),
+                             background=True).result(timeout=10)
+
+    assert list(summaries) == ['task_0', 'task_1', 'task_2']
+    assert len(polls) == 3
+    assert len(synced) == 3
+    # Each task is synced as soon as its job is seen to finish.
+    for name, n_polls in synced:
+        assert n_polls >= int(name[-1]) + 1
+
+
+def test_wait_all_queries_analysis_jobs_in_bulk(monkeypatch):
+    sim = _simulation('wait_analysis')
+    task = mds.Task(name='md', simulation=sim, script=())
+    task.hostname, task.username = 'login.accre.vanderbilt.edu', 'user'
+    task.pbs_server, task.pbs_id, task.analysis_id = True, '1', '2'
+    task.submit_line, task.submitted_at = 'sbatch', time.time()
+    sim.add_task(task)
+
+    # Not listed right after submission, then queued, then the analysis job
+    # is gone without having been seen to finish.
+    polls = [{}, {'1': {'State': 'RUNNING'}, '2': {'State': 'PENDING'}},
+             {'1': {'State': 'COMPLETED'}}]
+    queries = list()
+
+    def query_jobs(client, submit_line, job_ids):
+        queries.append(list(job_ids))
+        return polls[len(queries) - 1]
+
+    monkeypatch.setattr('metamds.simulation.query_jobs', query_jobs)
+    monkeypatch.setattr(sim.ssh_pool, 'client', lambda hostname, username: None)
+    monkeypatch.setattr(task, 'sync', lambda **kwargs: {'files': 1})
+    assert list(sim.wait_all(poll_interval=0.01)) == ['md']
+    assert queries == 3 * [['1', '2']]
+
+
+def test_wait_all_ends_unlisted_jobs_after_grace(monkeypatch):
+    sim = _simulation('wait_unlisted')
+    # Finished and dropped by the batch system before `wait_all` was called,
+    # submitted at an unknown time, and just submitted.
+    for name, submitted_at in (('old', time.time() - 600), ('restored', None),
+                               ('new', time.time())):
+        task = mds.Task(name=name, simulation=sim, script=())
+        task.hostname, task.username = 'rahman.vuse.vanderbilt.edu', 'user'
+        task.pbs_server, task.pbs_id, task.submit_line = True, name, 'qsub'
+        task.submitted_at = submitted_at
+        monkeypatch.setattr(task, 'sync', lambda **kwargs: {'files': 1})
+        sim.add_task(task)
+
+    monkeypatch.setattr('metamds.simulation.query_jobs',
+                        lambda client, submit_line, job_ids: {})
+    monkeypatch.setattr(sim.ssh_pool, 'client', lambda hostname, username: None)
+    start = time.time()
+    summaries = sim.wait_all(poll_interval=0.01, grace=0.2, timeout=10)
+    assert list(summaries) == ['old', 'restored', 'new']
+    assert time.time() - start >= 0.2
@@ -0,0 +1,78 @@
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+import metamds as mds
+from metamds.trajectory import open_trajectory
+
+XYZ = np.arange(4 * 3 * 3, dtype=np.float32).reshape(4, 3, 3)
+
+
+def _record(data):
+    return struct.pack('<i', len(data)) + data + struct.pack('<i', len(data))
+
+
+def _write_dcd(path, xyz):
+    icntrl = [len(xyz)] + [0] * 9 + [1] + [0] * 8 + [24]
+    with open(path, 'wb') as fh:
+        fh.write(_record(b'CORD' + struct.pack('<20i', *icntrl)))
+        fh.write(_record(struct.pack('<i', 1) + b' ' * 80))
+        fh.write(_record(struct.pack('<i', xyz.shape[1])))
+        for frame in xyz:
+            fh.write(_record(struct.pack('<6d', 10, 90, 10, 90, 90, 10)))
+            for dim in range(3):
+                fh.write(_record(frame[:, dim].astype('<f4').tobytes()))
+
+
+def _write_trr(path, xyz):
+    with open(path, 'wb') as fh:
+        for step, frame in enumerate(xyz):
+            fh.write(struct.pack('>3i', 1993, 13, 12) + b'GMX_trn_file')
+            fh.write(struct.pack('>13i', 0, 0, 36, 0, 0, 0, 0, frame.size * 4, 0, 0,
+                                 len(frame), step, 0))
+            fh.write(struct.pack('>2f', step, 0))
+            fh.write(np.eye(3, dtype='>f4').tobytes())
+            fh.write(frame.astype('>f4').tobytes())
+
+
+def _write_lammpstrj(path, xyz):
+    with open(path, 'w') as fh:
+        for step, frame in enumerate(xyz):
+            fh.write('ITEM: TIMESTEP\n{}\nITEM: NUMBER OF ATOMS\n{}\n'.format(step, len(frame)))
+            fh.write('ITEM: BOX BOUNDS pp pp pp\n' + '0 100\n' * 3)
+            fh.write('ITEM: ATOMS id type x y z\n')
+            # Atoms are not necessarily written in id order.
+            for i in reversed(range(len(frame))):
+                fh.write('{} 1 {} {} {}\n'.format(i + 1, *frame[i]))
+
+
+def test_readers():
+    out_dir = tempfile.mkdtemp(prefix='metamds_test_')
+    for ext, writer in (('.dcd', _write_dcd), ('.trr', _write_trr),
+                        ('.lammpstrj', _write_lammpstrj)):
+        path = os.path.join(out_dir, 'traj{}'.format(ext))
+        writer(path, XYZ)
+        reader = open_trajectory(path)
+        assert len(reader) == 4
+        assert reader.n_atoms == 3
+        assert np.allclose(reader[2], XYZ[2])
+        assert np.allclose(reader[-1], XYZ[-1])
+        chunks = list(reader.iter_chunks(3))
+        assert [len(chunk) for chunk in chunks] == [3, 1]
+        assert np.allclose(np.concatenate(chunks), XYZ)
+
+
+def test_simulation_iter_trajectories():
+    sim = mds.Simulation(name='trajectories', input_dir=tempfile.mkdtemp(prefix='metamds_test_'))
+    for i in range(2):
+        task = mds.Task(name='task_{}'.format(i), simulation=sim, script=())
+        sim.add_task(task)
+        task.create_dir()
+        _write_dcd(os.path.join(task.output_dir, 'traj.dcd'), XYZ + i)
+
+    assert np.allclose(task.trajectory()[0], XYZ[0] + 1)
+    chunks = list(sim.iter_trajectories(chunk_size=2))
+    assert [(task.name, len(chunk)) for task, chunk in chunks] == [
+        ('task_0', 2), ('task_0', 2), ('task_1', 2), ('task_1', 2)]
@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+import metamds as mds
+from metamds.walltime import (WalltimePredictor, format_walltime, job_elapsed,
+                              parse_walltime)
+
+
+def test_parse_and_format_walltime():
+    assert parse_walltime('1-02:03:04') == 93784
+    assert parse_walltime('02:03:04') == 7384
+    assert parse_walltime('03:04') == 184
+    assert format_walltime(7384) == '02:04:00'
+    assert format_walltime(100 * 3600) == '100:00:00'
+
+
+def test_job_elapsed():
+    assert job_elapsed({'job_state': 'C', 'exit_status': '0',
+                        'resources_used.walltime': '01:00:00'}) == 3600
+    assert job_elapsed({'job_state': 'C', 'exit_status': '1',
+                        'resources_used.walltime': '01:00:00'}) is None
+    assert job_elapsed({'State': 'COMPLETED', 'Elapsed': '00:10:00'}) == 600
+    assert job_elapsed({'State': 'RUNNING', 'Elapsed': '00:10:00'}) is None
+
+
+def _task(sim, name, n_atoms, **parameters):
+    task = mds.Task(name=name, simulation=sim, script=('true',))
+    task.parameters = parameters
+    task.create_dir()
+    with open(os.path.join(task.output_dir, 'conf.gro'), 'w') as fh:
+        fh.write('title\n{:d}\n'.format(n_atoms))
+    return task
+
+
+def test_predict_from_similar_runs():
+    history = os.path.join(tempfile.mkdtemp(prefix='metamds_test_'), 'walltimes.json')
+    predictor = WalltimePredictor(history, margin=1.5, minimum=60, k=1)
+    sim = mds.Simulation(name='walltime', input_dir=tempfile.mkdtemp(prefix='metamds_test_'))
+    hostname = 'edison.nersc.gov'
+
+    assert predictor.predict(_task(sim, 'new', 1000, T=300.0), hostname) is None
+
+    for name, n_atoms, temperature, seconds in (('a', 1000, 300.0, 3600),
+                                                ('b', 1000, 400.0, 7200)):
+        task = _task(sim, name, n_atoms, T=temperature, ff='oplsaa')
+        task.hostname = hostname
+        predictor.record(task, seconds)
+
+    # The nearest run is 'a', scaled up to twice as many atoms.
+    task = _task(sim, 'c', 2000, T=310.0, ff='oplsaa')
+    assert predictor.predict(task, hostname) == 1.5 * 2 * 3600
+    # Other clusters have no history yet.
+    assert predictor.predict(task, 'rahman.vuse.vanderbilt.edu') is None
+    # The history is reloaded from disk.
+    assert len(WalltimePredictor(history).history) == 2